@@ -1,11 +1,11 @@
 # SPDX-License-Identifier: LGPL-2.1-or-later
 
+import concurrent.futures
 import contextlib
 import dataclasses
 import datetime
 import functools
 import hashlib
-import io
 import itertools
 import json
 import logging
@@ -21,12 +21,12 @@ import sys
 import tempfile
 import textwrap
 import uuid
-from collections.abc import Iterator, Mapping, Sequence
+from collections.abc import Iterable, Iterator, Mapping, Sequence
 from contextlib import AbstractContextManager
 from pathlib import Path
-from typing import Optional, Union, cast
+from typing import Any, Callable, Optional, cast
 
-from mkosi.archive import can_extract_tar, extract_tar, make_cpio, make_tar
+from mkosi.archive import can_extract_tar, extract_tar, make_cpio, make_tar, write_tar
 from mkosi.burn import run_burn
 from mkosi.completion import print_completion
 from mkosi.config import (
@@ -58,20 +58,39 @@ from mkosi.config import (
 from mkosi.context import Context
 from mkosi.distributions import Distribution
 from mkosi.installer import clean_package_manager_metadata
-from mkosi.kmod import gen_required_kernel_modules, loaded_modules, process_kernel_modules
-from mkosi.log import ARG_DEBUG, complete_step, die, log_notice, log_step
+from mkosi.kmod import (
+    KernelModuleInventory,
+    gen_required_kernel_modules,
+    loaded_modules,
+    process_kernel_modules,
+)
+from mkosi.log import (
+    ARG_DEBUG,
+    complete_step,
+    die,
+    log_notice,
+    log_step,
+    profile_summary,
+    start_profiling,
+    stop_profiling,
+)
 from mkosi.manifest import Manifest
 from mkosi.mounts import finalize_crypto_mounts, finalize_source_mounts, mount_overlay
 from mkosi.pager import page
 from mkosi.partition import Partition, finalize_root, finalize_roothash
+from mkosi.pe import copy_pe_section
 from mkosi.qemu import KernelType, copy_ephemeral, run_qemu, run_ssh, start_journal_remote
 from mkosi.run import (
+    PROCESS_STATS,
     chroot_cmd,
     chroot_script_cmd,
     finalize_passwd_mounts,
     find_binary,
     fork_and_wait,
+    fork_and_wait_graph,
+    format_process_stats,
     run,
+    spawn,
 )
 from mkosi.sandbox import (
     CLONE_NEWNS,
@@ -81,18 +100,37 @@ from mkosi.sandbox import (
     MOUNT_ATTR_RDONLY,
     MS_REC,
     MS_SLAVE,
+    OverlayOperation,
     __version__,
     acquire_privileges,
     mount,
     mount_rbind,
     umask,
+    umount2,
     unshare,
     userns_has_single_user,
 )
-from mkosi.tree import copy_tree, make_tree, move_tree, rmtree
+from mkosi.tree import (
+    TRASH_DIRECTORY,
+    TreeIndex,
+    can_reflink,
+    clamp_mtime,
+    copy_tree,
+    empty_trash,
+    exchange_tree,
+    is_subvolume,
+    is_trash_directory,
+    make_tree,
+    move_tree,
+    reflink_file_range,
+    rmtree,
+)
 from mkosi.types import PathString
 from mkosi.user import INVOKING_USER
 from mkosi.util import (
+    HashingTee,
+    copy_file_contents,
+    evict_cache_entries,
     flatten,
     flock,
     flock_or_die,
@@ -139,6 +177,9 @@ def mount_base_trees(context: Context) -> Iterator[None]:
 
         yield
 
+    # Once the overlay is unmounted, the root only contains the upper directory so any index of it is stale.
+    context.index = None
+
 
 def remove_files(context: Context) -> None:
     """Remove files based on user-specified patterns"""
@@ -147,49 +188,62 @@ def remove_files(context: Context) -> None:
         return
 
     with complete_step("Removing files…"):
-        remove = flatten(context.root.glob(pattern.lstrip("/")) for pattern in context.config.remove_files)
-        rmtree(*remove, context.root / "work", sandbox=context.sandbox)
+        index = context.root_index()
+        remove = flatten(index.glob(pattern.lstrip("/")) for pattern in context.config.remove_files)
+        rmtree(*(context.root / p for p in remove), context.root / "work", sandbox=context.sandbox)
+        index.remove(*remove, Path("work"))
 
 
-def install_distribution(context: Context) -> None:
+def install_base_system(context: Context) -> None:
     if context.config.base_trees:
-        if not context.config.packages:
-            return
+        return
 
-        with complete_step(f"Installing extra packages for {str(context.config.distribution).capitalize()}"):
-            context.config.distribution.install_packages(context, context.config.packages)
-    else:
-        if context.config.overlay or context.config.output_format in (OutputFormat.sysext, OutputFormat.confext):
-            if context.config.packages:
-                die("Cannot install packages in extension images without a base tree",
-                    hint="Configure a base tree with the BaseTrees= setting")
-            return
+    if context.config.overlay or context.config.output_format in (OutputFormat.sysext, OutputFormat.confext):
+        if context.config.packages:
+            die("Cannot install packages in extension images without a base tree",
+                hint="Configure a base tree with the BaseTrees= setting")
+        return
 
-        with complete_step(f"Installing {str(context.config.distribution).capitalize()}"):
-            context.config.distribution.install(context)
+    with complete_step(f"Installing {str(context.config.distribution).capitalize()}"):
+        context.config.distribution.install(context)
 
-            if not (context.root / "etc/machine-id").exists():
-                # Uninitialized means we want it to get initialized on first boot.
-                with umask(~0o444):
-                    (context.root / "etc/machine-id").write_text("uninitialized\n")
+        if not (context.root / "etc/machine-id").exists():
+            # Uninitialized means we want it to get initialized on first boot.
+            with umask(~0o444):
+                (context.root / "etc/machine-id").write_text("uninitialized\n")
 
-            # Ensure /efi exists so that the ESP is mounted there, as recommended by
-            # https://0pointer.net/blog/linux-boot-partitions.html. Use the most restrictive access mode we
-            # can without tripping up mkfs tools since this directory is only meant to be overmounted and
-            # should not be read from or written to.
-            with umask(~0o500):
-                (context.root / "efi").mkdir(exist_ok=True)
-                (context.root / "boot").mkdir(exist_ok=True)
+        # Ensure /efi exists so that the ESP is mounted there, as recommended by
+        # https://0pointer.net/blog/linux-boot-partitions.html. Use the most restrictive access mode we
+        # can without tripping up mkfs tools since this directory is only meant to be overmounted and
+        # should not be read from or written to.
+        with umask(~0o500):
+            (context.root / "efi").mkdir(exist_ok=True)
+            (context.root / "boot").mkdir(exist_ok=True)
+
+        # Ensure /boot/loader/entries.srel exists and has type1 written to it to nudge kernel-install towards using
+        # the boot loader specification layout.
+        with umask(~0o700):
+            (context.root / "boot/loader").mkdir(exist_ok=True)
+        with umask(~0o600):
+            (context.root / "boot/loader/entries.srel").write_text("type1\n")
 
-            # Ensure /boot/loader/entries.srel exists and has type1 written to it to nudge kernel-install towards using
-            # the boot loader specification layout.
-            with umask(~0o700):
-                (context.root / "boot/loader").mkdir(exist_ok=True)
-            with umask(~0o600):
-                (context.root / "boot/loader/entries.srel").write_text("type1\n")
 
-            if context.config.packages:
-                context.config.distribution.install_packages(context, context.config.packages)
+def install_distribution_packages(context: Context) -> None:
+    if context.config.base_trees:
+        # Leave the files supplied by the base trees alone if we don't install anything on top of them.
+        if not context.config.packages:
+            return
+
+        step = f"Installing extra packages for {str(context.config.distribution).capitalize()}"
+    elif context.config.overlay or context.config.output_format in (OutputFormat.sysext, OutputFormat.confext):
+        # install_base_system() already refused packages for extension images without a base tree.
+        return
+    else:
+        step = f"Installing packages for {str(context.config.distribution).capitalize()}"
+
+    if context.config.packages:
+        with complete_step(step):
+            context.config.distribution.install_packages(context, context.config.packages)
 
     for f in ("var/lib/systemd/random-seed",
               "var/lib/systemd/credential.secret",
@@ -593,8 +647,11 @@ def script_maybe_chroot_sandbox(
                 yield sandbox
 
 
-def run_prepare_scripts(context: Context, build: bool) -> None:
-    if not context.config.prepare_scripts:
+def run_prepare_scripts(context: Context, build: bool, scripts: Optional[Sequence[Path]] = None) -> None:
+    if scripts is None:
+        scripts = context.config.prepare_scripts
+
+    if not scripts:
         return
     if build and not context.config.build_scripts:
         return
@@ -640,7 +697,7 @@ def run_prepare_scripts(context: Context, build: bool) -> None:
             step_msg = "Running prepare script {}…"
             arg = "final"
 
-        for script in context.config.prepare_scripts:
+        for script in scripts:
             with complete_step(step_msg.format(script)):
                 options: list[PathString] = [
                     "--ro-bind", script, "/work/prepare",
@@ -876,6 +933,8 @@ def run_finalize_scripts(context: Context) -> None:
                     )
                 )
 
+    context.index = None
+
 
 def run_postoutput_scripts(context: Context) -> None:
     if not context.config.postoutput_scripts:
@@ -1616,6 +1675,7 @@ def install_tree(
             src, t,
             preserve=preserve,
             use_subvolumes=config.use_subvolumes,
+            copy_tool=config.copy_tool,
             sandbox=config.sandbox,
         )
 
@@ -1716,6 +1776,7 @@ def install_build_dest(context: Context) -> None:
         copy_tree(
             context.install_dir, context.root,
             use_subvolumes=context.config.use_subvolumes,
+            copy_tool=context.config.copy_tool,
             sandbox=context.sandbox,
         )
 
@@ -1863,6 +1924,10 @@ def finalize_default_initrd(
     return dataclasses.replace(config, image="default-initrd")
 
 
+# The number of default initrds that are kept in the cache directory.
+DEFAULT_INITRD_CACHE_ENTRIES = 4
+
+
 def build_default_initrd(context: Context) -> Path:
     if context.config.distribution == Distribution.custom:
         die("Building a default initrd is not supported for custom distributions")
@@ -1877,10 +1942,39 @@ def build_default_initrd(context: Context) -> Path:
     assert config.output_dir
 
     config.output_dir.mkdir(exist_ok=True)
+    output = config.output_dir / config.output
+
+    if output.exists():
+        return output
+
+    if not context.config.cache_dir:
+        build_default_initrd_image(context, config)
+        return output
+
+    # Default initrds only depend on their configuration and on the packages they're built from, so they can be
+    # shared between all images and builds that use the same configuration and repository metadata.
+    key = default_initrd_cache_key(context, config)
+    cached = context.config.cache_dir / f"default-initrd-{key}.initrd"
+    lock = cached.with_suffix(".lock")
+
+    context.config.cache_dir.mkdir(parents=True, exist_ok=True)
+
+    # Serialize builds of the same initrd so that concurrent builds on this host only build it once.
+    with flock(lock, create=True):
+        if reuse_cache_file(cached, output):
+            logging.info(f"Reusing cached default initrd {cached}")
+            return output
 
-    if (config.output_dir / config.output).exists():
-        return config.output_dir / config.output
+        build_default_initrd_image(context, config)
+        install_cache_file(output, cached)
 
+    # Entries that are in use by other builds are skipped as they hold the entry's lock.
+    evict_cache_entries(context.config.cache_dir, "default-initrd-*.initrd", keep=DEFAULT_INITRD_CACHE_ENTRIES)
+
+    return output
+
+
+def build_default_initrd_image(context: Context, config: Config) -> None:
     with (
         complete_step("Building default initrd"),
         setup_workspace(context.args, config) as workspace,
@@ -1897,7 +1991,52 @@ def build_default_initrd(context: Context) -> Path:
             )
         )
 
-    return config.output_dir / config.output
+
+def default_initrd_cache_key(context: Context, config: Config) -> str:
+    # The output directory is part of the current build's workspace and the resources are unpacked into a temporary
+    # directory, so neither path may end up in the key.
+    settings = {k: v for k, v in config.to_dict().items() if k != "OutputDirectory"}
+    dump = json.dumps(settings, cls=JsonEncoder, sort_keys=True).replace(os.fspath(context.resources), "@RESOURCES@")
+
+    h = hashlib.sha256()
+    h.update(__version__.encode())
+    h.update(dump.encode())
+    h.update(json.dumps(config.cache_manifest(), cls=JsonEncoder, sort_keys=True).encode())
+    # We can't know which package versions the package manager resolves to without running it, but they're fully
+    # determined by the repository metadata snapshot the initrd is built from, so key on its contents instead.
+    h.update(repository_metadata_digest(config, context.metadata_dir).encode())
+
+    return h.hexdigest()[:32]
+
+
+def repository_metadata_digest(config: Config, metadata_dir: Path) -> str:
+    manager = config.distribution.package_manager(config)
+    subdir = manager.subdir(config)
+    excluded = []
+
+    for d, subdirs in (("cache", manager.cache_subdirs), ("lib", manager.state_subdirs)):
+        if (src := metadata_dir / d / subdir).exists():
+            excluded += subdirs(src)
+
+    return directory_digest(metadata_dir / "cache" / subdir, metadata_dir / "lib" / subdir, excluded=tuple(excluded))
+
+
+@functools.cache
+def directory_digest(*directories: Path, excluded: tuple[Path, ...] = ()) -> str:
+    h = hashlib.sha256()
+
+    for d in directories:
+        for dirpath, dirnames, filenames in os.walk(d):
+            dirnames[:] = sorted(n for n in dirnames if Path(dirpath) / n not in excluded)
+
+            for name in sorted(filenames):
+                p = Path(dirpath) / name
+                if p.is_symlink() or not p.is_file():
+                    continue
+
+                h.update(f"{p.relative_to(d.parent)}\0{hash_file(p)}\0".encode())
+
+    return h.hexdigest()
 
 
 def identify_cpu(root: Path) -> tuple[Optional[Path], Optional[Path]]:
@@ -1943,6 +2082,10 @@ def identify_cpu(root: Path) -> tuple[Optional[Path], Optional[Path]]:
     return (Path(f"{vendor_id}.bin"), None)
 
 
+# The number of microcode initrds that are kept in the cache directory.
+MICROCODE_INITRD_CACHE_ENTRIES = 4
+
+
 def build_microcode_initrd(context: Context) -> list[Path]:
     if not context.config.architecture.is_x86_variant():
         return []
@@ -1958,31 +2101,56 @@ def build_microcode_initrd(context: Context) -> list[Path]:
         logging.warning("/usr/lib/firmware/{amd-ucode,intel-ucode} not found, not adding microcode")
         return []
 
-    root = context.workspace / "microcode-root"
-    destdir = root / "kernel/x86/microcode"
-
-    with umask(~0o755):
-        destdir.mkdir(parents=True, exist_ok=True)
+    blobs: dict[str, list[Path]] = {}
 
     if context.config.microcode_host:
         vendorfile, ucodefile = identify_cpu(context.root)
         if vendorfile is None or ucodefile is None:
             logging.warning("Unable to identify CPU for MicrocodeHostonly=")
             return []
-        with (destdir / vendorfile).open("wb") as f:
-            f.write(ucodefile.read_bytes())
+        blobs[vendorfile.name] = [ucodefile]
     else:
         if amd.exists():
-            with (destdir / "AuthenticAMD.bin").open("wb") as f:
-                for p in amd.iterdir():
-                    f.write(p.read_bytes())
-
+            blobs["AuthenticAMD.bin"] = sorted(amd.iterdir())
         if intel.exists():
-            with (destdir / "GenuineIntel.bin").open("wb") as f:
-                for p in intel.iterdir():
-                    f.write(p.read_bytes())
+            blobs["GenuineIntel.bin"] = sorted(intel.iterdir())
+
+    cached = None
+    if context.config.cache_dir:
+        # Microcode only changes with the firmware packages so identify it by the paths, sizes and modification times
+        # of the blobs instead of by their contents.
+        h = hashlib.sha256()
+        for name, paths in blobs.items():
+            for p in paths:
+                st = p.stat()
+                h.update(f"{name}\0{p.relative_to(context.root)}\0{st.st_size}\0{st.st_mtime_ns}\0".encode())
+
+        mode = "host" if context.config.microcode_host else "all"
+        cached = context.config.cache_dir / f"microcode-{mode}-{h.hexdigest()[:32]}.initrd"
+
+        if reuse_cache_file(cached, microcode):
+            logging.debug(f"Reusing cached microcode initrd {cached}")
+            return [microcode]
+
+    root = context.workspace / "microcode-root"
+    destdir = root / "kernel/x86/microcode"
+
+    with umask(~0o755):
+        destdir.mkdir(parents=True, exist_ok=True)
+
+    for name, paths in blobs.items():
+        with (destdir / name).open("wb") as f:
+            for p in paths:
+                copy_file_contents(p, f)
 
-    make_cpio(root, microcode, sandbox=context.sandbox)
+    make_cpio(root, microcode)
+
+    if cached:
+        cached.parent.mkdir(parents=True, exist_ok=True)
+        install_cache_file(microcode, cached)
+        # Images sharing the cache directory might use different firmware, so only evict the least recently used
+        # entries instead of all entries built from other firmware.
+        evict_cache_entries(cached.parent, "microcode-*.initrd", keep=MICROCODE_INITRD_CACHE_ENTRIES)
 
     return [microcode]
 
@@ -1998,26 +2166,15 @@ def finalize_kernel_modules_include(context: Context, *, include: Sequence[str],
     return final
 
 
+# The number of kernel modules initrds that are kept in the cache directory.
+KERNEL_MODULES_INITRD_CACHE_ENTRIES = 8
+
+
 def build_kernel_modules_initrd(context: Context, kver: str) -> Path:
     kmods = context.workspace / f"kernel-modules-{kver}.initrd"
     if kmods.exists():
         return kmods
 
-    make_cpio(
-        context.root, kmods,
-        files=gen_required_kernel_modules(
-            context.root, kver,
-            include=finalize_kernel_modules_include(
-                context,
-                include=context.config.kernel_modules_initrd_include,
-                host=context.config.kernel_modules_initrd_include_host,
-            ),
-            exclude=context.config.kernel_modules_initrd_exclude,
-        ),
-        sandbox=context.sandbox,
-    )
-
-
     if context.config.distribution.is_apt_distribution():
         # Ubuntu Focal's kernel does not support zstd-compressed initrds so use xz instead.
         if context.config.distribution == Distribution.ubuntu and context.config.release == "focal":
@@ -2029,12 +2186,113 @@ def build_kernel_modules_initrd(context: Context, kver: str) -> Path:
             compression = Compression.none
         else:
             compression = Compression.zstd
+    else:
+        compression = Compression.none
 
-        maybe_compress(context, compression, kmods, kmods)
+    include = finalize_kernel_modules_include(
+        context,
+        include=context.config.kernel_modules_initrd_include,
+        host=context.config.kernel_modules_initrd_include_host,
+    )
+    files = list(
+        gen_required_kernel_modules(
+            context.root, kver,
+            include=include,
+            exclude=context.config.kernel_modules_initrd_exclude,
+            cache=context.config.cache_dir,
+        )
+    )
+
+    cached = None
+    if context.config.cache_dir:
+        cached = kernel_modules_initrd_cache_path(
+            context,
+            kver,
+            files=files,
+            compression=compression,
+            include=include,
+        )
+
+        if reuse_cache_file(cached, kmods):
+            logging.debug(f"Reusing cached kernel modules initrd {cached}")
+            return kmods
+
+    make_cpio(
+        context.root, kmods,
+        files=files,
+        compressor=compressor_command(context, compression) if compression else [],
+        sandbox=context.sandbox,
+    )
+
+    if cached:
+        cached.parent.mkdir(parents=True, exist_ok=True)
+        install_cache_file(kmods, cached)
+        # Images sharing the cache directory might use the same kernel and settings with different modules, so only
+        # evict the least recently used entries instead of all entries for other modules.
+        evict_cache_entries(cached.parent, "kernel-modules-*.initrd", keep=KERNEL_MODULES_INITRD_CACHE_ENTRIES)
 
     return kmods
 
 
+def kernel_modules_initrd_cache_path(
+    context: Context,
+    kver: str,
+    *,
+    files: Sequence[Path],
+    compression: Compression,
+    include: Iterable[str],
+) -> Path:
+    assert context.config.cache_dir
+
+    settings = hashlib.sha256()
+    settings.update(json.dumps([
+        kver,
+        str(compression),
+        sorted(include),
+        context.config.kernel_modules_initrd_exclude,
+    ]).encode())
+
+    # Instead of hashing the contents of every module and firmware file, we assume that files with the same path,
+    # size, mode, ownership and modification time have not changed.
+    content = hashlib.sha256()
+    for f in files:
+        st = os.lstat(context.root / f)
+        content.update(f"{f}\0{st.st_size}\0{st.st_mode}\0{st.st_uid}\0{st.st_gid}\0{st.st_mtime_ns}\0".encode())
+
+    key = f"{settings.hexdigest()[:16]}-{content.hexdigest()[:16]}"
+    return context.config.cache_dir / f"kernel-modules-{kver}-{key}.initrd"
+
+
+def reuse_cache_file(cached: Path, dst: Path) -> bool:
+    try:
+        # Mark the entry as recently used so that it's not evicted.
+        os.utime(cached)
+        link_or_copy(cached, dst)
+    except FileNotFoundError:
+        # The entry doesn't exist or was evicted by a concurrent build.
+        return False
+
+    return True
+
+
+def link_or_copy(src: Path, dst: Path) -> None:
+    dst.unlink(missing_ok=True)
+
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copy2(src, dst)
+
+
+def install_cache_file(src: Path, dst: Path) -> None:
+    # Install into the cache via a temporary file so that concurrent builds never see a partially written file.
+    with tempfile.NamedTemporaryFile(dir=dst.parent, prefix=f".{dst.name}", delete=False) as f:
+        pass
+
+    link_or_copy(src, Path(f.name))
+    os.rename(f.name, dst)
+
+
 def join_initrds(initrds: Sequence[Path], output: Path) -> Path:
     assert initrds
 
@@ -2042,15 +2300,27 @@ def join_initrds(initrds: Sequence[Path], output: Path) -> Path:
         shutil.copy2(initrds[0], output)
         return output
 
-    seq = io.BytesIO()
-    for p in initrds:
-        initrd = p.read_bytes()
-        n = len(initrd)
-        padding = b'\0' * (round_up(n, 4) - n)  # pad to 32 bit alignment
-        seq.write(initrd)
-        seq.write(padding)
+    with output.open("wb") as f:
+        blksize = os.fstat(f.fileno()).st_blksize
+
+        for p in initrds:
+            n = p.stat().st_size
+            offset = f.tell()
+
+            # If both the offset and the size are block aligned, we can share the initrd's blocks with the output
+            # instead of copying them. Otherwise copy_file_range() still avoids copying the data through userspace.
+            if offset % blksize == 0 and n % blksize == 0 and n > 0:
+                f.flush()
+                with p.open("rb") as initrd:
+                    reflinked = reflink_file_range(initrd.fileno(), f.fileno(), offset=offset, length=n)
+
+                if reflinked:
+                    f.seek(offset + n)
+                    continue
+
+            n = copy_file_contents(p, f)
+            f.write(b"\0" * (round_up(n, 4) - n))  # pad to 32 bit alignment
 
-    output.write_bytes(seq.getbuffer())
     return output
 
 
@@ -2067,6 +2337,11 @@ def python_binary(config: Config, *, binary: Optional[PathString]) -> str:
 
 
 def extract_pe_section(context: Context, binary: Path, section: str, output: Path) -> Path:
+    try:
+        return copy_pe_section(binary, section, output)
+    except (ValueError, OSError) as e:
+        logging.debug(f"Failed to extract {section} from {binary} natively, falling back to pefile: {e}")
+
     # When using a tools tree, we want to use the pefile module from the tools tree instead of requiring that
     # python-pefile is installed on the host. So we execute python as a subprocess to make sure we load
     # pefile from the tools tree if one is used.
@@ -2597,8 +2872,16 @@ def install_kernel(context: Context, partitions: Sequence[Partition]) -> None:
 
 
 def make_uki(context: Context, stub: Path, kver: str, kimg: Path, microcode: list[Path], output: Path) -> None:
-    make_cpio(context.root, context.workspace / "initrd", sandbox=context.sandbox)
-    maybe_compress(context, context.config.compress_output, context.workspace / "initrd", context.workspace / "initrd")
+    make_cpio(
+        context.root, context.workspace / "initrd",
+        index=context.root_index(),
+        compressor=(
+            compressor_command(context, context.config.compress_output)
+            if context.config.compress_output
+            else []
+        ),
+        sandbox=context.sandbox,
+    )
 
     initrds = [context.workspace / "initrd"]
 
@@ -2626,6 +2909,7 @@ def maybe_compress(context: Context, compression: Compression, src: Path, dst: O
             move_tree(
                 src, dst,
                 use_subvolumes=context.config.use_subvolumes,
+                copy_tool=context.config.copy_tool,
                 sandbox=context.sandbox,
             )
         return
@@ -2639,8 +2923,10 @@ def maybe_compress(context: Context, compression: Compression, src: Path, dst: O
         with src.open("rb") as i:
             src.unlink() # if src == dst, make sure dst doesn't truncate the src file but creates a new file.
 
-            with dst.open("wb") as o:
-                run(cmd, stdin=i, stdout=o, sandbox=context.sandbox(binary=cmd[0]))
+            with dst.open("wb") as o, (tee := HashingTee(o)) as fd:
+                run(cmd, stdin=i, stdout=fd, sandbox=context.sandbox(binary=cmd[0]))
+
+    context.record_digest(dst, tee.hexdigest())
 
 
 def copy_uki(context: Context) -> None:
@@ -2720,13 +3006,24 @@ def calculate_sha256sum(context: Context) -> None:
         return
 
     with complete_step("Calculating SHA256SUMS…"):
-        with open(context.workspace / context.config.output_checksum, "w") as f:
-            for p in context.staging.iterdir():
-                if p.is_dir():
-                    logging.warning(f"Cannot checksum directory '{p}', skipping")
-                    continue
+        paths = []
+        for p in context.staging.iterdir():
+            if p.is_dir():
+                logging.warning(f"Cannot checksum directory '{p}', skipping")
+                continue
+
+            paths += [p]
+
+        # Only hash the outputs we didn't write ourselves, the digests of the others were calculated while they were
+        # being written.
+        digests = {p: d for p in paths if (d := context.recorded_digest(p))}
+        if unhashed := [p for p in paths if p not in digests]:
+            with concurrent.futures.ThreadPoolExecutor(max_workers=min(len(unhashed), os.cpu_count() or 1)) as pool:
+                digests.update(zip(unhashed, pool.map(hash_file, unhashed)))
 
-                print(hash_file(p) + " *" + p.name, file=f)
+        with open(context.workspace / context.config.output_checksum, "w") as f:
+            for p in paths:
+                print(digests[p] + " *" + p.name, file=f)
 
         (context.workspace / context.config.output_checksum).rename(context.staging / context.config.output_checksum)
 
@@ -2774,21 +3071,6 @@ def calculate_signature(context: Context) -> None:
         )
 
 
-def dir_size(path: Union[Path, os.DirEntry[str]]) -> int:
-    dir_sum = 0
-    for entry in os.scandir(path):
-        if entry.is_symlink():
-            # We can ignore symlinks because they either point into our tree,
-            # in which case we'll include the size of target directory anyway,
-            # or outside, in which case we don't need to.
-            continue
-        elif entry.is_file():
-            dir_sum += entry.stat().st_blocks * 512
-        elif entry.is_dir():
-            dir_sum += dir_size(entry)
-    return dir_sum
-
-
 def save_manifest(context: Context, manifest: Optional[Manifest]) -> None:
     if not manifest:
         return
@@ -2805,16 +3087,18 @@ def save_manifest(context: Context, manifest: Optional[Manifest]) -> None:
                     manifest.write_package_report(f)
 
 
-def print_output_size(path: Path) -> None:
+def print_output_size(path: Path, *, index: Optional[TreeIndex] = None) -> None:
     if path.is_dir():
-        log_step(f"{path} size is " + format_bytes(dir_size(path)) + ".")
+        # We can ignore symlinks because they either point into our tree, in which case we'll include the size of
+        # target directory anyway, or outside, in which case we don't need to.
+        log_step(f"{path} size is " + format_bytes((index or TreeIndex.scan(path)).size()) + ".")
     else:
         size = format_bytes(path.stat().st_size)
         space = format_bytes(path.stat().st_blocks * 512)
         log_step(f"{path} size is {size}, consumes {space}.")
 
 
-def cache_tree_paths(config: Config) -> tuple[Path, Path, Path]:
+def cache_tree_paths(config: Config) -> tuple[Path, Path, Path, Path]:
     fragments = [config.distribution, config.release, config.architecture]
 
     if config.image:
@@ -2827,6 +3111,7 @@ def cache_tree_paths(config: Config) -> tuple[Path, Path, Path]:
         config.cache_dir / f"{key}.cache",
         config.cache_dir / f"{key}.build.cache",
         config.cache_dir / f"{key}.manifest",
+        config.cache_dir / f"{key}.stages",
     )
 
 
@@ -3071,8 +3356,8 @@ def run_depmod(context: Context, *, cache: bool = False) -> None:
             not context.config.kernel_modules_exclude and
             all((modulesd / o).exists() for o in outputs)
         ):
-            mtime = (modulesd / "modules.dep").stat().st_mtime
-            if all(m.stat().st_mtime <= mtime for m in modulesd.rglob("*.ko*")):
+            mtime = (modulesd / "modules.dep").stat().st_mtime_ns
+            if KernelModuleInventory.get(context.root, kver).newest_mtime() <= mtime:
                 continue
 
         if not cache:
@@ -3084,6 +3369,7 @@ def run_depmod(context: Context, *, cache: bool = False) -> None:
                     host=context.config.kernel_modules_include_host,
                 ),
                 exclude=context.config.kernel_modules_exclude,
+                cache=context.config.cache_dir,
             )
 
         with complete_step(f"Running depmod for {kver}"):
@@ -3254,22 +3540,24 @@ def save_cache(context: Context) -> None:
     if not context.config.incremental or context.config.base_trees or context.config.overlay:
         return
 
-    final, build, manifest = cache_tree_paths(context.config)
+    final, build, manifest, _ = cache_tree_paths(context.config)
 
     with complete_step("Installing cache copies"):
-        rmtree(final, sandbox=context.sandbox)
+        rmtree(final, sandbox=context.sandbox, background=True)
 
         move_tree(
             context.root, final,
             use_subvolumes=context.config.use_subvolumes,
+            copy_tool=context.config.copy_tool,
             sandbox=context.sandbox,
         )
 
         if need_build_overlay(context.config) and (context.workspace / "build-overlay").exists():
-            rmtree(build, sandbox=context.sandbox)
+            rmtree(build, sandbox=context.sandbox, background=True)
             move_tree(
                 context.workspace / "build-overlay", build,
                 use_subvolumes=context.config.use_subvolumes,
+                copy_tool=context.config.copy_tool,
                 sandbox=context.sandbox,
             )
 
@@ -3283,11 +3571,45 @@ def save_cache(context: Context) -> None:
         )
 
 
+def cache_manifest_delta(prev: dict[str, Any], new: dict[str, Any]) -> Optional[tuple[list[str], list[str]]]:
+    """
+    If the given cache manifests only differ in packages or build packages that were added, return the added
+    packages and build packages, otherwise return None.
+    """
+    if (
+        {k: v for k, v in prev.items() if k not in ("packages", "build_packages")} !=
+        {k: v for k, v in new.items() if k not in ("packages", "build_packages")}
+    ):
+        return None
+
+    if any(not set(prev.get(k, [])) <= set(new[k]) for k in ("packages", "build_packages")):
+        return None
+
+    return (
+        sorted(set(new["packages"]) - set(prev.get("packages", []))),
+        sorted(set(new["build_packages"]) - set(prev.get("build_packages", []))),
+    )
+
+
+def cache_package_delta(config: Config) -> tuple[list[str], list[str]]:
+    """
+    Return the packages and build packages that were added to the configuration since the cached images were built.
+    """
+    _, _, manifest, _ = cache_tree_paths(config)
+    if not have_cache(config):
+        return [], []
+
+    prev = json.loads(manifest.read_text())
+    new = json.loads(json.dumps(config.cache_manifest(), cls=JsonEncoder))
+
+    return cache_manifest_delta(prev, new) or ([], [])
+
+
 def have_cache(config: Config) -> bool:
     if not config.incremental or config.base_trees or config.overlay:
         return False
 
-    final, build, manifest = cache_tree_paths(config)
+    final, build, manifest, _ = cache_tree_paths(config)
     if not final.exists():
         logging.info(f"{final} does not exist, not reusing cached images")
         return False
@@ -3299,7 +3621,7 @@ def have_cache(config: Config) -> bool:
     if manifest.exists():
         prev = json.loads(manifest.read_text())
         new = json.dumps(config.cache_manifest(), cls=JsonEncoder, indent=4, sort_keys=True)
-        if prev != json.loads(new):
+        if prev != json.loads(new) and cache_manifest_delta(prev, json.loads(new)) is None:
             logging.info("Cache manifest mismatch, not reusing cached images")
             if ARG_DEBUG.get():
                 run(["diff", manifest, "-"], input=new, check=False,
@@ -3317,22 +3639,274 @@ def reuse_cache(context: Context) -> bool:
     if not have_cache(context.config):
         return False
 
-    final, build, _ = cache_tree_paths(context.config)
+    final, build, _, _ = cache_tree_paths(context.config)
 
     if final.stat().st_uid != os.getuid():
         return False
 
-    with complete_step("Copying cached trees"):
+    if want_cache_overlay(context):
+        with complete_step("Mounting cached trees"):
+            mount_cache_overlay(context, final)
+    else:
+        with complete_step("Copying cached trees"):
+            copy_tree(
+                final, context.root,
+                use_subvolumes=context.config.use_subvolumes,
+                copy_tool=context.config.copy_tool,
+                sandbox=context.sandbox,
+            )
+
+    if need_build_overlay(context.config):
+        (context.workspace / "build-overlay").symlink_to(build)
+
+    return True
+
+
+def want_cache_overlay(context: Context) -> bool:
+    if context.config.cache_overlay == ConfigFeature.disabled:
+        return False
+
+    # Packages that were added since the cache was built are installed into the root directory after which the root
+    # directory is moved into the cache again, which doesn't work if the root directory is an overlayfs mount.
+    if any(cache_package_delta(context.config)):
+        return False
+
+    if context.config.cache_overlay == ConfigFeature.enabled:
+        return True
+
+    final, _, _, _ = cache_tree_paths(context.config)
+
+    # If the cached tree can be snapshotted or reflinked, copying it is cheap enough.
+    return not (
+        (context.config.use_subvolumes != ConfigFeature.disabled and is_subvolume(final)) or
+        can_reflink(final.parent, context.workspace)
+    )
+
+
+def mount_cache_overlay(context: Context, lowerdir: Path) -> None:
+    """
+    Mount the given cached tree read-only as the lower directory of an overlayfs mount on the root directory so that
+    only files that are modified by the rest of the build are copied. The mount stays in place until
+    unmount_cache_overlay() is called.
+    """
+    upperdir = context.workspace / "cache-overlay"
+    workdir = context.workspace / "cache-overlay-workdir"
+
+    upperdir.mkdir(mode=stat.S_IMODE(lowerdir.stat().st_mode))
+    workdir.mkdir()
+
+    OverlayOperation((os.fspath(lowerdir),), os.fspath(upperdir), os.fspath(workdir), os.fspath(context.root)).execute(
+        "/", "/"
+    )
+
+
+def have_cache_overlay(context: Context) -> bool:
+    return (context.workspace / "cache-overlay").exists()
+
+
+def unmount_cache_overlay(context: Context) -> None:
+    if not have_cache_overlay(context):
+        return
+
+    umount2(os.fspath(context.root))
+    rmtree(context.workspace / "cache-overlay", context.workspace / "cache-overlay-workdir", sandbox=context.sandbox)
+
+
+@dataclasses.dataclass(frozen=True)
+class CacheStage:
+    name: str
+    digest: str
+    build: bool
+    step: Callable[[Context], None]
+
+
+def install_base(context: Context) -> None:
+    install_skeleton_trees(context)
+    install_base_system(context)
+
+
+def finalize_cache_stages(config: Config) -> list[CacheStage]:
+    """
+    Split the cached part of the image build into stages. Every stage is identified by a digest of the inputs of
+    the stage chained with the digest of the previous stage so that changing the inputs of a stage only
+    invalidates that stage and the stages that come after it.
+    """
+    manifest = config.cache_manifest()
+    stages: list[CacheStage] = []
+
+    def add(name: str, inputs: Any, step: Callable[[Context], None], *, build: bool = False) -> None:
+        digest = hashlib.sha256(
+            json.dumps(
+                [stages[-1].digest if stages else None, inputs],
+                cls=JsonEncoder,
+                sort_keys=True,
+            ).encode()
+        ).hexdigest()
+
+        stages.append(CacheStage(name=name, digest=digest, build=build, step=step))
+
+    add(
+        "base",
+        {
+            k: v for k, v in manifest.items()
+            if k not in ("packages", "build_packages", "package_directories", "prepare_scripts")
+        },
+        install_base,
+    )
+    add(
+        "packages",
+        {k: manifest[k] for k in ("packages", "package_directories")},
+        install_distribution_packages,
+    )
+
+    for i, script in enumerate(config.prepare_scripts):
+        add(
+            f"prepare-{i}",
+            hashlib.sha256(script.read_bytes()).hexdigest(),
+            functools.partial(run_prepare_scripts, build=False, scripts=[script]),
+        )
+
+    if config.build_scripts:
+        add("build-packages", manifest["build_packages"], install_build_packages, build=True)
+
+        for i, script in enumerate(config.prepare_scripts):
+            add(
+                f"prepare-build-{i}",
+                hashlib.sha256(script.read_bytes()).hexdigest(),
+                functools.partial(run_prepare_scripts, build=True, scripts=[script]),
+                build=True,
+            )
+
+    return stages
+
+
+def cache_stage_path(config: Config, stage: CacheStage) -> Path:
+    _, _, _, stages = cache_tree_paths(config)
+    return stages / f"{stage.name}.{stage.digest}"
+
+
+def restore_cache_stage(context: Context, stages: Sequence[CacheStage]) -> int:
+    """
+    Restore the most recent stage for which a snapshot is available and return the index of the first stage that
+    still has to be executed.
+    """
+    for i in reversed(range(len(stages))):
+        stage = cache_stage_path(context.config, stages[i])
+        if not stage.exists() or stage.stat().st_uid != os.getuid():
+            continue
+
+        # Snapshots of stages that run in the build overlay only store the build overlay, the root directory comes
+        # from the last stage that ran outside of the build overlay.
+        root = next(
+            (cache_stage_path(context.config, s) for s in reversed(stages[:i + 1]) if not s.build),
+            None,
+        )
+        if not root or not (root / "root").exists():
+            continue
+
+        with complete_step(f"Restoring cached {stages[i].name} stage"):
+            rmtree(context.root, sandbox=context.sandbox)
+            copy_tree(
+                root / "root", context.root,
+                use_subvolumes=context.config.use_subvolumes,
+                copy_tool=context.config.copy_tool,
+                sandbox=context.sandbox,
+            )
+
+            if stages[i].build and (stage / "build-overlay").exists():
+                copy_tree(
+                    stage / "build-overlay", context.workspace / "build-overlay",
+                    use_subvolumes=context.config.use_subvolumes,
+                    copy_tool=context.config.copy_tool,
+                    sandbox=context.sandbox,
+                )
+
+        return i + 1
+
+    return 0
+
+
+def save_cache_stage(context: Context, stage: CacheStage) -> None:
+    dst = cache_stage_path(context.config, stage)
+    tmp = dst.with_name(f"{dst.name}.tmp")
+
+    with complete_step(f"Saving snapshot of {stage.name} stage"):
+        rmtree(*dst.parent.glob(f"{stage.name}.*"), sandbox=context.sandbox, background=True)
+
+        with umask(~0o755):
+            tmp.mkdir(parents=True)
+
+        if stage.build:
+            if (context.workspace / "build-overlay").exists():
+                copy_tree(
+                    context.workspace / "build-overlay", tmp / "build-overlay",
+                    use_subvolumes=context.config.use_subvolumes,
+                    copy_tool=context.config.copy_tool,
+                    sandbox=context.sandbox,
+                )
+        else:
+            copy_tree(
+                context.root, tmp / "root",
+                use_subvolumes=context.config.use_subvolumes,
+                copy_tool=context.config.copy_tool,
+                sandbox=context.sandbox,
+            )
+
+        tmp.rename(dst)
+
+
+def run_cache_stages(context: Context) -> None:
+    stages = finalize_cache_stages(context.config)
+
+    if (
+        not context.config.incremental or
+        not context.config.cache_stages or
+        context.config.base_trees or
+        context.config.overlay
+    ):
+        for stage in stages:
+            stage.step(context)
+
+        return
+
+    for stage in stages[restore_cache_stage(context, stages):]:
+        stage.step(context)
+        save_cache_stage(context, stage)
+
+
+def install_cache_delta(context: Context) -> None:
+    packages, build_packages = cache_package_delta(context.config)
+    if not packages and not build_packages:
+        return
+
+    _, build, _, _ = cache_tree_paths(context.config)
+
+    # If the build overlay is a symlink to the cached build overlay, replace it with a copy so that we don't modify
+    # the cached build overlay in place and so that save_cache() can move it into the cache again.
+    if (overlay := context.workspace / "build-overlay").is_symlink():
+        overlay.unlink()
         copy_tree(
-            final, context.root,
+            build, overlay,
             use_subvolumes=context.config.use_subvolumes,
+            copy_tool=context.config.copy_tool,
             sandbox=context.sandbox,
         )
 
-        if need_build_overlay(context.config):
-            (context.workspace / "build-overlay").symlink_to(build)
+    if packages:
+        with complete_step(f"Installing packages added since the cached image was built: {' '.join(packages)}"):
+            context.config.distribution.install_packages(context, packages)
 
-    return True
+    if build_packages and context.config.build_scripts:
+        with (
+            complete_step(
+                f"Installing build packages added since the cached image was built: {' '.join(build_packages)}"
+            ),
+            mount_build_overlay(context),
+        ):
+            context.config.distribution.install_packages(context, build_packages)
+
+    save_cache(context)
+    reuse_cache(context)
 
 
 def save_uki_components(context: Context) -> tuple[Optional[Path], Optional[str], Optional[Path], list[Path]]:
@@ -3526,21 +4100,51 @@ def make_disk(
     return make_image(context, msg=msg, skip=skip, split=split, tabs=tabs, root=context.root, definitions=definitions)
 
 
-def make_oci(context: Context, root_layer: Path, dst: Path) -> None:
+def make_oci_layer(context: Context, root: Path, dst: Path) -> tuple[str, str]:
+    """
+    Write the (compressed) root layer to dst and return the SHA256 digests of the uncompressed and of the compressed
+    layer. The tar stream is hashed and compressed while it is produced so the root directory is only read once and no
+    uncompressed copy of the layer is ever written to disk.
+    """
+    if not (compression := context.config.compress_output):
+        digest = make_tar(root, dst, sandbox=context.sandbox)
+        return digest, digest
+
+    cmd = compressor_command(context, compression)
+
+    with complete_step(f"Creating {compression} compressed OCI layer {dst}…"):
+        r, w = os.pipe2(os.O_CLOEXEC)
+
+        with (
+            dst.open("wb") as o,
+            (blob := HashingTee(o)) as ofd,
+            os.fdopen(w, "wb") as ci,
+        ):
+            try:
+                with spawn(cmd, stdin=r, stdout=ofd, sandbox=context.sandbox(binary=cmd[0])):
+                    # Only the compressor should hold the read end of the pipe, so that tar gets EPIPE instead of
+                    # blocking forever if the compressor fails.
+                    os.close(r)
+                    r = -1
+
+                    # The compressor only sees EOF after the diff tee has flushed everything into the pipe and the
+                    # write end of the pipe is closed, after which spawn() can wait for the compressor to exit.
+                    with ci, (diff := HashingTee(ci)) as tfd:
+                        write_tar(root, tfd, sandbox=context.sandbox)
+            finally:
+                if r >= 0:
+                    os.close(r)
+
+    return diff.hexdigest(), blob.hexdigest()
+
+
+def make_oci(context: Context, root: Path, dst: Path) -> None:
     ca_store = dst / "blobs" / "sha256"
     with umask(~0o755):
         ca_store.mkdir(parents=True)
 
-    layer_diff_digest = hash_file(root_layer)
-    maybe_compress(
-        context,
-        context.config.compress_output,
-        context.staging / "rootfs.layer",
-        # Pass explicit destination to suppress adding an extension
-        context.staging / "rootfs.layer",
-    )
-    layer_digest = hash_file(root_layer)
-    root_layer.rename(ca_store / layer_digest)
+    layer_diff_digest, layer_digest = make_oci_layer(context, root, ca_store / "rootfs.layer")
+    (ca_store / "rootfs.layer").rename(ca_store / layer_digest)
 
     creation_time = (
         datetime.datetime.fromtimestamp(context.config.source_date_epoch, tz=datetime.timezone.utc)
@@ -3731,9 +4335,16 @@ def make_extension_image(context: Context, output: Path) -> None:
 
 
 def finalize_staging(context: Context) -> None:
-    rmtree(*(context.config.output_dir_or_cwd() / f.name for f in context.staging.iterdir()))
+    # Outputs on the same filesystem as the output directory replace the previous outputs atomically. The previous
+    # outputs end up in the staging directory and are removed together with it.
+    staged = [
+        f for f in context.staging.iterdir()
+        if not exchange_tree(f, context.config.output_dir_or_cwd() / f.name)
+    ]
+
+    rmtree(*(context.config.output_dir_or_cwd() / f.name for f in staged), background=True)
 
-    for f in context.staging.iterdir():
+    for f in staged:
         if f.is_symlink():
             (context.config.output_dir_or_cwd() / f.name).symlink_to(f.readlink())
             continue
@@ -3741,30 +4352,48 @@ def finalize_staging(context: Context) -> None:
         move_tree(
             f, context.config.output_dir_or_cwd(),
             use_subvolumes=context.config.use_subvolumes,
+            copy_tool=context.config.copy_tool,
             sandbox=context.sandbox,
         )
 
 
-def clamp_mtime(path: Path, mtime: int) -> None:
-    st = os.stat(path, follow_symlinks=False)
-    orig = (st.st_atime_ns, st.st_mtime_ns)
-    updated = (min(orig[0], mtime * 1_000_000_000),
-               min(orig[1], mtime * 1_000_000_000))
-    if orig != updated:
-        os.utime(path, ns=updated, follow_symlinks=False)
-
+def normalize_mtime(context: Context, directory: Path = Path("")) -> None:
+    if (mtime := context.config.source_date_epoch) is None:
+        return
 
-def normalize_mtime(root: Path, mtime: Optional[int], directory: Path = Path("")) -> None:
-    if mtime is None:
+    if not (context.root / directory).exists():
         return
 
-    if not (root / directory).exists():
+    with complete_step(
+        f"Normalizing modification times of /{directory}",
+        f"Clamped modification times of {{}} entries in /{directory}",
+    ) as clamped:
+        clamped += [clamp_mtime(context.root_index(), mtime * 1_000_000_000, directory)]
+
+
+@contextlib.contextmanager
+def setup_staging(config: Config, workspace: Path) -> Iterator[Optional[Path]]:
+    """
+    Create a hidden staging directory in the output directory if enabled, so that outputs can be moved into place
+    by renaming them even if the workspace is on a different filesystem. Yields None if outputs should be staged in
+    the workspace instead.
+    """
+    output = config.output_dir_or_cwd()
+
+    if config.stage_in_output_dir == ConfigFeature.disabled or (
+        config.stage_in_output_dir == ConfigFeature.auto and output.stat().st_dev == workspace.stat().st_dev
+    ):
+        yield None
         return
 
-    with complete_step(f"Normalizing modification times of /{directory}"):
-        clamp_mtime(root / directory, mtime)
-        for p in (root / directory).rglob("*"):
-            clamp_mtime(p, mtime)
+    staging = Path(tempfile.mkdtemp(dir=output, prefix=".mkosi-staging-"))
+    # Discard setuid/setgid bits as these are inherited and can leak into the outputs.
+    staging.chmod(stat.S_IMODE(staging.stat().st_mode) & ~(stat.S_ISGID|stat.S_ISUID))
+
+    try:
+        yield staging
+    finally:
+        rmtree(staging, sandbox=config.sandbox, background=True)
 
 
 @contextlib.contextmanager
@@ -3773,7 +4402,7 @@ def setup_workspace(args: Args, config: Config) -> Iterator[Path]:
         workspace = Path(tempfile.mkdtemp(dir=config.workspace_dir_or_default(), prefix="mkosi-workspace-"))
         # Discard setuid/setgid bits as these are inherited and can leak into the image.
         workspace.chmod(stat.S_IMODE(workspace.stat().st_mode) & ~(stat.S_ISGID|stat.S_ISUID))
-        stack.callback(lambda: rmtree(workspace, sandbox=config.sandbox))
+        stack.callback(lambda: rmtree(workspace, sandbox=config.sandbox, background=True))
         (workspace / "tmp").mkdir(mode=0o1777)
 
         with scopedenv({"TMPDIR" : os.fspath(workspace / "tmp")}):
@@ -3887,6 +4516,7 @@ def build_image(context: Context) -> None:
             or context.config.volatile_packages
             or context.config.postinst_scripts
             or context.config.finalize_scripts
+            or (cached and any(cache_package_delta(context.config)))
         )
 
         context.config.distribution.setup(context)
@@ -3897,22 +4527,21 @@ def build_image(context: Context) -> None:
                 install_package_directories(context, [context.package_dir])
 
         if not cached:
-            install_skeleton_trees(context)
-            install_distribution(context)
-            run_prepare_scripts(context, build=False)
-            install_build_packages(context)
-            run_prepare_scripts(context, build=True)
+            run_cache_stages(context)
             fixup_vmlinuz_location(context)
             run_depmod(context, cache=True)
 
             save_cache(context)
             reuse_cache(context)
+        else:
+            install_cache_delta(context)
 
         check_root_populated(context)
         run_build_scripts(context)
 
         if context.config.output_format == OutputFormat.none:
             finalize_staging(context)
+            unmount_cache_overlay(context)
             rmtree(context.root)
             return
 
@@ -3956,11 +4585,14 @@ def build_image(context: Context) -> None:
         run_selinux_relabel(context)
         run_finalize_scripts(context)
 
-    normalize_mtime(context.root, context.config.source_date_epoch)
+    normalize_mtime(context)
     partitions = make_disk(context, skip=("esp", "xbootldr"), tabs=True, msg="Generating disk image")
     install_kernel(context, partitions)
-    normalize_mtime(context.root, context.config.source_date_epoch, directory=Path("boot"))
-    normalize_mtime(context.root, context.config.source_date_epoch, directory=Path("efi"))
+    if context.index is not None:
+        # systemd-repart writes the fstab and crypttab and install_kernel() populates /boot and /efi.
+        context.index.update(Path("etc/fstab"), Path("etc/crypttab"), Path("boot"), Path("efi"))
+    normalize_mtime(context, directory=Path("boot"))
+    normalize_mtime(context, directory=Path("efi"))
     partitions = make_disk(context, msg="Formatting ESP/XBOOTLDR partitions")
     grub_bios_setup(context, partitions)
 
@@ -3973,16 +4605,21 @@ def build_image(context: Context) -> None:
     copy_initrd(context)
 
     if context.config.output_format == OutputFormat.tar:
-        make_tar(context.root, context.staging / context.config.output_with_format, sandbox=context.sandbox)
-    elif context.config.output_format == OutputFormat.oci:
-        make_tar(context.root, context.staging / "rootfs.layer", sandbox=context.sandbox)
-        make_oci(
-            context,
-            context.staging / "rootfs.layer",
+        context.record_digest(
             context.staging / context.config.output_with_format,
+            make_tar(context.root, context.staging / context.config.output_with_format, sandbox=context.sandbox),
         )
+    elif context.config.output_format == OutputFormat.oci:
+        make_oci(context, context.root, context.staging / context.config.output_with_format)
     elif context.config.output_format == OutputFormat.cpio:
-        make_cpio(context.root, context.staging / context.config.output_with_format, sandbox=context.sandbox)
+        context.record_digest(
+            context.staging / context.config.output_with_format,
+            make_cpio(
+                context.root,
+                context.staging / context.config.output_with_format,
+                index=context.root_index(),
+            ),
+        )
     elif context.config.output_format == OutputFormat.uki:
         assert stub and kver and kimg
         make_uki(context, stub, kver, kimg, microcode, context.staging / context.config.output_with_format)
@@ -3993,7 +4630,16 @@ def build_image(context: Context) -> None:
     elif context.config.output_format.is_extension_image():
         make_extension_image(context, context.staging / context.config.output_with_format)
     elif context.config.output_format == OutputFormat.directory:
-        context.root.rename(context.staging / context.config.output_with_format)
+        if have_cache_overlay(context):
+            copy_tree(
+                context.root, context.staging / context.config.output_with_format,
+                use_subvolumes=context.config.use_subvolumes,
+                copy_tool=context.config.copy_tool,
+                sandbox=context.sandbox,
+            )
+            unmount_cache_overlay(context)
+        else:
+            context.root.rename(context.staging / context.config.output_with_format)
 
     if context.config.output_format not in (OutputFormat.uki, OutputFormat.esp):
         maybe_compress(context, context.config.compress_output,
@@ -4011,9 +4657,14 @@ def build_image(context: Context) -> None:
 
     run_postoutput_scripts(context)
     finalize_staging(context)
+    unmount_cache_overlay(context)
     rmtree(context.root)
 
-    print_output_size(context.config.output_dir_or_cwd() / context.config.output_with_compression)
+    print_output_size(
+        context.config.output_dir_or_cwd() / context.config.output_with_compression,
+        # Post-output scripts can modify the output so we can only use the index if there weren't any.
+        index=context.index if not context.config.postoutput_scripts else None,
+    )
 
 
 def run_shell(args: Args, config: Config) -> None:
@@ -4494,6 +5145,17 @@ def needs_build(args: Args, config: Config, force: int = 1) -> bool:
     )
 
 
+# Caches derived from the image inputs that are stored directly in the cache directory and are not tied to a
+# specific image.
+DERIVED_CACHE_PATTERNS = (
+    "modinfo-*.json",
+    "kernel-modules-*.initrd",
+    "default-initrd-*.initrd",
+    "default-initrd-*.lock",
+    "microcode-*.initrd",
+)
+
+
 def run_clean(args: Args, config: Config, *, resources: Path) -> None:
     # We remove any cached images if either the user used --force twice, or he/she called "clean" with it
     # passed once. Let's also remove the downloaded package cache if the user specified one additional
@@ -4546,9 +5208,15 @@ def run_clean(args: Args, config: Config, *, resources: Path) -> None:
             else []
         )
 
-        if any(p.exists() for p in itertools.chain(cache_tree_paths(config), initrd)):
+        derived = [p for pattern in DERIVED_CACHE_PATTERNS for p in config.cache_dir.glob(pattern)]
+
+        if any(p.exists() for p in itertools.chain(cache_tree_paths(config), initrd)) or derived:
             with complete_step(f"Removing cache entries of {config.name()} image…"):
-                rmtree(*(p for p in itertools.chain(cache_tree_paths(config), initrd) if p.exists()), sandbox=sandbox)
+                rmtree(
+                    *(p for p in itertools.chain(cache_tree_paths(config), initrd) if p.exists()),
+                    *derived,
+                    sandbox=sandbox,
+                )
 
     if remove_package_cache and any(config.package_cache_dir_or_default().glob("*")):
         subdir = config.distribution.package_manager(config).subdir(config)
@@ -4565,13 +5233,24 @@ def run_clean(args: Args, config: Config, *, resources: Path) -> None:
                 sandbox=sandbox,
             )
 
+    # Remove anything that was left behind in the trash by builds whose background removal didn't finish. Old cache
+    # stage snapshots are trashed in the stages directory itself so that has to be checked as well.
+    stages = cache_tree_paths(config)[3] if config.cache_dir else None
+    for d in (config.output_dir_or_cwd(), config.workspace_dir_or_default(), config.cache_dir, stages):
+        if d and is_trash_directory(trash := d / TRASH_DIRECTORY) and any(trash.iterdir()):
+            with complete_step(f"Emptying {trash}…"):
+                rmtree(*trash.iterdir(), sandbox=sandbox)
+
     run_clean_scripts(config)
 
 
 def sync_repository_metadata(context: Context) -> None:
     if (
         context.config.cacheonly != Cacheonly.never and
-        (have_cache(context.config) or context.config.cacheonly != Cacheonly.auto)
+        (
+            (have_cache(context.config) and not any(cache_package_delta(context.config))) or
+            context.config.cacheonly != Cacheonly.auto
+        )
     ):
         return
 
@@ -4644,6 +5323,14 @@ def run_build(
 
         p.mkdir(parents=True, exist_ok=True)
 
+    # Remove anything that earlier builds left behind in the trash, including old cache stage snapshots which are
+    # trashed in the stages directory.
+    empty_trash(
+        config.output_dir_or_cwd(),
+        config.workspace_dir_or_default(),
+        *([config.cache_dir, cache_tree_paths(config)[3]] if config.cache_dir else []),
+    )
+
     if config.build_dir:
         # Discard setuid/setgid bits as these are inherited and can leak into the image.
         config.build_dir.chmod(stat.S_IMODE(config.build_dir.stat().st_mode) & ~(stat.S_ISGID|stat.S_ISUID))
@@ -4669,17 +5356,63 @@ def run_build(
     with (
         complete_step(f"Building {config.name()} image"),
         setup_workspace(args, config) as workspace,
+        setup_staging(config, workspace) as staging,
     ):
-        build_image(
-            Context(
-                args,
-                config,
-                workspace=workspace,
-                resources=resources,
-                metadata_dir=metadata_dir,
-                package_dir=package_dir,
-            )
+        context = Context(
+            args,
+            config,
+            workspace=workspace,
+            resources=resources,
+            metadata_dir=metadata_dir,
+            package_dir=package_dir,
+            staging=staging,
+        )
+
+        if args.trace:
+            start_profiling()
+
+        PROCESS_STATS.clear()
+
+        try:
+            build_image(context)
+        finally:
+            unmount_cache_overlay(context)
+
+            if args.trace:
+                save_trace(args.trace, stop_profiling())
+
+            if args.stats:
+                show_process_stats(args, config)
+
+
+def show_process_stats(args: Args, config: Config) -> None:
+    if args.json:
+        print(
+            json.dumps(
+                {
+                    "Image": config.name(),
+                    "Processes": {binary: stats.to_dict() for binary, stats in PROCESS_STATS.items()},
+                },
+                indent=4,
+                sort_keys=True,
+            ),
+            flush=True,
         )
+    else:
+        logging.info(f"Programs executed while building {config.name()} image:\n{format_process_stats(PROCESS_STATS)}")
+
+
+def save_trace(path: Path, events: list[dict[str, Any]]) -> None:
+    # Multiple images might be built at the same time so make sure we don't lose any events of other images.
+    with flock(path.parent):
+        if path.exists():
+            previous = json.loads(path.read_text())["traceEvents"]
+        else:
+            previous = []
+
+        path.write_text(json.dumps({"traceEvents": [*previous, *events]}, indent=4))
+
+    logging.info(f"Build step profile (full trace written to {path}):\n{profile_summary(events)}")
 
 
 def run_verb(args: Args, images: Sequence[Config], *, resources: Path) -> None:
@@ -4759,6 +5492,9 @@ def run_verb(args: Args, images: Sequence[Config], *, resources: Path) -> None:
 
     assert args.verb.needs_build()
 
+    if args.trace:
+        args.trace.unlink(missing_ok=True)
+
     if (
         tools and
         not (tools.output_dir_or_cwd() / tools.output).exists() and
@@ -4838,9 +5574,14 @@ def run_verb(args: Args, images: Sequence[Config], *, resources: Path) -> None:
             run_sync(args, last, resources=resources)
             copy_repository_metadata(last, Path(metadata_dir))
 
-            for config in images:
-                # If the output format is "none" and there are no build scripts, there's nothing to do so exit early.
-                if config.output_format == OutputFormat.none and not config.build_scripts:
+            # If the output format is "none" and there are no build scripts, there's nothing to do so skip the image.
+            skip = {
+                i for i, config in enumerate(images)
+                if config.output_format == OutputFormat.none and not config.build_scripts
+            }
+
+            for i, config in enumerate(images):
+                if i in skip:
                     continue
 
                 with prepend_to_environ_path(config):
@@ -4848,8 +5589,15 @@ def run_verb(args: Args, images: Sequence[Config], *, resources: Path) -> None:
                         check_tools(config, Verb.build)
 
                     check_inputs(config)
-                    fork_and_wait(
-                        run_build,
+
+            def build(i: int) -> None:
+                if i in skip:
+                    return
+
+                config = images[i]
+
+                with prepend_to_environ_path(config):
+                    run_build(
                         args,
                         config,
                         resources=resources,
@@ -4857,6 +5605,17 @@ def run_verb(args: Args, images: Sequence[Config], *, resources: Path) -> None:
                         package_dir=Path(package_dir),
                     )
 
+            names = {config.image: i for i, config in enumerate(images)}
+
+            fork_and_wait_graph(
+                build,
+                {
+                    i: [names[d] for d in config.dependencies if d in names]
+                    for i, config in enumerate(images)
+                },
+                jobs=last.build_jobs,
+            )
+
             if args.auto_bump:
                 bump_image_version()
 
@@ -1,15 +1,22 @@
 # SPDX-License-Identifier: LGPL-2.1-or-later
 
+import dataclasses
+import errno
+import hashlib
+import io
 import os
+import stat
+import subprocess
 from collections.abc import Iterable, Sequence
 from pathlib import Path
-from typing import Optional
+from typing import Callable, Optional
 
-from mkosi.log import log_step
-from mkosi.run import SandboxProtocol, finalize_passwd_mounts, nosandbox, run
+from mkosi.log import die, log_step
+from mkosi.run import SandboxProtocol, finalize_passwd_mounts, nosandbox, run, spawn
 from mkosi.sandbox import umask
+from mkosi.tree import TreeIndex
 from mkosi.types import PathString
-from mkosi.util import chdir
+from mkosi.util import HashingTee
 
 
 def tar_exclude_apivfs_tmp() -> list[str]:
@@ -23,34 +30,42 @@ def tar_exclude_apivfs_tmp() -> list[str]:
     ]
 
 
-def make_tar(src: Path, dst: Path, *, sandbox: SandboxProtocol = nosandbox) -> None:
+def make_tar(src: Path, dst: Path, *, sandbox: SandboxProtocol = nosandbox) -> str:
+    """Create a tar archive of src at dst and return the SHA256 digest of the archive."""
     log_step(f"Creating tar archive {dst}…")
 
-    with dst.open("wb") as f:
-        run(
-            [
-                "tar",
-                "--create",
-                "--file", "-",
-                "--directory", src,
-                "--acls",
-                "--selinux",
-                # --xattrs implies --format=pax
-                "--xattrs",
-                # PAX format emits additional headers for atime, ctime and mtime
-                # that would make the archive non-reproducible.
-                "--pax-option=delete=atime,delete=ctime,delete=mtime",
-                "--sparse",
-                "--force-local",
-                *(["--owner=root:0"] if os.getuid() != 0 else []),
-                *(["--group=root:0"] if os.getuid() != 0 else []),
-                *tar_exclude_apivfs_tmp(),
-                ".",
-            ],
-            stdout=f,
-            # Make sure tar uses user/group information from the root directory instead of the host.
-            sandbox=sandbox(binary="tar", options=["--ro-bind", src, src, *finalize_passwd_mounts(src)]),
-        )
+    with dst.open("wb") as f, (tee := HashingTee(f)) as fd:
+        write_tar(src, fd, sandbox=sandbox)
+
+    return tee.hexdigest()
+
+
+def write_tar(src: Path, fd: int, *, sandbox: SandboxProtocol = nosandbox) -> None:
+    """Write a tar archive of src to the given file descriptor."""
+    run(
+        [
+            "tar",
+            "--create",
+            "--file", "-",
+            "--directory", src,
+            "--acls",
+            "--selinux",
+            # --xattrs implies --format=pax
+            "--xattrs",
+            # PAX format emits additional headers for atime, ctime and mtime
+            # that would make the archive non-reproducible.
+            "--pax-option=delete=atime,delete=ctime,delete=mtime",
+            "--sparse",
+            "--force-local",
+            *(["--owner=root:0"] if os.getuid() != 0 else []),
+            *(["--group=root:0"] if os.getuid() != 0 else []),
+            *tar_exclude_apivfs_tmp(),
+            ".",
+        ],
+        stdout=fd,
+        # Make sure tar uses user/group information from the root directory instead of the host.
+        sandbox=sandbox(binary="tar", options=["--ro-bind", src, src, *finalize_passwd_mounts(src)]),
+    )
 
 
 def can_extract_tar(src: Path) -> bool:
@@ -97,35 +112,236 @@ def extract_tar(
     )
 
 
-def make_cpio(
+# The newc format stores a 110 byte header followed by the NUL terminated name of the entry and the entry's data,
+# both padded to a multiple of 4 bytes.
+CPIO_NEWC_MAGIC = b"070701"
+CPIO_TRAILER = b"TRAILER!!!"
+# GNU cpio pads the archive to a multiple of its default block size and we want to produce identical archives.
+CPIO_BLOCK_SIZE = 512
+CPIO_ZEROES = bytes(1024**2)
+
+
+@dataclasses.dataclass
+class CpioEntry:
+    path: Path
+    name: bytes
+    st: os.stat_result
+    ino: int
+
+    @property
+    def key(self) -> tuple[int, int]:
+        return (self.st.st_dev, self.st.st_ino)
+
+
+class CpioWriter:
+    """
+    Writes a reproducible newc cpio archive that is byte for byte identical to the one written by GNU cpio with
+    --reproducible --renumber-inodes --format=newc (and --owner=0:0 when running unprivileged). Just like GNU cpio,
+    the entries of hardlinked regular files are deferred until the last link is encountered, after which all links
+    are written with only the last one carrying the file's data.
+    """
+
+    def __init__(self, src: Path, write: Callable[[bytes], object]) -> None:
+        self.src = src
+        self.write = write
+        self.offset = 0
+        self.inodes: dict[tuple[int, int], int] = {}
+        self.next_inode = 0
+        # Deferred hardlinks, most recently deferred first.
+        self.deferred: list[CpioEntry] = []
+        self.unprivileged = os.getuid() != 0
+
+    def output(self, b: bytes) -> None:
+        self.write(b)
+        self.offset += len(b)
+
+    def pad(self, alignment: int) -> None:
+        if n := -self.offset % alignment:
+            self.output(CPIO_ZEROES[:n])
+
+    def header(self, entry: CpioEntry, filesize: int) -> None:
+        st = entry.st
+        fields = (
+            entry.ino,
+            st.st_mode,
+            0 if self.unprivileged else st.st_uid,
+            0 if self.unprivileged else st.st_gid,
+            # --reproducible implies --ignore-dirnlink.
+            2 if stat.S_ISDIR(st.st_mode) else st.st_nlink,
+            max(int(st.st_mtime), 0),
+            filesize,
+            # --reproducible implies --ignore-devno.
+            0,
+            0,
+            os.major(st.st_rdev),
+            os.minor(st.st_rdev),
+            len(entry.name) + 1,
+            0,
+        )
+
+        self.record(fields, entry.name)
+
+    def record(self, fields: Sequence[int], name: bytes) -> None:
+        self.output(CPIO_NEWC_MAGIC + b"".join(b"%08X" % (f & 0xFFFFFFFF) for f in fields) + name + b"\0")
+        self.pad(4)
+
+    def data(self, entry: CpioEntry) -> None:
+        size = entry.st.st_size
+        fd = os.open(self.src / entry.path, os.O_RDONLY|os.O_CLOEXEC|os.O_NOFOLLOW)
+
+        try:
+            offset = 0
+            while offset < size:
+                # Skip over holes in sparse files instead of reading them.
+                try:
+                    start = os.lseek(fd, offset, os.SEEK_DATA)
+                    end = os.lseek(fd, start, os.SEEK_HOLE)
+                except OSError as e:
+                    if e.errno == errno.ENXIO:
+                        start = end = size
+                    elif e.errno == errno.EINVAL:
+                        start, end = offset, size
+                    else:
+                        raise e
+
+                start, end = min(start, size), min(end, size)
+
+                while offset < start:
+                    self.output(CPIO_ZEROES[:min(start - offset, len(CPIO_ZEROES))])
+                    offset = min(start, offset + len(CPIO_ZEROES))
+
+                os.lseek(fd, offset, os.SEEK_SET)
+                while offset < end:
+                    if not (b := os.read(fd, min(end - offset, len(CPIO_ZEROES)))):
+                        die(f"{self.src / entry.path} shrunk while it was being archived")
+                    self.output(b)
+                    offset += len(b)
+        finally:
+            os.close(fd)
+
+        self.pad(4)
+
+    def entry(self, entry: CpioEntry) -> None:
+        mode = stat.S_IFMT(entry.st.st_mode)
+
+        if mode == stat.S_IFREG:
+            self.header(entry, entry.st.st_size)
+            self.data(entry)
+        elif mode == stat.S_IFLNK:
+            target = os.fsencode(os.readlink(self.src / entry.path))
+            self.header(entry, len(target))
+            self.output(target)
+            self.pad(4)
+        else:
+            self.header(entry, 0)
+
+    def add(self, path: Path, st: Optional[os.stat_result] = None) -> None:
+        st = st or os.lstat(self.src / path)
+
+        # Mimick GNU cpio's renumbering: every file gets the next inode number except for additional links to an
+        # inode we've already seen.
+        key = (st.st_dev, st.st_ino)
+        if st.st_nlink > 1:
+            if (ino := self.inodes.get(key)) is None:
+                ino = self.inodes[key] = self.next_inode
+                self.next_inode += 1
+        else:
+            ino = self.next_inode
+            self.next_inode += 1
+
+        name = os.fsencode(path)
+        if name.startswith(b"./"):
+            name = name[2:]
+
+        entry = CpioEntry(path=path, name=name, st=st, ino=ino)
+
+        if not stat.S_ISREG(st.st_mode) or st.st_nlink == 1:
+            self.entry(entry)
+            return
+
+        links = [d for d in self.deferred if d.key == key]
+        if len(links) + 1 < st.st_nlink:
+            self.deferred.insert(0, entry)
+            return
+
+        for d in links:
+            self.header(d, 0)
+            self.deferred.remove(d)
+
+        self.entry(entry)
+
+    def finish(self) -> None:
+        # Write out hardlinks of which not all links were part of the archive.
+        while self.deferred:
+            d = self.deferred.pop(0)
+            if any(o.key == d.key for o in self.deferred):
+                self.header(d, 0)
+            else:
+                self.entry(d)
+
+        # The trailer is an empty entry with a link count of one.
+        self.record((0, 0, 0, 0, 1, 0, 0, 0, 0, 0, 0, len(CPIO_TRAILER) + 1, 0), CPIO_TRAILER)
+        self.pad(CPIO_BLOCK_SIZE)
+
+
+def write_cpio(
     src: Path,
-    dst: Path,
+    write: Callable[[bytes], object],
     *,
     files: Optional[Iterable[Path]] = None,
-    sandbox: SandboxProtocol = nosandbox,
+    index: Optional[TreeIndex] = None,
 ) -> None:
-    if not files:
-        with chdir(src):
-            files = sorted(Path(".").rglob("*"))
-    else:
+    """
+    Write a reproducible newc cpio archive of src to the given write callback. If an index of src is given, the files
+    and their metadata are taken from the index instead of walking src.
+    """
+    if files:
         files = sorted(files)
+    else:
+        index = index or TreeIndex.scan(src)
+        files = index.paths()
+
+    writer = CpioWriter(src, write)
+    for p in files:
+        writer.add(p, index[p] if index and p in index else None)
+    writer.finish()
+
 
+def make_cpio(
+    src: Path,
+    dst: Path,
+    *,
+    files: Optional[Iterable[Path]] = None,
+    index: Optional[TreeIndex] = None,
+    compressor: Sequence[PathString] = (),
+    sandbox: SandboxProtocol = nosandbox,
+) -> str:
+    """
+    Create a cpio archive of src at dst and return the SHA256 digest of dst. If a compressor command is given, the
+    archive is streamed through it.
+    """
     log_step(f"Creating cpio archive {dst}…")
 
-    with dst.open("wb") as f:
-        run(
-            [
-                "cpio",
-                "--create",
-                "--reproducible",
-                "--renumber-inodes",
-                "--null",
-                "--format=newc",
-                "--quiet",
-                "--directory", src,
-                *(["--owner=0:0"] if os.getuid() != 0 else []),
-            ],
-            input="\0".join(os.fspath(f) for f in files),
-            stdout=f,
-            sandbox=sandbox(binary="cpio", options=["--ro-bind", src, src, *finalize_passwd_mounts(src)]),
-        )
+    if not compressor:
+        h = hashlib.sha256()
+
+        with dst.open("wb") as f:
+            def write(b: bytes) -> None:
+                h.update(b)
+                f.write(b)
+
+            write_cpio(src, write, files=files, index=index)
+
+        return h.hexdigest()
+
+    with (
+        dst.open("wb") as f,
+        (tee := HashingTee(f)) as fd,
+        spawn(compressor, stdin=subprocess.PIPE, stdout=fd, sandbox=sandbox(binary=compressor[0])) as proc,
+    ):
+        # spawn() always opens the pipes in text mode, so write the archive to the underlying binary buffer.
+        assert isinstance(proc.stdin, io.TextIOWrapper)
+        write_cpio(src, proc.stdin.buffer.write, files=files, index=index)
+        proc.stdin.close()
+
+    return tee.hexdigest()
@@ -293,6 +293,11 @@ class Vmm(StrEnum):
     vmspawn = enum.auto()
 
 
+class CopyTool(StrEnum):
+    native = enum.auto()
+    cp     = enum.auto()
+
+
 class Architecture(StrEnum):
     alpha       = enum.auto()
     arc         = enum.auto()
@@ -1105,6 +1110,21 @@ def config_parse_sector_size(value: Optional[str], old: Optional[int]) -> Option
     return size
 
 
+def config_parse_build_jobs(value: Optional[str], old: Optional[int]) -> Optional[int]:
+    if not value:
+        return None
+
+    try:
+        jobs = int(value)
+    except ValueError:
+        die(f"'{value}' is not a valid number")
+
+    if jobs < 1:
+        die(f"Number of build jobs must be at least 1: {jobs}")
+
+    return jobs
+
+
 def config_parse_vsock_cid(value: Optional[str], old: Optional[int]) -> Optional[int]:
     if not value:
         return None
@@ -1335,6 +1355,8 @@ class Args:
     doc_format: DocFormat
     json: bool
     wipe_build_dir: bool
+    trace: Optional[Path]
+    stats: bool
 
     @classmethod
     def default(cls) -> "Args":
@@ -1435,6 +1457,7 @@ class Config:
     compress_level: int
     output_dir: Optional[Path]
     workspace_dir: Optional[Path]
+    stage_in_output_dir: ConfigFeature
     cache_dir: Optional[Path]
     package_cache_dir: Optional[Path]
     build_dir: Optional[Path]
@@ -1446,6 +1469,7 @@ class Config:
     repart_offline: bool
     overlay: bool
     use_subvolumes: ConfigFeature
+    copy_tool: CopyTool
     seed: uuid.UUID
 
     packages: list[str]
@@ -1534,6 +1558,9 @@ class Config:
     proxy_client_certificate: Optional[Path]
     proxy_client_key: Optional[Path]
     incremental: bool
+    cache_stages: bool
+    cache_overlay: ConfigFeature
+    build_jobs: int
     nspawn_settings: Optional[Path]
     extra_search_paths: list[Path]
     ephemeral: bool
@@ -2096,6 +2123,16 @@ SETTINGS = (
         help="Workspace directory",
         scope=SettingScope.universal,
     ),
+    ConfigSetting(
+        dest="stage_in_output_dir",
+        name="StageInOutputDirectory",
+        metavar="FEATURE",
+        nargs="?",
+        section="Output",
+        parse=config_parse_feature,
+        help="Write outputs to a hidden directory in the output directory while building",
+        scope=SettingScope.universal,
+    ),
     ConfigSetting(
         dest="cache_dir",
         metavar="PATH",
@@ -2193,6 +2230,15 @@ SETTINGS = (
         help="Use btrfs subvolumes for faster directory operations where possible",
         scope=SettingScope.universal,
     ),
+    ConfigSetting(
+        dest="copy_tool",
+        section="Output",
+        parse=config_make_enum_parser(CopyTool),
+        default=CopyTool.cp,
+        choices=CopyTool.choices(),
+        help="Tool to use for copying directory trees",
+        scope=SettingScope.universal,
+    ),
     ConfigSetting(
         dest="seed",
         metavar="UUID",
@@ -2842,6 +2888,35 @@ SETTINGS = (
         help="Make use of and generate intermediary cache images",
         scope=SettingScope.universal,
     ),
+    ConfigSetting(
+        dest="cache_stages",
+        metavar="BOOL",
+        nargs="?",
+        section="Host",
+        parse=config_parse_boolean,
+        help="Save a snapshot of the image after every stage of the cached part of the build",
+        scope=SettingScope.universal,
+    ),
+    ConfigSetting(
+        dest="cache_overlay",
+        metavar="FEATURE",
+        nargs="?",
+        section="Host",
+        parse=config_parse_feature,
+        help="Mount cached images with overlayfs instead of copying them",
+        scope=SettingScope.universal,
+    ),
+    ConfigSetting(
+        dest="build_jobs",
+        long="--jobs",
+        short="-j",
+        metavar="JOBS",
+        section="Host",
+        parse=config_parse_build_jobs,
+        default=1,
+        help="Number of images to build in parallel",
+        scope=SettingScope.universal,
+    ),
     ConfigSetting(
         dest="nspawn_settings",
         name="NSpawnSettings",
@@ -3300,7 +3375,7 @@ def create_argument_parser(chdir: bool = True) -> argparse.ArgumentParser:
     )
     parser.add_argument(
         "--json",
-        help="Show summary as JSON",
+        help="Show summary and statistics as JSON",
         action="store_true",
         default=False,
     )
@@ -3310,6 +3385,19 @@ def create_argument_parser(chdir: bool = True) -> argparse.ArgumentParser:
         action="store_true",
         default=False,
     )
+    parser.add_argument(
+        "--trace",
+        metavar="PATH",
+        help="Write a Chrome trace of the duration and resource usage of every build step to the given path",
+        type=make_path_parser(required=False),
+        default=None,
+    )
+    parser.add_argument(
+        "--stats",
+        help="Show the resource usage of the programs executed during the build",
+        action="store_true",
+        default=False,
+    )
     # These can be removed once mkosi v15 is available in LTS distros and compatibility with <= v14
     # is no longer needed in build infrastructure (e.g.: OBS).
     parser.add_argument(
@@ -4141,6 +4229,7 @@ def summary(config: Config) -> str:
                   Compression Level: {config.compress_level}
                    Output Directory: {config.output_dir_or_cwd()}
                 Workspace Directory: {config.workspace_dir_or_default()}
+          Stage In Output Directory: {config.stage_in_output_dir}
                     Cache Directory: {none_to_none(config.cache_dir)}
             Package Cache Directory: {none_to_default(config.package_cache_dir)}
                     Build Directory: {none_to_none(config.build_dir)}
@@ -4152,6 +4241,7 @@ def summary(config: Config) -> str:
                      Repart Offline: {yes_no(config.repart_offline)}
                             Overlay: {yes_no(config.overlay)}
                      Use Subvolumes: {config.use_subvolumes}
+                          Copy Tool: {config.copy_tool}
                                Seed: {none_to_random(config.seed)}
                       Clean Scripts: {line_join_list(config.clean_scripts)}
 
@@ -4250,6 +4340,9 @@ def summary(config: Config) -> str:
            Proxy Client Certificate: {none_to_none(config.proxy_client_certificate)}
                    Proxy Client Key: {none_to_none(config.proxy_client_key)}
                         Incremental: {yes_no(config.incremental)}
+                       Cache Stages: {yes_no(config.cache_stages)}
+                      Cache Overlay: {config.cache_overlay}
+                         Build Jobs: {config.build_jobs}
                     NSpawn Settings: {none_to_none(config.nspawn_settings)}
                  Extra Search Paths: {line_join_list(config.extra_search_paths)}
                           Ephemeral: {config.ephemeral}
@@ -4419,6 +4512,7 @@ def json_type_transformer(refcls: Union[type[Args], type[Config]]) -> Callable[[
         Network: enum_transformer,
         KeySource: key_source_transformer,
         Vmm: enum_transformer,
+        CopyTool: enum_transformer,
     }
 
     def json_transformer(key: str, val: Any) -> Any:
@@ -6,6 +6,7 @@ from pathlib import Path
 from typing import Optional
 
 from mkosi.config import Args, Config
+from mkosi.tree import TreeIndex
 from mkosi.types import PathString
 
 
@@ -21,6 +22,7 @@ class Context:
         resources: Path,
         metadata_dir: Path,
         package_dir: Optional[Path] = None,
+        staging: Optional[Path] = None,
     ) -> None:
         self.args = args
         self.config = config
@@ -28,9 +30,16 @@ class Context:
         self.resources = resources
         self.metadata_dir = metadata_dir
         self.package_dir = package_dir or (self.workspace / "packages")
+        self.staging = staging or (self.workspace / "staging")
+        # SHA256 digests of the outputs we wrote ourselves, keyed by device and inode number so that they stay valid
+        # when the outputs are renamed.
+        self.digests: dict[tuple[int, int], tuple[int, int, str]] = {}
+        # Index of the root directory shared by the steps that post-process it. Steps that modify the root keep it up
+        # to date and steps that can modify the root arbitrarily (e.g. by running scripts) drop it.
+        self.index: Optional[TreeIndex] = None
 
         self.package_dir.mkdir(exist_ok=True)
-        self.staging.mkdir()
+        self.staging.mkdir(exist_ok=True)
         self.pkgmngr.mkdir()
         self.repository.mkdir()
         self.artifacts.mkdir()
@@ -40,10 +49,6 @@ class Context:
     def root(self) -> Path:
         return self.workspace / "root"
 
-    @property
-    def staging(self) -> Path:
-        return self.workspace / "staging"
-
     @property
     def pkgmngr(self) -> Path:
         return self.workspace / "pkgmngr"
@@ -60,6 +65,25 @@ class Context:
     def install_dir(self) -> Path:
         return self.workspace / "dest"
 
+    def root_index(self) -> TreeIndex:
+        if self.index is None:
+            self.index = TreeIndex.scan(self.root)
+
+        return self.index
+
+    def record_digest(self, path: Path, digest: str) -> None:
+        st = path.stat()
+        self.digests[(st.st_dev, st.st_ino)] = (st.st_size, st.st_mtime_ns, digest)
+
+    def recorded_digest(self, path: Path) -> Optional[str]:
+        """Return the digest recorded for path, unless the file was modified after its digest was recorded."""
+        st = path.stat()
+        size, mtime, digest = self.digests.get((st.st_dev, st.st_ino), (-1, -1, ""))
+        if (size, mtime) != (st.st_size, st.st_mtime_ns):
+            return None
+
+        return digest
+
     def sandbox(
         self,
         *,
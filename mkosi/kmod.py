@@ -1,16 +1,28 @@
 # SPDX-License-Identifier: LGPL-2.1-or-later
 
+import bisect
+import concurrent.futures
+import dataclasses
+import functools
+import gzip
 import itertools
+import json
 import logging
+import lzma
 import os
 import re
+import struct
 import subprocess
-from collections.abc import Iterable, Iterator
+import tempfile
+from collections.abc import Iterable, Iterator, Mapping, Sequence
 from pathlib import Path
+from typing import Any, Optional, cast
 
 from mkosi.log import complete_step, log_step
 from mkosi.run import chroot_cmd, run
-from mkosi.util import chdir, parents_below
+from mkosi.util import evict_cache_entries, parents_below
+
+FIRMWARED = Path("usr/lib/firmware")
 
 
 def loaded_modules() -> list[str]:
@@ -18,30 +30,53 @@ def loaded_modules() -> list[str]:
     return [fr"/{line.split()[0].replace('_', '[_-]')}\.ko" for line in Path("/proc/modules").read_text().splitlines()]
 
 
-def filter_kernel_modules(root: Path, kver: str, *, include: Iterable[str], exclude: Iterable[str]) -> list[Path]:
-    modulesd = Path("usr/lib/modules") / kver
-    with chdir(root):
-        modules = set(modulesd.rglob("*.ko*"))
+class FirmwareIndex:
+    """
+    Index of the firmware directory of an image. Kernel modules reference firmware by a path prefix, so resolving a
+    reference means listing the directory it's located in. Directory listings are cached and kept sorted so that
+    every lookup is a binary search instead of a rescan of the firmware directory.
+    """
 
-    keep = set()
-    if include:
-        regex = re.compile("|".join(include))
-        for m in modules:
-            rel = os.fspath(Path(*m.parts[1:]))
-            if regex.search(rel):
-                keep.add(rel)
+    def __init__(self, root: Path) -> None:
+        self.root = root
+        self.listings: dict[str, list[str]] = {}
 
-    if exclude:
-        remove = set()
-        regex = re.compile("|".join(exclude))
-        for m in modules:
-            rel = os.fspath(Path(*m.parts[1:]))
-            if rel not in keep and regex.search(rel):
-                remove.add(m)
+    def listing(self, directory: str) -> list[str]:
+        if (names := self.listings.get(directory)) is None:
+            try:
+                names = sorted(os.listdir(self.root / FIRMWARED / directory))
+            except (FileNotFoundError, NotADirectoryError):
+                names = []
+
+            self.listings[directory] = names
+
+        return names
+
+    def glob(self, reference: str) -> list[Path]:
+        """Equivalent to Path("usr/lib/firmware").glob(f"{reference}*") relative to the root directory."""
+        directory, _, prefix = reference.rpartition("/")
+        names = self.listing(directory)
+
+        matches = []
+        for name in itertools.islice(names, bisect.bisect_left(names, prefix), None):
+            if not name.startswith(prefix):
+                break
 
-        modules -= remove
+            matches += [FIRMWARED / directory / name]
 
-    return sorted(modules)
+        return matches
+
+    def walk(self) -> list[Path]:
+        """Equivalent to Path("usr/lib/firmware").rglob("*") relative to the root directory."""
+        paths = []
+
+        for dirpath, dirnames, filenames in os.walk(self.root / FIRMWARED):
+            directory = os.path.relpath(dirpath, self.root / FIRMWARED)
+            directory = "" if directory == "." else directory
+            names = self.listings[directory] = sorted(dirnames + filenames)
+            paths += [FIRMWARED / directory / name for name in names]
+
+        return paths
 
 
 def normalize_module_name(name: str) -> str:
@@ -52,84 +87,474 @@ def module_path_to_name(path: Path) -> str:
     return normalize_module_name(path.name.partition(".")[0])
 
 
-def resolve_module_dependencies(
-    root: Path,
-    kver: str,
-    modules: Iterable[str],
-) -> tuple[set[Path], set[Path]]:
+@functools.cache
+def compile_module_patterns(patterns: tuple[str, ...]) -> re.Pattern[str]:
+    return re.compile("|".join(patterns))
+
+
+def stat_module(path: Path) -> os.stat_result:
+    try:
+        return path.stat()
+    except FileNotFoundError:
+        # Dangling symlinks are still picked up by rglob() so stat the symlink itself instead.
+        return path.lstat()
+
+
+@dataclasses.dataclass(frozen=True)
+class KernelModule:
+    # The path of the module relative to the root directory.
+    path: Path
+    name: str
+    size: int
+    mtime: int
+
+
+class KernelModuleInventory:
     """
-    Returns a tuple of lists containing the paths to the module and firmware dependencies of the given list
-    of module names (including the given module paths themselves). The paths are returned relative to the
-    root directory.
+    The kernel modules of a kernel version in a root directory. The module tree is scanned once and the inventory is
+    reused by all kernel module operations on the same tree until the tree changes. Use KernelModuleInventory.get()
+    to get an up to date inventory.
     """
-    modulesd = Path("usr/lib/modules") / kver
-    if (p := root / modulesd / "modules.builtin").exists():
-        builtin = set(module_path_to_name(Path(m)) for m in p.read_text().splitlines())
-    else:
-        builtin = set()
-    with chdir(root):
-        allmodules = set(modulesd.rglob("*.ko*"))
-    nametofile = {module_path_to_name(m): m for m in allmodules}
 
-    log_step("Running modinfo to fetch kernel module dependencies")
+    inventories: dict[tuple[Path, str], "KernelModuleInventory"] = {}
 
-    # We could run modinfo once for each module but that's slow. Luckily we can pass multiple modules to modinfo and
-    # it'll process them all in a single go. We get the modinfo for all modules to build two maps that map the path of
-    # the module to its module dependencies and its firmware dependencies respectively. Because there's more kernel
-    # modules than the max number of accepted CLI arguments, we split the modules list up into chunks.
-    info = ""
-    for i in range(0, len(nametofile.keys()), 8500):
-        chunk = list(nametofile.keys())[i:i+8500]
-        info += run(
-            ["modinfo", "--set-version", kver, "--null", *chunk],
-            stdout=subprocess.PIPE,
-            sandbox=chroot_cmd(root=root),
-        ).stdout.strip()
+    def __init__(self, root: Path, kver: str) -> None:
+        self.root = root
+        self.kver = kver
+        self.modulesd = Path("usr/lib/modules") / kver
+        # The modification times of all directories in the tree, to detect added, removed and renamed modules.
+        # A missing module directory is recorded with a modification time of -1.
+        self.directories: dict[str, int] = {os.fspath(root / self.modulesd): -1}
+        modules = []
 
-    log_step("Calculating required kernel modules and firmware")
+        for dirpath, _, filenames in os.walk(root / self.modulesd):
+            self.directories[dirpath] = os.stat(dirpath).st_mtime_ns
+
+            for name in filenames:
+                # Equivalent to rglob("*.ko*").
+                if ".ko" not in name:
+                    continue
+
+                path = Path(dirpath) / name
+                st = stat_module(path)
+                modules += [
+                    KernelModule(
+                        path=path.relative_to(root),
+                        name=module_path_to_name(path),
+                        size=st.st_size,
+                        mtime=st.st_mtime_ns,
+                    )
+                ]
+
+        self.modules = {m.path: m for m in sorted(modules, key=lambda m: m.path)}
+        self.by_name = {m.name: m.path for m in self.modules.values()}
+
+    @classmethod
+    def get(cls, root: Path, kver: str) -> "KernelModuleInventory":
+        if (inventory := cls.inventories.get((root, kver))) and not inventory.changed():
+            return inventory
+
+        inventory = cls.inventories[(root, kver)] = KernelModuleInventory(root, kver)
+        return inventory
+
+    def changed(self) -> bool:
+        for d, mtime in self.directories.items():
+            try:
+                if os.stat(d).st_mtime_ns != mtime:
+                    return True
+            except FileNotFoundError:
+                if mtime != -1:
+                    return True
+
+        for m in self.modules.values():
+            try:
+                st = stat_module(self.root / m.path)
+            except FileNotFoundError:
+                return True
+
+            if (st.st_size, st.st_mtime_ns) != (m.size, m.mtime):
+                return True
 
-    moddep = {}
-    firmwaredep = {}
+        return False
 
+    def paths(self) -> list[Path]:
+        return list(self.modules)
+
+    def newest_mtime(self) -> int:
+        return max((m.mtime for m in self.modules.values()), default=0)
+
+    def filter(self, *, include: Iterable[str], exclude: Iterable[str]) -> list[Path]:
+        # The regexes are matched against the module paths without the leading /usr.
+        rels = {m: os.fspath(Path(*m.parts[1:])) for m in self.modules}
+
+        keep = set()
+        if include := tuple(include):
+            regex = compile_module_patterns(include)
+            keep = {rel for rel in rels.values() if regex.search(rel)}
+
+        modules = set(rels)
+
+        if exclude := tuple(exclude):
+            regex = compile_module_patterns(exclude)
+            modules -= {m for m, rel in rels.items() if rel not in keep and regex.search(rel)}
+
+        return sorted(modules)
+
+
+def filter_kernel_modules(root: Path, kver: str, *, include: Iterable[str], exclude: Iterable[str]) -> list[Path]:
+    return KernelModuleInventory.get(root, kver).filter(include=include, exclude=exclude)
+
+
+@dataclasses.dataclass(frozen=True)
+class ModuleInfo:
+    name: str
+    # The module dependencies, including soft dependencies.
+    depends: tuple[str, ...]
+    # The firmware references exactly as they appear in the modinfo output.
+    firmware: tuple[str, ...]
+
+
+def make_module_info(filename: Path, fields: Iterable[tuple[str, str]]) -> ModuleInfo:
+    name = ""
     depends = []
     firmware = []
 
-    with chdir(root):
-        for line in info.split("\0"):
-            key, sep, value = line.partition(":")
-            if not sep:
-                key, sep, value = line.partition("=")
+    for key, value in fields:
+        if key == "depends":
+            depends += [normalize_module_name(d) for d in value.strip().split(",") if d]
+
+        elif key == "softdep":
+            # softdep is delimited by spaces and can contain strings like pre: and post: so discard anything that
+            # ends with a colon.
+            depends += [normalize_module_name(d) for d in value.strip().split() if not d.endswith(":")]
+
+        elif key == "firmware":
+            firmware += [value.strip()]
+
+        elif key == "name":
+            name = value.strip()
+
+    return ModuleInfo(
+        # The file names use dashes, but the module names use underscores. We track the names in terms of the file
+        # names, since the depends use dashes and therefore filenames as well.
+        name=normalize_module_name(name) if name else module_path_to_name(filename),
+        depends=tuple(depends),
+        firmware=tuple(firmware),
+    )
+
+
+def parse_modinfo(info: str) -> dict[Path, ModuleInfo]:
+    """Parse the NUL separated output of modinfo into a map from module path to the module's information."""
+    modules = {}
+    filename: Optional[Path] = None
+    fields: list[tuple[str, str]] = []
+
+    for line in info.split("\0"):
+        key, sep, value = line.partition(":")
+        if not sep:
+            key, sep, value = line.partition("=")
 
-            if key == "depends":
-                depends += [normalize_module_name(d) for d in value.strip().split(",") if d]
+        key = key.strip()
 
-            elif key == "softdep":
-                # softdep is delimited by spaces and can contain strings like pre: and post: so discard anything that
-                # ends with a colon.
-                depends += [normalize_module_name(d) for d in value.strip().split() if not d.endswith(":")]
+        if key == "filename":
+            if filename:
+                modules[filename] = make_module_info(filename, fields)
 
-            elif key == "firmware":
-                fw = [f for f in Path("usr/lib/firmware").glob(f"{value.strip()}*")]
-                if not fw:
-                    logging.debug(f"Not including missing firmware /usr/lib/firmware/{value} in the initrd")
+            filename = Path(value.strip().lstrip("/"))
+            fields = []
+        else:
+            fields += [(key, value)]
 
-                firmware += fw
+    if filename:
+        modules[filename] = make_module_info(filename, fields)
 
-            elif key == "name":
-                # The file names use dashes, but the module names use underscores. We track the names
-                # in terms of the file names, since the depends use dashes and therefore filenames as
-                # well.
-                name = normalize_module_name(value.strip())
+    return modules
 
-                moddep[name] = depends
-                firmwaredep[name] = firmware
 
-                depends = []
-                firmware = []
+def decompress_module(path: Path) -> Optional[bytes]:
+    """Return the uncompressed contents of the given kernel module or None if its compression is not supported."""
+    data = path.read_bytes()
+
+    if path.name.endswith(".ko"):
+        return data
+    elif path.name.endswith(".ko.xz"):
+        return lzma.decompress(data)
+    elif path.name.endswith(".ko.gz"):
+        return gzip.decompress(data)
+    elif path.name.endswith(".ko.zst"):
+        try:
+            from compression import zstd  # type: ignore
+
+            return cast(bytes, zstd.decompress(data))
+        except ImportError:
+            pass
+
+        try:
+            import zstandard  # type: ignore
+
+            return cast(bytes, zstandard.ZstdDecompressor().decompressobj().decompress(data))
+        except ImportError:
+            return None
+
+    return None
+
+
+def read_modinfo_section(elf: bytes) -> Optional[bytes]:
+    """Return the contents of the .modinfo section of the given ELF object or None if it can't be found."""
+    if elf[:4] != b"\x7fELF" or elf[4] not in (1, 2) or elf[5] not in (1, 2):
+        return None
+
+    # EI_CLASS is 1 for 32-bit and 2 for 64-bit objects, EI_DATA is 1 for little endian and 2 for big endian.
+    is64 = elf[4] == 2
+    endian = "<" if elf[5] == 1 else ">"
+
+    try:
+        if is64:
+            shoff, = struct.unpack_from(f"{endian}Q", elf, 0x28)
+            shentsize, shnum, shstrndx = struct.unpack_from(f"{endian}HHH", elf, 0x3A)
+            shdr = f"{endian}IIQQQQIIQQ"
+        else:
+            shoff, = struct.unpack_from(f"{endian}I", elf, 0x20)
+            shentsize, shnum, shstrndx = struct.unpack_from(f"{endian}HHH", elf, 0x2E)
+            shdr = f"{endian}IIIIIIIIII"
+
+        # Each section header is unpacked into (name, type, flags, addr, offset, size, ...).
+        sections = [struct.unpack_from(shdr, elf, shoff + i * shentsize) for i in range(shnum)]
+        strtab = sections[shstrndx]
+
+        for name, _, _, _, offset, size, *_ in sections:
+            start = strtab[4] + name
+            if elf[start:elf.index(b"\0", start)] == b".modinfo":
+                return elf[offset:offset + size]
+    except (struct.error, IndexError, ValueError):
+        return None
+
+    return None
+
+
+def read_module_info(path: Path) -> Optional[ModuleInfo]:
+    """
+    Read the dependencies and firmware references of the given kernel module directly from its .modinfo section. None
+    is returned if the module can't be parsed, in which case modinfo should be used instead.
+    """
+    try:
+        if (elf := decompress_module(path)) is None or (section := read_modinfo_section(elf)) is None:
+            return None
+    except (OSError, lzma.LZMAError, EOFError):
+        return None
+
+    # The .modinfo section consists of NUL terminated key=value strings which might be padded with extra NULs.
+    fields = []
+    for e in section.split(b"\0"):
+        key, sep, value = e.decode(errors="replace").partition("=")
+        if sep:
+            fields += [(key, value)]
+
+    return make_module_info(path, fields)
+
+
+def read_modules_info(root: Path, modules: Sequence[Path]) -> tuple[dict[Path, ModuleInfo], list[Path]]:
+    """
+    Read the information of the given modules natively, in parallel for larger numbers of modules. Returns the
+    information of the modules that could be read and the list of modules that have to be handled by modinfo.
+    """
+    paths = [root / m for m in modules]
+
+    # Decompressing modules is CPU bound so use multiple processes, unless there's too little work to make up for
+    # the cost of starting them.
+    if (workers := min(os.cpu_count() or 1, len(paths) // 64)) <= 1:
+        results = [read_module_info(p) for p in paths]
+    else:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as pool:
+            results = list(pool.map(read_module_info, paths, chunksize=32))
+
+    info: dict[Path, ModuleInfo] = {}
+    unsupported = []
+    for m, i in zip(modules, results):
+        if i is None:
+            unsupported += [m]
+        else:
+            info[m] = i
+
+    return info, unsupported
+
+
+def run_modinfo(root: Path, kver: str, modules: Sequence[Path]) -> dict[Path, ModuleInfo]:
+    # We could run modinfo once for each module but that's slow. Luckily we can pass multiple modules to modinfo and
+    # it'll process them all in a single go. Because there's more kernel modules than the max number of accepted CLI
+    # arguments, we split the modules list up into chunks.
+    info: dict[Path, ModuleInfo] = {}
+    for i in range(0, len(modules), 4000):
+        info |= parse_modinfo(
+            run(
+                ["modinfo", "--set-version", kver, "--null", *(f"/{m}" for m in modules[i:i + 4000])],
+                stdout=subprocess.PIPE,
+                sandbox=chroot_cmd(root=root),
+            ).stdout.strip()
+        )
+
+    return info
+
+
+# The number of kernel versions for which the modinfo cache is kept.
+MODINFO_CACHE_ENTRIES = 4
+
+
+def read_modinfo_cache(cache: Path) -> dict[str, Any]:
+    try:
+        entries = cast(dict[str, Any], json.loads(cache.read_text()))
+        # Mark the cache as recently used so that it's not evicted.
+        os.utime(cache)
+        return entries
+    except (FileNotFoundError, json.JSONDecodeError):
+        return {}
+
+
+def write_modinfo_cache(cache: Path, entries: Mapping[str, Any]) -> None:
+    cache.parent.mkdir(parents=True, exist_ok=True)
+
+    # Write to a temporary file first so that concurrent builds never see a partially written cache.
+    with tempfile.NamedTemporaryFile("w", dir=cache.parent, prefix=f".{cache.name}", delete=False) as f:
+        json.dump(entries, f)
+
+    os.rename(f.name, cache)
+    evict_cache_entries(cache.parent, "modinfo-*.json", keep=MODINFO_CACHE_ENTRIES)
+
+
+def modules_info(
+    inventory: KernelModuleInventory,
+    modules: Iterable[Path],
+    *,
+    cache: Optional[Path],
+) -> dict[Path, ModuleInfo]:
+    """
+    Return the information of the given modules. If a cache directory is given, the information of modules that
+    haven't changed since a previous invocation, as identified by their path, size and modification time, is read
+    from the cache instead of from the modules themselves.
+    """
+    root, kver = inventory.root, inventory.kver
+    cachefile = cache / f"modinfo-{kver}.json" if cache else None
+    entries = read_modinfo_cache(cachefile) if cachefile else {}
+
+    info: dict[Path, ModuleInfo] = {}
+    missing = []
+    for m in modules:
+        km = inventory.modules[m]
+        e = entries.get(os.fspath(m))
+        if e and (e["size"], e["mtime"]) == (km.size, km.mtime):
+            info[m] = ModuleInfo(name=e["name"], depends=tuple(e["depends"]), firmware=tuple(e["firmware"]))
+        else:
+            missing += [m]
+
+    if not missing:
+        return info
+
+    log_step(f"Reading kernel module dependencies of {len(missing)} modules")
+    new, unsupported = read_modules_info(root, sorted(missing))
+
+    if unsupported:
+        log_step(f"Running modinfo to fetch kernel module dependencies of {len(unsupported)} modules")
+        new |= run_modinfo(root, kver, unsupported)
+
+    info |= new
+
+    if cachefile:
+        # Drop the entries of modules that were removed.
+        entries = {k: v for k, v in entries.items() if (root / k).exists()}
+
+        for m, i in new.items():
+            entries[os.fspath(m)] = {
+                "size": inventory.modules[m].size,
+                "mtime": inventory.modules[m].mtime,
+                "name": i.name,
+                "depends": i.depends,
+                "firmware": i.firmware,
+            }
+
+        write_modinfo_cache(cachefile, entries)
+
+    return info
+
+
+def read_depmod_indexes(inventory: KernelModuleInventory) -> Optional[dict[str, list[str]]]:
+    """
+    Build a map from module name to the names of its (soft) dependencies from the modules.dep and modules.softdep
+    indexes generated by depmod. None is returned if the indexes are missing or older than any of the modules.
+    """
+    dep = inventory.root / inventory.modulesd / "modules.dep"
+    softdep = inventory.root / inventory.modulesd / "modules.softdep"
+
+    if not dep.exists():
+        return None
+
+    if inventory.newest_mtime() > dep.stat().st_mtime_ns:
+        logging.debug(f"{dep} is out of date, not using it to resolve kernel module dependencies")
+        return None
+
+    moddep: dict[str, list[str]] = {}
+
+    for line in dep.read_text().splitlines():
+        module, sep, depends = line.partition(":")
+        if not sep:
+            continue
+
+        # modules.dep lists the full set of (indirect) dependencies of every module.
+        moddep[module_path_to_name(Path(module))] = [module_path_to_name(Path(d)) for d in depends.split()]
+
+    # depmod lists every module it found, so if a module is missing, the index doesn't describe this tree.
+    if any(name not in moddep for name in inventory.by_name):
+        logging.debug(f"{dep} does not list all kernel modules, not using it to resolve kernel module dependencies")
+        return None
+
+    if softdep.exists():
+        for line in softdep.read_text().splitlines():
+            if not line.startswith("softdep "):
+                continue
+
+            _, module, *depends = line.split()
+            # Discard the pre: and post: markers.
+            moddep.setdefault(normalize_module_name(module), []).extend(
+                normalize_module_name(d) for d in depends if not d.endswith(":")
+            )
+
+    return moddep
+
+
+def resolve_module_dependencies(
+    root: Path,
+    kver: str,
+    modules: Iterable[str],
+    *,
+    cache: Optional[Path] = None,
+    firmware_index: Optional[FirmwareIndex] = None,
+    inventory: Optional[KernelModuleInventory] = None,
+) -> tuple[set[Path], set[Path]]:
+    """
+    Returns a tuple of lists containing the paths to the module and firmware dependencies of the given list
+    of module names (including the given module paths themselves). The paths are returned relative to the
+    root directory. If a cache directory is given, the modinfo output of modules that haven't changed since a previous
+    invocation is read from the cache instead of running modinfo again.
+    """
+    modulesd = Path("usr/lib/modules") / kver
+    if (p := root / modulesd / "modules.builtin").exists():
+        builtin = set(module_path_to_name(Path(m)) for m in p.read_text().splitlines())
+    else:
+        builtin = set()
+    inventory = inventory or KernelModuleInventory.get(root, kver)
+    nametofile = inventory.by_name
+
+    # If depmod's indexes are up to date, we only need the information of the modules we end up including to figure
+    # out their firmware dependencies.
+    if (moddep := read_depmod_indexes(inventory)) is not None:
+        info = None
+    else:
+        info = modules_info(inventory, nametofile.values(), cache=cache)
+        moddep = {i.name: list(i.depends) for i in info.values()}
+
+    log_step("Calculating required kernel modules and firmware")
 
     todo = [*builtin, *modules]
     mods = set()
-    firmware = set()
 
     while todo:
         m = todo.pop()
@@ -143,9 +568,26 @@ def resolve_module_dependencies(
 
         mods.add(m)
         todo += depends
-        firmware.update(firmwaredep.get(m, []))
 
-    return set(nametofile[m] for m in mods if m in nametofile), set(firmware)
+    paths = set(nametofile[m] for m in mods if m in nametofile)
+
+    if info is None:
+        info = modules_info(inventory, paths, cache=cache)
+
+    firmware_index = firmware_index or FirmwareIndex(root)
+    firmware = set()
+
+    for m in paths:
+        if not (i := info.get(m)):
+            continue
+
+        for value in i.firmware:
+            if not (fw := firmware_index.glob(value)):
+                logging.debug(f"Not including missing firmware /usr/lib/firmware/{value} in the initrd")
+
+            firmware.update(fw)
+
+    return paths, firmware
 
 
 def gen_required_kernel_modules(
@@ -154,20 +596,28 @@ def gen_required_kernel_modules(
     *,
     include: Iterable[str],
     exclude: Iterable[str],
+    cache: Optional[Path] = None,
+    firmware_index: Optional[FirmwareIndex] = None,
 ) -> Iterator[Path]:
     modulesd = Path("usr/lib/modules") / kver
+    firmware_index = firmware_index or FirmwareIndex(root)
+    inventory = KernelModuleInventory.get(root, kver)
 
     # There is firmware in /usr/lib/firmware that is not depended on by any modules so if any firmware was installed
     # we have to take the slow path to make sure we don't copy firmware into the initrd that is not depended on by any
     # kernel modules.
-    if exclude or (root / "usr/lib/firmware").glob("*"):
-        modules = filter_kernel_modules(root, kver, include=include, exclude=exclude)
-        names = [module_path_to_name(m) for m in modules]
-        mods, firmware = resolve_module_dependencies(root, kver, names)
+    if exclude or firmware_index.listing(""):
+        modules = inventory.filter(include=include, exclude=exclude)
+        names = [inventory.modules[m].name for m in modules]
+        mods, firmware = resolve_module_dependencies(
+            root, kver, names,
+            cache=cache,
+            firmware_index=firmware_index,
+            inventory=inventory,
+        )
     else:
         logging.debug("No modules excluded and no firmware installed, using kernel modules generation fast path")
-        with chdir(root):
-            mods = set(modulesd.rglob("*.ko*"))
+        mods = set(inventory.paths())
         firmware = set()
 
     yield from sorted(
@@ -193,20 +643,28 @@ def process_kernel_modules(
     *,
     include: Iterable[str],
     exclude: Iterable[str],
+    cache: Optional[Path] = None,
 ) -> None:
     if not exclude:
         return
 
-    modulesd = Path("usr/lib/modules") / kver
-    firmwared = Path("usr/lib/firmware")
+    firmware_index = FirmwareIndex(root)
 
     with complete_step("Applying kernel module filters"):
+        # Walk the firmware directory up front so that the firmware lookups are served from the same listings.
+        firmware = sorted(firmware_index.walk(), reverse=True)
+
         required = set(
-            gen_required_kernel_modules(root, kver, include=include, exclude=exclude))
+            gen_required_kernel_modules(
+                root, kver,
+                include=include,
+                exclude=exclude,
+                cache=cache,
+                firmware_index=firmware_index,
+            )
+        )
 
-        with chdir(root):
-            modules = sorted(modulesd.rglob("*.ko*"), reverse=True)
-            firmware = sorted(firmwared.rglob("*"), reverse=True)
+        modules = sorted(KernelModuleInventory.get(root, kver).paths(), reverse=True)
 
         for m in modules:
             if m in required:
@@ -222,7 +680,7 @@ def process_kernel_modules(
             if fw in required:
                 continue
 
-            if any(fw.is_relative_to(Path("usr/lib/firmware") / d) for d in ("amd-ucode", "intel-ucode")):
+            if any(fw.is_relative_to(FIRMWARED / d) for d in ("amd-ucode", "intel-ucode")):
                 continue
 
             p = root / fw
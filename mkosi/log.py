@@ -4,14 +4,19 @@ import contextlib
 import contextvars
 import logging
 import os
+import resource
 import sys
+import time
 from collections.abc import Iterator
+from pathlib import Path
 from typing import Any, NoReturn, Optional
 
 # This global should be initialized after parsing arguments
 ARG_DEBUG = contextvars.ContextVar("debug", default=False)
 ARG_DEBUG_SHELL = contextvars.ContextVar("debug-shell", default=False)
 LEVEL = 0
+# When set to a list, every step run with complete_step() is recorded in it as a Chrome trace event.
+PROFILE: Optional[list[dict[str, Any]]] = None
 
 
 class Style:
@@ -48,12 +53,114 @@ def log_notice(text: str) -> None:
     logging.info(f"{Style.bold}{text}{Style.reset}")
 
 
+def start_profiling() -> None:
+    global PROFILE
+    PROFILE = []
+
+
+def stop_profiling() -> list[dict[str, Any]]:
+    global PROFILE
+    events, PROFILE = PROFILE, None
+
+    if events is None:
+        return []
+
+    # The peak memory usage is a high-water mark of the whole process and its children, so it can't be attributed
+    # to individual steps and is recorded once for the whole build instead.
+    rss = max(
+        resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss,
+    )
+
+    return [
+        *events,
+        {
+            "name": "Peak RSS",
+            "cat": "memory",
+            "ph": "C",
+            "pid": os.getpid(),
+            "tid": os.getpid(),
+            "ts": int(time.time() * 1_000_000),
+            # ru_maxrss is in kilobytes.
+            "args": {"peak_rss_bytes": rss * 1024},
+        },
+    ]
+
+
+def read_io_counters() -> tuple[int, int]:
+    try:
+        counters = dict(line.split(": ", maxsplit=1) for line in Path("/proc/self/io").read_text().splitlines())
+    except OSError:
+        return 0, 0
+
+    return int(counters["read_bytes"]), int(counters["write_bytes"])
+
+
+def profile_sample() -> dict[str, float]:
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    read, written = read_io_counters()
+
+    return {
+        "time": time.time(),
+        "monotonic": time.monotonic(),
+        "utime": children.ru_utime,
+        "stime": children.ru_stime,
+        "read": read,
+        "written": written,
+    }
+
+
+def record_step(text: str, level: int, start: dict[str, float]) -> None:
+    assert PROFILE is not None
+
+    end = profile_sample()
+
+    PROFILE.append({
+        "name": text,
+        "cat": "step",
+        "ph": "X",
+        "pid": os.getpid(),
+        "tid": os.getpid(),
+        "ts": int(start["time"] * 1_000_000),
+        "dur": int((end["monotonic"] - start["monotonic"]) * 1_000_000),
+        "args": {
+            "level": level,
+            "children_user_time": end["utime"] - start["utime"],
+            "children_system_time": end["stime"] - start["stime"],
+            "read_bytes": end["read"] - start["read"],
+            "written_bytes": end["written"] - start["written"],
+        },
+    })
+
+
+def profile_summary(events: list[dict[str, Any]]) -> str:
+    lines = [f"{'Wall':>9} {'CPU':>9} {'Read':>9} {'Written':>9}  Step"]
+    steps = [e for e in events if e["ph"] == "X"]
+
+    for event in sorted(steps, key=lambda e: e["dur"], reverse=True):
+        args = event["args"]
+        lines += [
+            f"{event['dur'] / 1_000_000:>8.2f}s "
+            f"{args['children_user_time'] + args['children_system_time']:>8.2f}s "
+            f"{args['read_bytes'] // 1024**2:>7}M "
+            f"{args['written_bytes'] // 1024**2:>7}M  "
+            f"{' ' * args['level']}{event['name']}"
+        ]
+
+    if rss := [e["args"]["peak_rss_bytes"] for e in events if e["ph"] == "C" and e["name"] == "Peak RSS"]:
+        lines += [f"Peak RSS: {max(rss) // 1024**2}M"]
+
+    return "\n".join(lines)
+
+
 @contextlib.contextmanager
 def complete_step(text: str, text2: Optional[str] = None) -> Iterator[list[Any]]:
     global LEVEL
 
     log_step(text)
 
+    start = profile_sample() if PROFILE is not None else None
+
     LEVEL += 1
     try:
         args: list[Any] = []
@@ -62,6 +169,9 @@ def complete_step(text: str, text2: Optional[str] = None) -> Iterator[list[Any]]
         LEVEL -= 1
         assert LEVEL >= 0
 
+        if start is not None and PROFILE is not None:
+            record_step(text, LEVEL, start)
+
     if text2 is not None:
         log_step(text2.format(*args))
 
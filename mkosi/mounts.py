@@ -10,6 +10,7 @@ from typing import Optional
 
 from mkosi.config import Config
 from mkosi.sandbox import OverlayOperation
+from mkosi.tree import TreeIndex
 from mkosi.types import PathString
 from mkosi.util import flatten
 
@@ -24,10 +25,10 @@ def delete_whiteout_files(path: Path) -> None:
     Overlayfs uses such files to mark "whiteouts" (files present in
     the lower layers, but removed in the upper one).
     """
-    for entry in path.rglob("*"):
-        # TODO: Use Path.stat() once we depend on Python 3.10+.
-        if stat_is_whiteout(os.stat(entry, follow_symlinks=False)):
-            entry.unlink()
+    index = TreeIndex.scan(path)
+    for p in index.paths():
+        if stat_is_whiteout(index[p]):
+            (path / p).unlink()
 
 
 @contextlib.contextmanager
@@ -0,0 +1,90 @@
+# SPDX-License-Identifier: LGPL-2.1-or-later
+
+import dataclasses
+import mmap
+import os
+import struct
+from pathlib import Path
+
+PE_SIGNATURE = b"PE\0\0"
+# pefile rounds section file offsets down to this value if the file alignment is at least this large.
+PE_FILE_ALIGNMENT_HARDCODED = 0x200
+
+
+@dataclasses.dataclass(frozen=True)
+class PeSection:
+    name: str
+    virtual_size: int
+    virtual_address: int
+    raw_size: int
+    raw_offset: int
+
+
+def read_pe_sections(f: mmap.mmap) -> dict[str, PeSection]:
+    """
+    Parse the section table of the given PE/COFF binary. Only the headers needed to locate the sections are parsed.
+    Raises ValueError if the binary is not a PE binary.
+    """
+    if f[:2] != b"MZ":
+        raise ValueError("Missing MZ header")
+
+    (pe,) = struct.unpack_from("<I", f, 0x3C)
+    if f[pe:pe + 4] != PE_SIGNATURE:
+        raise ValueError("Missing PE signature")
+
+    nsections, optsize = struct.unpack_from("<2xH12xH", f, pe + 4)
+    # FileAlignment is at the same offset in both the PE32 and the PE32+ optional header.
+    (alignment,) = struct.unpack_from("<I", f, pe + 24 + 36) if optsize >= 40 else (0,)
+
+    sections = {}
+    for i in range(nsections):
+        name, vsize, vaddr, rawsize, rawoffset = struct.unpack_from("<8sIIII", f, pe + 24 + optsize + i * 40)
+
+        # Round the offset down the same way pefile does so that we return the same data it does.
+        if alignment >= PE_FILE_ALIGNMENT_HARDCODED:
+            rawoffset = rawoffset // PE_FILE_ALIGNMENT_HARDCODED * PE_FILE_ALIGNMENT_HARDCODED
+
+        section = PeSection(
+            name=name.decode(errors="replace").strip("\0"),
+            virtual_size=vsize,
+            virtual_address=vaddr,
+            raw_size=rawsize,
+            raw_offset=rawoffset,
+        )
+        sections[section.name] = section
+
+    return sections
+
+
+def copy_pe_section(binary: Path, section: str, output: Path) -> Path:
+    """
+    Write the contents of the given section of the given PE binary to output. Raises KeyError if the section does not
+    exist and ValueError if the binary can't be parsed.
+    """
+    with binary.open("rb") as f:
+        size = os.fstat(f.fileno()).st_size
+        if size == 0:
+            raise ValueError(f"{binary} is empty")
+
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+            try:
+                sections = read_pe_sections(m)
+            except struct.error as e:
+                raise ValueError(f"{binary} is truncated") from e
+
+        if not (s := sections.get(section)):
+            raise KeyError(f"{section} section not found in {binary}")
+
+        offset = s.raw_offset
+        remaining = max(min(s.virtual_size, size - offset), 0)
+
+        with output.open("wb") as o:
+            while remaining > 0:
+                n = os.copy_file_range(f.fileno(), o.fileno(), remaining, offset, None)
+                if n == 0:
+                    break
+
+                offset += n
+                remaining -= n
+
+    return output
@@ -571,6 +571,7 @@ def copy_ephemeral(config: Config, src: Path) -> Iterator[Path]:
                 # Make sure the ownership is changed to the (fake) root user if the directory was not built as root.
                 preserve=config.output_format == OutputFormat.directory and src.stat().st_uid == 0,
                 use_subvolumes=config.use_subvolumes,
+                copy_tool=config.copy_tool,
                 sandbox=config.sandbox,
             )
 
@@ -582,7 +583,7 @@ def copy_ephemeral(config: Config, src: Path) -> Iterator[Path]:
             if config.output_format == OutputFormat.directory:
                 become_root_in_subuid_range()
 
-            rmtree(tmp, sandbox=config.sandbox)
+            rmtree(tmp, sandbox=config.sandbox, background=True)
 
         fork_and_wait(rm)
 
@@ -3,24 +3,30 @@
 import asyncio
 import asyncio.tasks
 import contextlib
+import dataclasses
 import errno
 import fcntl
+import graphlib
 import itertools
 import logging
 import os
 import queue
+import resource
+import select
 import shlex
 import shutil
 import signal
 import subprocess
 import sys
+import tempfile
 import threading
+import time
 import uuid
 from collections.abc import Awaitable, Collection, Iterator, Mapping, Sequence
 from contextlib import AbstractContextManager
 from pathlib import Path
 from types import TracebackType
-from typing import Any, Callable, NoReturn, Optional, Protocol
+from typing import IO, Any, Callable, NoReturn, Optional, Protocol
 
 import mkosi.sandbox
 from mkosi.log import ARG_DEBUG, ARG_DEBUG_SHELL, die
@@ -30,6 +36,74 @@ from mkosi.util import flatten, one_zero
 SD_LISTEN_FDS_START = 3
 
 
+@dataclasses.dataclass
+class ProcessStats:
+    count: int = 0
+    wall_time: float = 0
+    user_time: float = 0
+    system_time: float = 0
+    max_rss: int = 0
+
+    def to_dict(self) -> dict[str, Any]:
+        return {
+            "Count": self.count,
+            "WallTime": self.wall_time,
+            "UserTime": self.user_time,
+            "SystemTime": self.system_time,
+            "MaxRss": self.max_rss,
+        }
+
+
+# Resource usage of every process spawned with spawn(), aggregated by the name of the binary that was executed.
+PROCESS_STATS: dict[str, ProcessStats] = {}
+
+
+class AccountingPopen(subprocess.Popen[str]):
+    """
+    A Popen that reaps the child process with wait4() instead of waitpid() when waiting for it without a timeout so
+    that we get the resource usage of the child process.
+    """
+
+    rusage: Optional[resource.struct_rusage] = None
+
+    def wait(self, timeout: Optional[float] = None) -> int:
+        if self.returncode is None and timeout is None:
+            try:
+                _, status, self.rusage = os.wait4(self.pid, 0)
+            except ChildProcessError:
+                # This happens if waiting for child processes has been disabled for our process or if the child was
+                # already reaped. Let Popen handle this case like it normally does.
+                pass
+            else:
+                self.returncode = os.waitstatus_to_exitcode(status)
+
+        return super().wait(timeout)
+
+
+def record_process_stats(binary: str, wall_time: float, rusage: Optional[resource.struct_rusage]) -> None:
+    stats = PROCESS_STATS.setdefault(os.path.basename(binary), ProcessStats())
+    stats.count += 1
+    stats.wall_time += wall_time
+
+    if rusage:
+        stats.user_time += rusage.ru_utime
+        stats.system_time += rusage.ru_stime
+        # ru_maxrss is in kilobytes.
+        stats.max_rss = max(stats.max_rss, rusage.ru_maxrss * 1024)
+
+
+def format_process_stats(stats: Mapping[str, ProcessStats]) -> str:
+    lines = [f"{'Count':>7} {'Wall':>9} {'User':>9} {'System':>9} {'Max RSS':>9}  Binary"]
+
+    for binary, s in sorted(stats.items(), key=lambda i: i[1].wall_time, reverse=True):
+        lines += [
+            f"{s.count:>7} {s.wall_time:>8.2f}s {s.user_time:>8.2f}s {s.system_time:>8.2f}s "
+            f"{s.max_rss // 1024**2:>7}M  {binary}"
+        ]
+
+    return "\n".join(lines)
+
+
 def make_foreground_process(*, new_process_group: bool = True) -> None:
     """
     If we're connected to a terminal, put the process in a new process group and make that the foreground
@@ -117,6 +191,123 @@ def fork_and_wait(target: Callable[..., None], *args: Any, **kwargs: Any) -> Non
         raise subprocess.CalledProcessError(rc, ["self"])
 
 
+def fork_detached(target: Callable[..., None], *args: Any, **kwargs: Any) -> None:
+    """
+    Run target() in a daemonized grandchild that outlives the current process. The grandchild doesn't inherit any file
+    descriptors besides stdin, stdout and stderr, which are connected to /dev/null, so it can't hold on to any locks
+    held by the current process.
+    """
+    pid = os.fork()
+    if pid == 0:
+        try:
+            os.setsid()
+            if os.fork() != 0:
+                os._exit(0)
+
+            signal.signal(signal.SIGINT, signal.SIG_IGN)
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+
+            null = os.open("/dev/null", os.O_RDWR)
+            for fd in (0, 1, 2):
+                os.dup2(null, fd)
+            os.closerange(3, resource.getrlimit(resource.RLIMIT_NOFILE)[0])
+
+            target(*args, **kwargs)
+        finally:
+            os._exit(0)
+
+    os.waitpid(pid, 0)
+
+
+def fork_and_wait_graph(
+    target: Callable[[int], None],
+    graph: Mapping[int, Collection[int]],
+    *,
+    jobs: int = 1,
+) -> None:
+    """
+    Run target() in a forked child for every node in the given dependency graph, starting a node as soon as all
+    the nodes it depends on have finished, with at most the given number of children running at the same time.
+
+    When more than one job is allowed to run at the same time, the stdout and stderr of each child are captured and
+    only written to our own stdout and stderr once the child exits so that the output of concurrent children doesn't
+    get interleaved.
+    The first child that fails causes all other running children to be terminated and no new children to be
+    started. When only one job is allowed, the nodes are built one after the other in the order of the given
+    mapping, which is expected to already be topologically sorted.
+    """
+    if jobs <= 1:
+        for node in graph:
+            fork_and_wait(target, node)
+
+        return
+
+    sorter = graphlib.TopologicalSorter(graph)
+    sorter.prepare()
+    ready: list[int] = []
+    # Maps the pid of every running child to its node, its captured stdout and stderr and a pidfd that becomes
+    # readable when the child exits. We only ever wait for our own children so that we never reap children forked by
+    # others, such as the intermediate children of fork_detached().
+    running: dict[int, tuple[int, tuple[IO[bytes], IO[bytes]], int]] = {}
+
+    def flush(logs: tuple[IO[bytes], IO[bytes]]) -> None:
+        for log, stream in zip(logs, (sys.stdout, sys.stderr)):
+            log.seek(0)
+            stream.flush()
+            shutil.copyfileobj(log, stream.buffer)
+            stream.buffer.flush()
+            log.close()
+
+    def start(node: int) -> None:
+        logs = (tempfile.TemporaryFile(), tempfile.TemporaryFile())
+
+        sys.stdout.flush()
+        sys.stderr.flush()
+
+        pid = os.fork()
+        if pid == 0:
+            with uncaught_exception_handler(exit=os._exit):
+                make_foreground_process()
+                os.dup2(logs[0].fileno(), sys.stdout.fileno())
+                os.dup2(logs[1].fileno(), sys.stderr.fileno())
+                target(node)
+
+        running[pid] = (node, logs, os.pidfd_open(pid))
+
+    def reap(pid: int) -> tuple[int, int]:
+        node, logs, pidfd = running.pop(pid)
+        os.close(pidfd)
+        try:
+            _, status = os.waitpid(pid, 0)
+        finally:
+            # Just like fork_and_wait(), take back the terminal once a child exits so that SIGINT reaches us again.
+            make_foreground_process(new_process_group=False)
+        flush(logs)
+        return node, status
+
+    try:
+        while sorter.is_active():
+            ready += sorter.get_ready()
+
+            while ready and len(running) < jobs:
+                start(ready.pop(0))
+
+            exited, _, _ = select.select([pidfd for _, _, pidfd in running.values()], [], [])
+            pid = next(pid for pid, (_, _, pidfd) in running.items() if pidfd == exited[0])
+            node, status = reap(pid)
+
+            if (rc := os.waitstatus_to_exitcode(status)) != 0:
+                raise subprocess.CalledProcessError(rc, ["self"])
+
+            sorter.done(node)
+    finally:
+        for pid in running:
+            os.kill(pid, signal.SIGTERM)
+
+        for pid in list(running):
+            reap(pid)
+
+
 def log_process_failure(sandbox: Sequence[str], cmdline: Sequence[str], returncode: int) -> None:
     if returncode < 0:
         logging.error(f"Interrupted by {signal.Signals(-returncode).name} signal")
@@ -254,9 +445,10 @@ def spawn(
 
     with sandbox as sbx:
         prefix = [os.fspath(x) for x in sbx]
+        start = time.monotonic()
 
         try:
-            with subprocess.Popen(
+            with AccountingPopen(
                 [*prefix, *cmdline],
                 stdin=stdin,
                 stdout=stdout,
@@ -277,6 +469,7 @@ def spawn(
                     raise
                 finally:
                     returncode = proc.wait()
+                    record_process_stats(os.fspath(cmdline[0]), time.monotonic() - start, proc.rusage)
 
                 if check and returncode not in success_exit_status:
                     if log:
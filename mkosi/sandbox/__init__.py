@@ -48,6 +48,7 @@ OPEN_TREE_CLOEXEC = os.O_CLOEXEC
 OPEN_TREE_CLONE = 1
 PR_CAP_AMBIENT = 47
 PR_CAP_AMBIENT_RAISE = 2
+RENAME_EXCHANGE = 1 << 1
 # These definitions are taken from the libseccomp headers
 SCMP_ACT_ALLOW = 0x7FFF0000
 SCMP_ACT_ERRNO = 0x00050000
@@ -124,6 +125,13 @@ def umount2(path: str, flags: int = 0) -> None:
         oserror()
 
 
+def renameat2(src: str, dst: str, flags: int) -> None:
+    libc.renameat2.argtypes = (ctypes.c_int, ctypes.c_char_p, ctypes.c_int, ctypes.c_char_p, ctypes.c_uint)
+
+    if libc.renameat2(AT_FDCWD, src.encode(), AT_FDCWD, dst.encode(), flags) < 0:
+        oserror(src)
+
+
 def cap_permitted_to_ambient() -> None:
     """
     When unsharing a user namespace and mapping the current user to itself, the user has a full set of capabilities in
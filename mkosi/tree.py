@@ -1,27 +1,70 @@
 # SPDX-License-Identifier: LGPL-2.1-or-later
 
+import concurrent.futures
 import contextlib
 import errno
+import fcntl
+import fnmatch
 import logging
+import os
 import shutil
+import stat
+import struct
 import subprocess
 import tempfile
-from collections.abc import Iterator
+import threading
+import uuid
+from collections.abc import Callable, Iterator
 from pathlib import Path
+from typing import Optional, Union
 
-from mkosi.config import ConfigFeature
+from mkosi.config import ConfigFeature, CopyTool
 from mkosi.log import ARG_DEBUG, die
-from mkosi.run import SandboxProtocol, nosandbox, run
-from mkosi.sandbox import BTRFS_SUPER_MAGIC, statfs
+from mkosi.run import SandboxProtocol, fork_detached, nosandbox, run
+from mkosi.sandbox import BTRFS_SUPER_MAGIC, RENAME_EXCHANGE, renameat2, statfs
 from mkosi.types import PathString
-from mkosi.util import flatten
+from mkosi.util import flatten, flock
 from mkosi.versioncomp import GenericVersion
 
+FICLONE = 0x40049409
+FICLONERANGE = 0x4020940D
+TRASH_DIRECTORY = ".mkosi-trash"
+
 
 def is_subvolume(path: Path) -> bool:
     return path.is_dir() and path.stat().st_ino == 256 and statfs(str(path)) == BTRFS_SUPER_MAGIC
 
 
+def can_reflink(src: Path, dst: Path) -> bool:
+    """Check whether files in the src directory can be reflinked into the dst directory."""
+    if src.stat().st_dev != dst.stat().st_dev:
+        return False
+
+    with (
+        tempfile.NamedTemporaryFile(dir=src, prefix=".mkosi-reflink-") as s,
+        tempfile.NamedTemporaryFile(dir=dst, prefix=".mkosi-reflink-") as d,
+    ):
+        try:
+            fcntl.ioctl(d.fileno(), FICLONE, s.fileno())
+        except OSError:
+            return False
+
+    return True
+
+
+def reflink_file_range(src: int, dst: int, *, offset: int, length: int) -> bool:
+    """
+    Try to share the first length bytes of src with dst at the given offset. Both the offset and the length have to be
+    aligned to the block size of the filesystem. Returns whether the data was reflinked.
+    """
+    try:
+        fcntl.ioctl(dst, FICLONERANGE, struct.pack("=qQQQ", src, 0, length, offset))
+    except OSError:
+        return False
+
+    return True
+
+
 def cp_version(*, sandbox: SandboxProtocol = nosandbox) -> GenericVersion:
     return GenericVersion(
         run(
@@ -60,11 +103,14 @@ def make_tree(
 
 @contextlib.contextmanager
 def preserve_target_directories_stat(src: Path, dst: Path) -> Iterator[None]:
-    dirs = [p for d in src.glob("**/") if (dst / (p := d.relative_to(src))).exists()]
+    # When copying a file into a directory, the directory is the only one that is modified.
+    dirs = [d for d in (TreeIndex.scan(src).directories() if src.is_dir() else [Path(".")]) if (dst / d).is_dir()]
 
     with tempfile.TemporaryDirectory() as tmp:
+        # Create all directories before copying their stat as creating a subdirectory modifies its parent.
         for d in dirs:
             (tmp / d).mkdir(exist_ok=True)
+        for d in dirs:
             shutil.copystat(dst / d, tmp / d)
 
         yield
@@ -73,6 +119,482 @@ def preserve_target_directories_stat(src: Path, dst: Path) -> Iterator[None]:
             shutil.copystat(tmp / d, dst / d)
 
 
+def copy_file_data(src: int, dst: int, size: int) -> None:
+    """
+    Copy size bytes from src to dst. The data is reflinked if possible, otherwise it is copied with copy_file_range()
+    while preserving holes in sparse files.
+    """
+    try:
+        fcntl.ioctl(dst, FICLONE, src)
+        return
+    except OSError:
+        pass
+
+    offset = 0
+    while offset < size:
+        try:
+            start = os.lseek(src, offset, os.SEEK_DATA)
+            end = os.lseek(src, start, os.SEEK_HOLE)
+        except OSError as e:
+            # ENXIO means there's no more data after offset.
+            if e.errno == errno.ENXIO:
+                break
+            if e.errno != errno.EINVAL:
+                raise
+
+            start, end = offset, size
+
+        while start < end:
+            try:
+                n = os.copy_file_range(src, dst, end - start, start, start)
+            except OSError as e:
+                if e.errno not in (errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP):
+                    raise
+
+                n = os.pwrite(dst, os.pread(src, min(end - start, 1024**2), start), start)
+
+            if n == 0:
+                break
+
+            start += n
+
+        offset = end
+
+    os.ftruncate(dst, size)
+
+
+def copy_xattrs(src: Union[int, Path], dst: Union[int, Path], *, follow_symlinks: bool = True) -> None:
+    # Note that ACLs are stored as extended attributes as well so they're copied here too.
+    try:
+        names = os.listxattr(src, follow_symlinks=follow_symlinks)
+    except OSError as e:
+        if e.errno not in (errno.ENOTSUP, errno.ENODATA):
+            raise
+        return
+
+    for name in names:
+        value = os.getxattr(src, name, follow_symlinks=follow_symlinks)
+        try:
+            os.setxattr(dst, name, value, follow_symlinks=follow_symlinks)
+        except OSError as e:
+            if e.errno != errno.ENOTSUP:
+                raise
+
+
+def chown_or_ignore(dst: Union[int, Path], uid: int, gid: int, *, follow_symlinks: bool = True) -> None:
+    try:
+        os.chown(dst, uid, gid, follow_symlinks=follow_symlinks)
+    except OSError as e:
+        # Like cp, ignore failures to change the ownership when we're not privileged to do so.
+        if e.errno not in (errno.EPERM, errno.EINVAL) or os.geteuid() == 0:
+            raise
+
+
+def walk_directories(top: Path, visit: Callable[[Path], list[Path]], *, name: str) -> list[Path]:
+    """
+    Call visit() on a thread pool for the given directory and for every subdirectory returned by previous calls to
+    visit(). Returns all visited directories, where every directory comes after its parent.
+    """
+    directories = [top]
+
+    with concurrent.futures.ThreadPoolExecutor(thread_name_prefix=f"mkosi-{name}") as pool:
+        pending = {pool.submit(visit, top)}
+
+        try:
+            while pending:
+                done, pending = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+                for f in done:
+                    directories += (subdirs := f.result())
+                    pending |= {pool.submit(visit, d) for d in subdirs}
+        except BaseException:
+            for f in pending:
+                f.cancel()
+            raise
+
+    return directories
+
+
+class TreeIndex:
+    """
+    The paths and lstat() results of every entry of a directory tree, captured in a single parallel scan so that the
+    steps that post-process the tree don't each have to walk it again. Paths are relative to the root of the tree,
+    which itself is stored as ".". Steps that modify the tree keep the index up to date with update() and remove().
+    """
+
+    def __init__(self, root: Path) -> None:
+        self.root = root
+        self.lock = threading.Lock()
+        self.entries: dict[Path, os.stat_result] = {}
+        # Maps every directory in the index to the names of its entries.
+        self.children: dict[Path, list[str]] = {}
+
+    @classmethod
+    def scan(cls, root: Path) -> "TreeIndex":
+        index = cls(root)
+        index.update(Path("."))
+        return index
+
+    def __getitem__(self, path: Path) -> os.stat_result:
+        return self.entries[path]
+
+    def __contains__(self, path: Path) -> bool:
+        return path in self.entries
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def scan_directory(self, d: Path) -> list[Path]:
+        entries = {}
+        subdirs = []
+
+        fd = os.open(self.root / d, os.O_RDONLY|os.O_DIRECTORY|os.O_CLOEXEC|(os.O_NOFOLLOW if d != Path(".") else 0))
+        try:
+            with os.scandir(fd) as it:
+                for entry in it:
+                    entries[entry.name] = st = entry.stat(follow_symlinks=False)
+                    if stat.S_ISDIR(st.st_mode):
+                        subdirs += [d / entry.name]
+        finally:
+            os.close(fd)
+
+        with self.lock:
+            self.children[d] = list(entries)
+            self.entries.update((d / name, st) for name, st in entries.items())
+
+        return subdirs
+
+    def forget(self, path: Path) -> None:
+        if self.entries.pop(path, None) is None:
+            return
+
+        for name in self.children.pop(path, []):
+            self.forget(path / name)
+
+        if path != Path(".") and path.name in (siblings := self.children.get(path.parent, [])):
+            siblings.remove(path.name)
+
+    def update(self, *paths: Path) -> None:
+        """Scan the given paths, and everything below them if they are directories, again."""
+        for path in paths:
+            self.forget(path)
+
+            try:
+                st = os.stat(self.root) if path == Path(".") else os.lstat(self.root / path)
+            except FileNotFoundError:
+                continue
+
+            self.entries[path] = st
+            if path != Path(".") and path.parent in self.children:
+                self.children[path.parent].append(path.name)
+
+            if stat.S_ISDIR(st.st_mode):
+                walk_directories(path, self.scan_directory, name="index")
+
+        self.update_parents(*paths)
+
+    def remove(self, *paths: Path) -> None:
+        """Drop the given paths, and everything below them, from the index after they were removed from the tree."""
+        for path in paths:
+            self.forget(path)
+
+        self.update_parents(*paths)
+
+    def update_parents(self, *paths: Path) -> None:
+        # Adding or removing entries modifies the directories containing them, so stat those directories again.
+        for parent in {path.parent for path in paths if path != Path(".")}:
+            if parent not in self.entries:
+                continue
+
+            try:
+                self.entries[parent] = os.stat(self.root) if parent == Path(".") else os.lstat(self.root / parent)
+            except FileNotFoundError:
+                pass
+
+    def paths(self) -> list[Path]:
+        """Return all paths in the index except the root directory, sorted."""
+        return sorted(p for p in self.entries if p != Path("."))
+
+    def directories(self) -> list[Path]:
+        """Return all directories in the index, including the root directory, sorted."""
+        return sorted(self.children)
+
+    def size(self) -> int:
+        """Return the disk space used by the regular files in the tree."""
+        return sum(st.st_blocks * 512 for st in self.entries.values() if stat.S_ISREG(st.st_mode))
+
+    def resolve(self, path: Path) -> Optional[Path]:
+        """
+        Resolve the symlinks in the given path as if the root of the tree were the root directory. Returns None if
+        the path does not exist.
+        """
+        parts = list(path.parts)
+        current = Path(".")
+        links = 0
+
+        while parts:
+            name = parts.pop(0)
+            if name in ("/", "."):
+                continue
+            if name == "..":
+                current = current.parent
+                continue
+
+            if (st := self.entries.get(current / name)) is None:
+                return None
+
+            if not stat.S_ISLNK(st.st_mode):
+                current = current / name
+                continue
+
+            links += 1
+            if links > 40:
+                return None
+
+            target = Path(os.readlink(self.root / current / name))
+            if target.is_absolute():
+                current = Path(".")
+            parts = [*target.parts, *parts]
+
+        return current
+
+    def glob(self, pattern: str) -> list[Path]:
+        """
+        Return the paths in the index matching the given relative glob pattern, with the same semantics as
+        Path.glob(), except that symlinks are resolved within the tree and the returned paths don't contain any
+        symlinks except for their last component.
+        """
+        matches: dict[Path, None] = {}
+
+        def match(d: Path, parts: tuple[str, ...]) -> None:
+            if not parts:
+                matches[d] = None
+                return
+
+            head, rest = parts[0], parts[1:]
+
+            if head == "**":
+                match(d, rest)
+                for name in self.children.get(d, []):
+                    if stat.S_ISDIR(self.entries[d / name].st_mode):
+                        match(d / name, parts)
+                return
+
+            for name in fnmatch.filter(self.children.get(d, []), head) if any(c in head for c in "*?[") else [head]:
+                if d / name not in self.entries:
+                    continue
+
+                if not rest:
+                    matches[d / name] = None
+                elif (target := self.resolve(d / name)) is not None and stat.S_ISDIR(self.entries[target].st_mode):
+                    match(target, rest)
+
+        if not (parts := Path(pattern).parts):
+            raise ValueError(f"Unacceptable pattern: {pattern!r}")
+
+        match(Path("."), parts)
+        return list(matches)
+
+
+class TreeCopier:
+    """
+    Copy a directory tree with the same semantics as `cp --recursive --reflink=auto --preserve=mode,links` (and
+    timestamps, ownership and xattrs if preserve is true) without spawning cp. Every directory is copied by a
+    separate task on a thread pool using directory file descriptor relative operations.
+    """
+
+    def __init__(self, src: Path, dst: Path, *, preserve: bool, dereference: bool) -> None:
+        self.src = src
+        self.dst = dst
+        self.preserve = preserve
+        self.dereference = dereference
+        self.lock = threading.Lock()
+        # Maps the device and inode number of hardlinked source files to the first destination path they were
+        # copied to.
+        self.inodes: dict[tuple[int, int], Path] = {}
+        # Hardlinks (target, link) that can only be created once the file they link to has been copied.
+        self.links: list[tuple[Path, Path]] = []
+        # Directories whose metadata still has to be applied, in the order they were created.
+        self.directories: list[tuple[Path, os.stat_result]] = []
+        # Existing directories whose timestamps have to be restored when not preserving metadata.
+        self.existing: list[tuple[Path, os.stat_result]] = []
+
+    def copy(self) -> None:
+        st = os.stat(self.src) if self.dereference else os.lstat(self.src)
+
+        if stat.S_ISDIR(st.st_mode):
+            self.copy_directory_entry(Path("."), st, existing=os.stat(self.dst) if self.dst.is_dir() else None)
+
+            walk_directories(Path("."), self.copy_directory, name="copy")
+        else:
+            if self.dst.is_dir():
+                dst = self.dst / self.src.name
+                if not self.preserve:
+                    self.existing.append((Path("."), os.stat(self.dst)))
+            else:
+                dst = self.dst
+
+            sfd = os.open(self.src.parent, os.O_RDONLY|os.O_DIRECTORY|os.O_CLOEXEC)
+            dfd = os.open(dst.parent, os.O_RDONLY|os.O_DIRECTORY|os.O_CLOEXEC)
+            try:
+                self.copy_entry(sfd, self.src.name, dfd, dst.name, self.src, dst, st)
+            finally:
+                os.close(sfd)
+                os.close(dfd)
+
+        for target, link in self.links:
+            link.unlink(missing_ok=True)
+            os.link(target, link, follow_symlinks=False)
+
+        # Apply the directory metadata last and bottom up so that copying the contents of a directory doesn't change
+        # its timestamps and so that read-only directories can be populated.
+        for d, st in reversed(self.directories):
+            path = self.dst / d
+            if self.preserve:
+                chown_or_ignore(path, st.st_uid, st.st_gid)
+                copy_xattrs(self.src / d, path, follow_symlinks=True)
+            os.chmod(path, stat.S_IMODE(st.st_mode))
+            if self.preserve:
+                os.utime(path, ns=(st.st_atime_ns, st.st_mtime_ns))
+
+        for d, st in self.existing:
+            os.utime(self.dst / d, ns=(st.st_atime_ns, st.st_mtime_ns))
+
+    def copy_directory_entry(self, d: Path, st: os.stat_result, *, existing: Optional[os.stat_result]) -> None:
+        if existing is None:
+            os.mkdir(self.dst / d, 0o700)
+
+        # Only override the metadata of directories that already existed if we're preserving metadata. Otherwise,
+        # their timestamps are restored once we're done, like copy_tree() does when copying with cp.
+        if existing is None or self.preserve:
+            self.directories.append((d, st))
+        else:
+            self.existing.append((d, existing))
+
+    def copy_directory(self, d: Path) -> list[Path]:
+        subdirs = []
+        sfd = os.open(self.src / d, os.O_RDONLY|os.O_DIRECTORY|os.O_CLOEXEC)
+
+        try:
+            dfd = os.open(self.dst / d, os.O_RDONLY|os.O_DIRECTORY|os.O_CLOEXEC)
+
+            try:
+                with os.scandir(sfd) as it:
+                    for entry in it:
+                        st = entry.stat(follow_symlinks=self.dereference)
+
+                        if stat.S_ISDIR(st.st_mode):
+                            existing: Optional[os.stat_result]
+                            try:
+                                existing = os.stat(entry.name, dir_fd=dfd)
+                            except FileNotFoundError:
+                                existing = None
+                            else:
+                                # Directories are merged into existing directories or symlinks to directories.
+                                if not stat.S_ISDIR(existing.st_mode):
+                                    raise FileExistsError(
+                                        errno.EEXIST,
+                                        "Cannot overwrite non-directory with directory",
+                                        os.fspath(self.dst / d / entry.name),
+                                    )
+
+                            self.copy_directory_entry(d / entry.name, st, existing=existing)
+                            subdirs += [d / entry.name]
+                        else:
+                            self.copy_entry(
+                                sfd, entry.name, dfd, entry.name,
+                                self.src / d / entry.name, self.dst / d / entry.name,
+                                st,
+                            )
+            finally:
+                os.close(dfd)
+        finally:
+            os.close(sfd)
+
+        return subdirs
+
+    def copy_entry(
+        self,
+        sfd: int,
+        sname: str,
+        dfd: int,
+        dname: str,
+        spath: Path,
+        dpath: Path,
+        st: os.stat_result,
+    ) -> None:
+        if st.st_nlink > 1:
+            with self.lock:
+                if (target := self.inodes.get((st.st_dev, st.st_ino))):
+                    self.links += [(target, dpath)]
+                    return
+
+                self.inodes[(st.st_dev, st.st_ino)] = dpath
+
+        if stat.S_ISREG(st.st_mode):
+            self.copy_file(sfd, sname, dfd, dname, st)
+            return
+
+        with contextlib.suppress(FileNotFoundError):
+            os.unlink(dname, dir_fd=dfd)
+
+        if stat.S_ISLNK(st.st_mode):
+            os.symlink(os.readlink(sname, dir_fd=sfd), dname, dir_fd=dfd)
+        else:
+            os.mknod(dname, mode=st.st_mode, device=st.st_rdev, dir_fd=dfd)
+
+        # Python doesn't support extended attribute operations relative to a directory file descriptor, so use the
+        # full paths instead.
+        if self.preserve:
+            chown_or_ignore(dpath, st.st_uid, st.st_gid, follow_symlinks=False)
+            copy_xattrs(spath, dpath, follow_symlinks=self.dereference)
+
+        if not stat.S_ISLNK(st.st_mode):
+            os.chmod(dname, stat.S_IMODE(st.st_mode), dir_fd=dfd)
+
+        if self.preserve:
+            os.utime(dname, ns=(st.st_atime_ns, st.st_mtime_ns), dir_fd=dfd, follow_symlinks=False)
+
+    def copy_file(self, sfd: int, sname: str, dfd: int, dname: str, st: os.stat_result) -> None:
+        flags = os.O_RDONLY|os.O_CLOEXEC|(0 if self.dereference else os.O_NOFOLLOW)
+        infd = os.open(sname, flags, dir_fd=sfd)
+
+        try:
+            try:
+                outfd = os.open(dname, os.O_WRONLY|os.O_CREAT|os.O_CLOEXEC|os.O_NOFOLLOW, 0o600, dir_fd=dfd)
+            except OSError as e:
+                # The destination is a symlink or a special file, replace it.
+                if e.errno not in (errno.ELOOP, errno.ENXIO, errno.EACCES):
+                    raise
+
+                os.unlink(dname, dir_fd=dfd)
+                outfd = os.open(dname, os.O_WRONLY|os.O_CREAT|os.O_EXCL|os.O_CLOEXEC, 0o600, dir_fd=dfd)
+
+            # Like cp, don't write through existing hardlinks in the destination but replace them instead.
+            if os.fstat(outfd).st_nlink > 1:
+                os.close(outfd)
+                os.unlink(dname, dir_fd=dfd)
+                outfd = os.open(dname, os.O_WRONLY|os.O_CREAT|os.O_EXCL|os.O_CLOEXEC, 0o600, dir_fd=dfd)
+            else:
+                os.ftruncate(outfd, 0)
+
+            try:
+                copy_file_data(infd, outfd, st.st_size)
+
+                if self.preserve:
+                    chown_or_ignore(outfd, st.st_uid, st.st_gid)
+                    copy_xattrs(infd, outfd)
+
+                # Changing the ownership clears the setuid and setgid bits so only change the mode afterwards.
+                os.fchmod(outfd, stat.S_IMODE(st.st_mode))
+
+                if self.preserve:
+                    os.utime(outfd, ns=(st.st_atime_ns, st.st_mtime_ns))
+            finally:
+                os.close(outfd)
+        finally:
+            os.close(infd)
+
+
 def copy_tree(
     src: Path,
     dst: Path,
@@ -80,11 +602,16 @@ def copy_tree(
     preserve: bool = True,
     dereference: bool = False,
     use_subvolumes: ConfigFeature = ConfigFeature.disabled,
+    copy_tool: CopyTool = CopyTool.cp,
     sandbox: SandboxProtocol = nosandbox,
 ) -> Path:
     options: list[PathString] = ["--ro-bind", src, src, "--bind", dst.parent, dst.parent]
 
     def copy() -> None:
+        if copy_tool == CopyTool.native:
+            TreeCopier(src, dst, preserve=preserve, dereference=dereference).copy()
+            return
+
         cmdline: list[PathString] = [
             "cp",
             "--recursive",
@@ -113,9 +640,10 @@ def copy_tree(
         not is_subvolume(src) or
         (dst.exists() and (not dst.is_dir() or any(dst.iterdir())))
     ):
+        # The native copier restores the timestamps of existing directories itself.
         with (
             preserve_target_directories_stat(src, dst)
-            if not preserve
+            if not preserve and copy_tool == CopyTool.cp
             else contextlib.nullcontext()
         ):
             copy()
@@ -132,18 +660,267 @@ def copy_tree(
         sandbox=sandbox(binary="btrfs", options=options),
     ).returncode
 
+    # We only get here when preserving metadata, so there's no need to preserve the stat of target directories.
     if result != 0:
-        with (
-            preserve_target_directories_stat(src, dst)
-            if not preserve
-            else contextlib.nullcontext()
-        ):
-            copy()
+        copy()
 
     return dst
 
 
-def rmtree(*paths: Path, sandbox: SandboxProtocol = nosandbox) -> None:
+def is_trash_directory(trash: Path) -> bool:
+    """
+    Check whether the given trash directory can be used. Trash directories that aren't actual directories owned by
+    the current user, e.g. one created by another user in /var/tmp or a symlink, are never used or emptied.
+    """
+    try:
+        st = trash.lstat()
+    except OSError:
+        return False
+
+    return stat.S_ISDIR(st.st_mode) and st.st_uid == os.getuid()
+
+
+def trash_directory(path: Path) -> Optional[Path]:
+    """
+    Return the trash directory for the given path, which is located next to it so that the path can be moved into it
+    with a rename. None is returned if the trash directory can't be used.
+    """
+    trash = path.parent / TRASH_DIRECTORY
+
+    try:
+        with contextlib.suppress(FileExistsError):
+            trash.mkdir(mode=0o700)
+    except OSError:
+        return None
+
+    return trash if is_trash_directory(trash) else None
+
+
+def move_to_trash(path: Path) -> bool:
+    # Removing files and symlinks is cheap so only directories are moved to the trash.
+    if path.is_symlink() or not path.is_dir():
+        return False
+
+    if not (trash := trash_directory(path)):
+        return False
+
+    try:
+        os.rename(path, trash / f"{path.name}-{uuid.uuid4().hex}")
+    except OSError as e:
+        logging.debug(f"Failed to move {path} to {trash}, removing it in the foreground instead: {e}")
+        return False
+
+    return True
+
+
+class RemovedDirectory:
+    def __init__(self, name: str, parent: Optional["RemovedDirectory"]) -> None:
+        self.name = name
+        self.parent = parent
+        self.fd = -1
+        # The number of references to the directory: one for the directory itself and one for every subdirectory
+        # that hasn't been removed yet. The directory is removed when the last reference is dropped.
+        self.references = 1
+
+
+def remove_tree(path: Path) -> None:
+    """
+    Remove the given directory tree on a thread pool, with one task per directory. Every directory is opened and
+    removed relative to the file descriptor of its parent without following symlinks, so replacing a directory in the
+    tree with a symlink never redirects the removal outside of the tree. Unlike rm -rf, this doesn't fail if entries
+    disappear while the tree is being removed, as happens when multiple processes empty the same trash.
+    """
+    cond = threading.Condition()
+    # Directories are removed depth first so that only the directories above the ones that are being removed are kept
+    # open, instead of every directory in the tree.
+    todo = [RemovedDirectory(path.name, None)]
+    opened: set[RemovedDirectory] = set()
+    errors: list[BaseException] = []
+    busy = 0
+
+    topfd = os.open(path.parent, os.O_RDONLY|os.O_DIRECTORY|os.O_CLOEXEC)
+
+    def parentfd(d: RemovedDirectory) -> int:
+        return d.parent.fd if d.parent else topfd
+
+    def empty(d: RemovedDirectory) -> list[RemovedDirectory]:
+        try:
+            d.fd = os.open(d.name, os.O_RDONLY|os.O_DIRECTORY|os.O_NOFOLLOW|os.O_CLOEXEC, dir_fd=parentfd(d))
+        except FileNotFoundError:
+            return []
+        except OSError as e:
+            # The directory was replaced by a symlink or another file, so remove that instead.
+            if e.errno not in (errno.ELOOP, errno.ENOTDIR):
+                raise
+
+            with contextlib.suppress(FileNotFoundError):
+                os.unlink(d.name, dir_fd=parentfd(d))
+
+            return []
+
+        with cond:
+            opened.add(d)
+
+        subdirs = []
+
+        with os.scandir(d.fd) as it:
+            for entry in it:
+                if entry.is_dir(follow_symlinks=False):
+                    subdirs += [RemovedDirectory(entry.name, d)]
+                    continue
+
+                with contextlib.suppress(FileNotFoundError):
+                    os.unlink(entry.name, dir_fd=d.fd)
+
+        with cond:
+            d.references += len(subdirs)
+
+        return subdirs
+
+    def release(d: Optional[RemovedDirectory]) -> None:
+        while d:
+            with cond:
+                d.references -= 1
+                if d.references > 0:
+                    return
+
+                if d in opened:
+                    opened.remove(d)
+                    os.close(d.fd)
+
+            with contextlib.suppress(FileNotFoundError):
+                os.rmdir(d.name, dir_fd=parentfd(d))
+
+            d = d.parent
+
+    def work() -> None:
+        nonlocal busy
+
+        while True:
+            with cond:
+                cond.wait_for(lambda: todo or not busy or errors)
+                if errors or not todo:
+                    cond.notify_all()
+                    return
+
+                d = todo.pop()
+                busy += 1
+
+            subdirs: list[RemovedDirectory] = []
+
+            try:
+                subdirs = empty(d)
+                release(d)
+            except BaseException as e:
+                with cond:
+                    errors.append(e)
+
+            with cond:
+                todo.extend(subdirs)
+                busy -= 1
+                cond.notify_all()
+
+    threads = [threading.Thread(target=work, name=f"mkosi-rm-{i}") for i in range(min(32, (os.cpu_count() or 1) + 4))]
+
+    try:
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+    finally:
+        for d in opened:
+            os.close(d.fd)
+        os.close(topfd)
+
+    if errors:
+        raise errors[0]
+
+
+def clamp_mtime(index: TreeIndex, mtime: int, directory: Path = Path(".")) -> int:
+    """
+    Clamp the access and modification times of the given directory in the index, and everything below it, to mtime
+    (in nanoseconds) on a thread pool, with one task per directory. Entries are updated with utimensat() relative to
+    the file descriptor of their directory, and symlinks are not followed. The index is updated with the new
+    timestamps. Returns the number of entries that were modified.
+    """
+    clamped = 0
+
+    def clamp(st: os.stat_result, name: Union[int, str], dir_fd: Optional[int] = None) -> Optional[os.stat_result]:
+        times = (min(st.st_atime_ns, mtime), min(st.st_mtime_ns, mtime))
+        if times == (st.st_atime_ns, st.st_mtime_ns):
+            return None
+
+        os.utime(name, ns=times, dir_fd=dir_fd, follow_symlinks=dir_fd is None)
+        return os.stat(name, dir_fd=dir_fd, follow_symlinks=dir_fd is None)
+
+    def clamp_directory(d: Path) -> list[Path]:
+        nonlocal clamped
+        subdirs = []
+        updated = {}
+
+        fd = os.open(
+            index.root / d,
+            os.O_RDONLY|os.O_DIRECTORY|os.O_CLOEXEC|(os.O_NOFOLLOW if d != Path(".") else 0),
+        )
+        try:
+            for name in index.children.get(d, []):
+                st = index[d / name]
+                if stat.S_ISDIR(st.st_mode):
+                    subdirs += [d / name]
+                elif new := clamp(st, name, fd):
+                    updated[d / name] = new
+
+            # Directories are clamped through their own file descriptor so that every directory is only opened once.
+            # Use the directory's current stat as entries might have been added or removed since it was indexed.
+            if new := clamp(os.fstat(fd), fd):
+                updated[d] = new
+        finally:
+            os.close(fd)
+
+        with index.lock:
+            index.entries.update(updated)
+            clamped += len(updated)
+
+        return subdirs
+
+    if directory in index and stat.S_ISDIR(index[directory].st_mode):
+        walk_directories(directory, clamp_directory, name="mtime")
+
+    return clamped
+
+
+def empty_trash(*directories: Path) -> None:
+    """
+    Remove everything in the trash directories in the given directories in a detached process so that the current
+    process doesn't have to wait for it.
+    """
+    trashes = [t for d in directories if is_trash_directory(t := d / TRASH_DIRECTORY)]
+    if not trashes:
+        return
+
+    def empty() -> None:
+        for trash in trashes:
+            try:
+                # If another process is emptying the trash already, leave it to that process.
+                with flock(trash, fcntl.LOCK_EX|fcntl.LOCK_NB):
+                    while entries := list(trash.iterdir()):
+                        for p in entries:
+                            if p.is_dir() and not p.is_symlink():
+                                remove_tree(p)
+                            else:
+                                p.unlink(missing_ok=True)
+            except OSError as e:
+                if e.errno != errno.EWOULDBLOCK:
+                    logging.debug(f"Failed to empty {trash}: {e}")
+
+    fork_detached(empty)
+
+
+def rmtree(*paths: Path, sandbox: SandboxProtocol = nosandbox, background: bool = False) -> None:
+    """
+    Remove the given paths. If background is true, directories are moved into a trash directory next to them and
+    removed by a detached process instead, so that the caller doesn't have to wait until they are removed.
+    """
     if not paths:
         return
 
@@ -157,16 +934,42 @@ def rmtree(*paths: Path, sandbox: SandboxProtocol = nosandbox) -> None:
             stderr=subprocess.DEVNULL if not ARG_DEBUG.get() else None)
 
     filtered = sorted({p for p in paths if p.exists() or p.is_symlink()})
+
+    if background and (trashed := [p for p in filtered if move_to_trash(p)]):
+        filtered = [p for p in filtered if p not in trashed]
+        empty_trash(*{p.parent for p in trashed})
+
     if filtered:
         run(["rm", "-rf", "--", *filtered],
             sandbox=sandbox(binary="rm", options=flatten(("--bind", p.parent, p.parent) for p in filtered)))
 
 
+def exchange_tree(src: Path, dst: Path) -> bool:
+    """
+    Atomically replace dst with src by exchanging them with renameat2(RENAME_EXCHANGE), or by renaming src if dst
+    doesn't exist. Afterwards, src refers to the previous dst, if there was one. Returns False without changing
+    anything if src and dst are on different filesystems or if the filesystem can't exchange files.
+    """
+    try:
+        try:
+            renameat2(os.fspath(src), os.fspath(dst), RENAME_EXCHANGE)
+        except FileNotFoundError:
+            src.rename(dst)
+    except OSError as e:
+        if e.errno not in (errno.EXDEV, errno.EINVAL, errno.ENOSYS):
+            raise e
+
+        return False
+
+    return True
+
+
 def move_tree(
     src: Path,
     dst: Path,
     *,
     use_subvolumes: ConfigFeature = ConfigFeature.disabled,
+    copy_tool: CopyTool = CopyTool.cp,
     sandbox: SandboxProtocol = nosandbox
 ) -> Path:
     if src == dst:
@@ -184,7 +987,7 @@ def move_tree(
         logging.info(
             f"Could not rename {src} to {dst} as they are located on different devices, falling back to copying"
         )
-        copy_tree(src, dst, use_subvolumes=use_subvolumes, sandbox=sandbox)
+        copy_tree(src, dst, use_subvolumes=use_subvolumes, copy_tool=copy_tool, sandbox=sandbox)
         rmtree(src, sandbox=sandbox)
 
     return dst
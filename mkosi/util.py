@@ -17,10 +17,11 @@ import re
 import resource
 import stat
 import tempfile
+import threading
 from collections.abc import Hashable, Iterable, Iterator, Mapping, Sequence
 from pathlib import Path
 from types import ModuleType
-from typing import Any, Callable, Optional, TypeVar, no_type_check
+from typing import IO, Any, Callable, Optional, TypeVar, no_type_check
 
 from mkosi.log import die
 from mkosi.types import PathString
@@ -126,8 +127,8 @@ def make_executable(*paths: Path) -> None:
 
 
 @contextlib.contextmanager
-def flock(path: Path, flags: int = fcntl.LOCK_EX) -> Iterator[int]:
-    fd = os.open(path, os.O_CLOEXEC|os.O_RDONLY)
+def flock(path: Path, flags: int = fcntl.LOCK_EX, *, create: bool = False) -> Iterator[int]:
+    fd = os.open(path, os.O_CLOEXEC|os.O_RDONLY|(os.O_CREAT if create else 0), 0o644)
     try:
         fcntl.fcntl(fd, fcntl.FD_CLOEXEC)
         logging.debug(f"Acquiring lock on {path}")
@@ -138,6 +139,33 @@ def flock(path: Path, flags: int = fcntl.LOCK_EX) -> Iterator[int]:
         os.close(fd)
 
 
+def evict_cache_entries(directory: Path, pattern: str, *, keep: int) -> None:
+    """
+    Remove all but the given number of most recently used files in the given directory that match the given glob
+    pattern. Entries are considered used when their modification time was last updated, so callers should bump it
+    whenever they reuse an entry. Entries with a lock file (the same path with a .lock suffix) are only removed if no
+    other process holds the lock. The lock file itself is never removed, as another process might be about to lock
+    it, and removing it would allow two processes to hold a lock on different inodes for the same entry.
+    """
+    entries = []
+    for p in directory.glob(pattern):
+        try:
+            entries += [(p.stat().st_mtime_ns, p)]
+        except FileNotFoundError:
+            pass
+
+    for _, p in sorted(entries, reverse=True)[keep:]:
+        lock = p.with_suffix(".lock")
+
+        try:
+            with flock(lock, fcntl.LOCK_EX|fcntl.LOCK_NB) if lock.exists() else contextlib.nullcontext():
+                logging.debug(f"Evicting cache entry {p}")
+                p.unlink(missing_ok=True)
+        except OSError as e:
+            if e.errno not in (errno.EWOULDBLOCK, errno.ENOENT):
+                raise e
+
+
 @contextlib.contextmanager
 def flock_or_die(path: Path) -> Iterator[Path]:
     try:
@@ -311,6 +339,81 @@ def hash_file(path: Path) -> str:
     return h.hexdigest()
 
 
+def copy_file_contents(src: Path, dst: IO[bytes]) -> int:
+    """
+    Append the contents of src to dst at its current offset without copying them through userspace where possible and
+    return the number of bytes that were copied.
+    """
+    dst.flush()
+    copied = 0
+
+    with src.open("rb") as f:
+        try:
+            while n := os.copy_file_range(f.fileno(), dst.fileno(), 1024**3):
+                copied += n
+        except OSError as e:
+            # Not all filesystems (and kernels) support copy_file_range(), in which case we copy the remainder
+            # ourselves.
+            if e.errno not in (errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP):
+                raise
+
+            while b := f.read(1024**2):
+                dst.write(b)
+                copied += len(b)
+
+    return copied
+
+
+class HashingTee:
+    """
+    A pipe whose contents are written to the given file while their SHA256 digest is calculated. The write end of the
+    pipe is returned when entering the context manager and is meant to be passed as stdout to a subprocess. After the
+    context manager exits, the digest of everything that was written is available from hexdigest().
+    """
+
+    def __init__(self, output: IO[bytes]) -> None:
+        self.output = output
+        self.hash = hashlib.sha256()
+        self.error: Optional[BaseException] = None
+        self.thread: Optional[threading.Thread] = None
+        self.rfd = self.wfd = -1
+
+    def copy(self) -> None:
+        b = bytearray(1024**2)
+        mv = memoryview(b)
+
+        try:
+            with open(self.rfd, "rb", buffering=0, closefd=False) as f:
+                while n := f.readinto(mv):
+                    self.hash.update(mv[:n])
+                    self.output.write(mv[:n])
+        except BaseException as e:
+            self.error = e
+            # Keep draining the pipe so that the writer doesn't block forever.
+            while os.read(self.rfd, len(b)):
+                pass
+
+    def __enter__(self) -> int:
+        self.rfd, self.wfd = os.pipe2(os.O_CLOEXEC)
+        self.thread = threading.Thread(target=self.copy, name="hashing-tee", daemon=True)
+        self.thread.start()
+        return self.wfd
+
+    def __exit__(self, *args: object, **kwargs: object) -> None:
+        os.close(self.wfd)
+        assert self.thread
+        self.thread.join()
+        os.close(self.rfd)
+
+        if self.error:
+            raise self.error
+
+        self.output.flush()
+
+    def hexdigest(self) -> str:
+        return self.hash.hexdigest()
+
+
 def try_or(fn: Callable[..., T], exception: type[Exception], default: T) -> T:
     try:
         return fn()
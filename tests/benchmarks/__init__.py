@@ -0,0 +1,375 @@
+# SPDX-License-Identifier: LGPL-2.1-or-later
+
+import contextlib
+import dataclasses
+import lzma
+import os
+import random
+import shutil
+import subprocess
+import textwrap
+from collections.abc import Iterator
+from pathlib import Path
+from typing import Callable, Optional
+from unittest import mock
+
+from mkosi.archive import make_cpio
+from mkosi.config import Config, CopyTool, parse_config
+from mkosi.kmod import read_modules_info, resolve_module_dependencies
+from mkosi.tree import TreeIndex, clamp_mtime, copy_tree, rmtree
+from mkosi.types import CompletedProcess
+from mkosi.util import chdir, hash_file
+from mkosi.versioncomp import GenericVersion
+from tests.helpers import make_elf_module
+
+
+@dataclasses.dataclass(frozen=True)
+class Timed:
+    # The function to time.
+    run: Callable[[], None]
+    # An optional function that is called untimed before every iteration.
+    setup: Optional[Callable[[], None]] = None
+
+
+# A benchmark is a context manager that sets up its fixtures in the given directory, scaled by the given factor, and
+# yields the function to time.
+BenchmarkFunction = Callable[[Path, float], contextlib.AbstractContextManager[Timed]]
+
+
+@dataclasses.dataclass(frozen=True)
+class Benchmark:
+    name: str
+    function: BenchmarkFunction
+    iterations: int = 5
+    # The name of a binary that is required to run the benchmark.
+    requires: Optional[str] = None
+
+
+BENCHMARKS: list[Benchmark] = []
+
+
+def benchmark(
+    name: str,
+    *,
+    iterations: int = 5,
+    requires: Optional[str] = None,
+) -> Callable[[Callable[[Path, float], Iterator[Timed]]], BenchmarkFunction]:
+    def decorator(f: Callable[[Path, float], Iterator[Timed]]) -> BenchmarkFunction:
+        cm = contextlib.contextmanager(f)
+        BENCHMARKS.append(Benchmark(name=name, function=cm, iterations=iterations, requires=requires))
+        return cm
+
+    return decorator
+
+
+def make_file_tree(root: Path, nfiles: int, *, fanout: int = 100) -> None:
+    """Create a tree with the given number of small files spread over nested directories."""
+    root.mkdir()
+
+    for i in range(nfiles):
+        d = root / f"d{i // fanout // fanout:03}" / f"d{i // fanout % fanout:03}"
+        if i % fanout == 0:
+            d.mkdir(parents=True, exist_ok=True)
+
+        (d / f"f{i}").write_bytes(b"x" * (i % 512))
+
+        if i % 1000 == 0:
+            (d / f"l{i}").symlink_to(f"f{i}")
+
+
+def make_modules_tree(root: Path, kver: str, nmodules: int, nfirmware: int, *, depmod: bool = False) -> str:
+    """
+    Create a fake root directory with kernel modules and firmware files and return the output modinfo would produce
+    for all the kernel modules. If depmod is true, the modules.dep and modules.softdep indexes are written as well.
+    """
+    rng = random.Random(0)
+
+    modulesd = root / "usr/lib/modules" / kver
+    firmwared = root / "usr/lib/firmware"
+    names = [f"mod_{i}" for i in range(nmodules)]
+    info = []
+    dep = []
+    softdeps = []
+
+    for i, name in enumerate(names):
+        d = modulesd / "kernel" / f"subsys{i % 50}"
+        d.mkdir(parents=True, exist_ok=True)
+        (d / f"{name}.ko.xz").touch()
+
+        depends = rng.sample(names[:i], min(i, rng.randint(0, 4)))
+        softdep = rng.sample(names[:i], min(i, rng.randint(0, 1)))
+        firmware = [f"vendor{i % 20}/fw{i}.bin"] if i % 3 == 0 else []
+
+        info += [
+            f"filename:       /{d.relative_to(root)}/{name}.ko.xz",
+            f"depends:        {','.join(depends)}",
+            *(f"softdep:        pre: {' '.join(softdep)}" for _ in [None] if softdep),
+            *(f"firmware:       {fw}" for fw in firmware),
+            f"name:           {name}",
+        ]
+
+        # depmod writes the full set of indirect dependencies but direct dependencies suffice for benchmarking.
+        subsys = {n: f"kernel/subsys{int(n.partition('_')[2]) % 50}" for n in [name, *depends]}
+        dep += [f"{subsys[name]}/{name}.ko.xz: {' '.join(f'{subsys[d]}/{d}.ko.xz' for d in depends)}"]
+        if softdep:
+            softdeps += [f"softdep {name} pre: {' '.join(softdep)}"]
+
+    for i in range(nfirmware):
+        d = firmwared / f"vendor{i % 20}"
+        d.mkdir(parents=True, exist_ok=True)
+        (d / f"fw{i}.bin.xz").touch()
+
+    (modulesd / "modules.builtin").write_text("\n".join(f"kernel/builtin/builtin_{i}.ko" for i in range(100)))
+
+    if depmod:
+        (modulesd / "modules.dep").write_text("\n".join(dep) + "\n")
+        (modulesd / "modules.softdep").write_text("\n".join(softdeps) + "\n")
+
+    return "\0".join(info)
+
+
+@benchmark("parse_config", iterations=5)
+def bench_parse_config(directory: Path, scale: float) -> Iterator[Timed]:
+    (directory / "mkosi.conf").write_text(
+        textwrap.dedent(
+            """\
+            [Distribution]
+            Distribution=fedora
+
+            [Output]
+            ImageId=benchmark
+            """
+        )
+    )
+
+    (directory / "mkosi.conf.d").mkdir()
+
+    for i in range(int(500 * scale)):
+        (directory / "mkosi.conf.d" / f"{i:04}.conf").write_text(
+            textwrap.dedent(
+                f"""\
+                [Match]
+                Distribution=fedora
+
+                [Content]
+                Packages=package-{i}
+                         other-package-{i}
+                BuildPackages=build-package-{i}
+                Environment=VAR{i}=value{i}
+                RemoveFiles=/usr/share/doc/package-{i}
+                """
+            )
+        )
+
+    def run() -> None:
+        with chdir(directory):
+            parse_config(["summary"])
+
+    yield Timed(run)
+
+
+@benchmark("resolve_module_dependencies", iterations=5)
+def bench_resolve_module_dependencies(directory: Path, scale: float) -> Iterator[Timed]:
+    kver = "6.0.0-benchmark"
+    info = make_modules_tree(directory, kver, int(6000 * scale), int(3000 * scale))
+    modules = [f"mod_{i}" for i in range(0, int(6000 * scale), 10)]
+
+    # There's no modinfo that can parse our fake kernel modules so we replay the output modinfo would produce. This
+    # means the time spent in modinfo itself is not included in the result.
+    def modinfo(cmdline: list[str], *args: object, **kwargs: object) -> CompletedProcess:
+        return CompletedProcess(cmdline, 0, info, "")
+
+    def run() -> None:
+        with mock.patch("mkosi.kmod.run", modinfo):
+            resolve_module_dependencies(directory, kver, modules)
+
+    yield Timed(run)
+
+
+@benchmark("resolve_module_dependencies (depmod)", iterations=5)
+def bench_resolve_module_dependencies_depmod(directory: Path, scale: float) -> Iterator[Timed]:
+    kver = "6.0.0-benchmark"
+    info = make_modules_tree(directory, kver, int(6000 * scale), int(3000 * scale), depmod=True)
+    modules = [f"mod_{i}" for i in range(0, int(6000 * scale), 10)]
+
+    def modinfo(cmdline: list[str], *args: object, **kwargs: object) -> CompletedProcess:
+        return CompletedProcess(cmdline, 0, info, "")
+
+    def run() -> None:
+        with mock.patch("mkosi.kmod.run", modinfo):
+            resolve_module_dependencies(directory, kver, modules)
+
+    yield Timed(run)
+
+
+@benchmark("resolve_module_dependencies (cached)", iterations=5)
+def bench_resolve_module_dependencies_cached(directory: Path, scale: float) -> Iterator[Timed]:
+    kver = "6.0.0-benchmark"
+    info = make_modules_tree(directory / "root", kver, int(6000 * scale), int(3000 * scale))
+    modules = [f"mod_{i}" for i in range(0, int(6000 * scale), 10)]
+
+    def modinfo(cmdline: list[str], *args: object, **kwargs: object) -> CompletedProcess:
+        return CompletedProcess(cmdline, 0, info, "")
+
+    # Populate the cache so that every timed iteration only has to validate it.
+    with mock.patch("mkosi.kmod.run", modinfo):
+        resolve_module_dependencies(directory / "root", kver, modules, cache=directory / "cache")
+
+    def run() -> None:
+        with mock.patch("mkosi.kmod.run", modinfo):
+            resolve_module_dependencies(directory / "root", kver, modules, cache=directory / "cache")
+
+    yield Timed(run)
+
+
+def make_elf_modules(root: Path, nmodules: int) -> list[Path]:
+    """Create xz compressed kernel modules with a realistic amount of padding around their .modinfo section."""
+    modules = []
+
+    for i in range(nmodules):
+        m = Path(f"usr/lib/modules/6.0.0-benchmark/kernel/subsys{i % 50}/mod_{i}.ko.xz")
+        (root / m).parent.mkdir(parents=True, exist_ok=True)
+
+        elf = make_elf_module(
+            [
+                ("license", "GPL"),
+                *((("firmware", f"vendor{i % 20}/fw{i}.bin"),) if i % 3 == 0 else ()),
+                ("depends", ",".join(f"mod_{d}" for d in range(max(0, i - 3), i))),
+                ("name", f"mod_{i}"),
+            ]
+        )
+        # Real modules carry code and data as well, which have to be decompressed too.
+        (root / m).write_bytes(lzma.compress(elf + os.urandom(2048) + bytes(64 * 1024), preset=1))
+        modules += [m]
+
+    return modules
+
+
+@benchmark("read_modules_info", iterations=3)
+def bench_read_modules_info(directory: Path, scale: float) -> Iterator[Timed]:
+    modules = make_elf_modules(directory, int(6000 * scale))
+
+    def run() -> None:
+        info, unsupported = read_modules_info(directory, modules)
+        assert not unsupported
+
+    yield Timed(run)
+
+
+@benchmark("modinfo", iterations=3, requires="modinfo")
+def bench_modinfo(directory: Path, scale: float) -> Iterator[Timed]:
+    modules = make_elf_modules(directory, int(6000 * scale))
+
+    # The same chunked invocation as run_modinfo() but without the chroot, since the generated tree doesn't contain a
+    # modinfo binary.
+    def run() -> None:
+        for i in range(0, len(modules), 4000):
+            subprocess.run(
+                ["modinfo", "--null", *(directory / m for m in modules[i:i + 4000])],
+                stdout=subprocess.DEVNULL,
+                check=True,
+            )
+
+    yield Timed(run)
+
+
+@benchmark("copy_tree", iterations=3)
+def bench_copy_tree(directory: Path, scale: float) -> Iterator[Timed]:
+    make_file_tree(directory / "src", int(200_000 * scale))
+
+    def run() -> None:
+        copy_tree(directory / "src", directory / "dst")
+        shutil.rmtree(directory / "dst")
+
+    yield Timed(run)
+
+
+@benchmark("copy_tree (native)", iterations=3)
+def bench_copy_tree_native(directory: Path, scale: float) -> Iterator[Timed]:
+    make_file_tree(directory / "src", int(200_000 * scale))
+
+    def run() -> None:
+        copy_tree(directory / "src", directory / "dst", copy_tool=CopyTool.native)
+        shutil.rmtree(directory / "dst")
+
+    yield Timed(run)
+
+
+@benchmark("rmtree", iterations=3)
+def bench_rmtree(directory: Path, scale: float) -> Iterator[Timed]:
+    make_file_tree(directory / "src", int(200_000 * scale))
+
+    # Removing the tree destroys it so we time removing a copy of the tree, which we create before every iteration.
+    def run() -> None:
+        rmtree(directory / "dst")
+
+    def setup() -> None:
+        subprocess.run(["cp", "--recursive", "--reflink=auto", directory / "src", directory / "dst"], check=True)
+
+    yield Timed(run, setup)
+
+
+@benchmark("normalize_mtime", iterations=3)
+def bench_normalize_mtime(directory: Path, scale: float) -> Iterator[Timed]:
+    make_file_tree(directory / "root", int(200_000 * scale))
+
+    # Use an earlier timestamp every iteration so that every entry has to be clamped again.
+    mtime = 1_000_000_000
+
+    def run() -> None:
+        nonlocal mtime
+        clamp_mtime(TreeIndex.scan(directory / "root"), mtime * 1_000_000_000)
+        mtime -= 1
+
+    yield Timed(run)
+
+
+@benchmark("make_cpio", iterations=3)
+def bench_make_cpio(directory: Path, scale: float) -> Iterator[Timed]:
+    make_file_tree(directory / "root", int(50_000 * scale))
+
+    def run() -> None:
+        make_cpio(directory / "root", directory / "root.cpio")
+
+    yield Timed(run)
+
+
+@benchmark("hash_file", iterations=3)
+def bench_hash_file(directory: Path, scale: float) -> Iterator[Timed]:
+    path = directory / "sparse.raw"
+
+    with path.open("wb") as f:
+        f.truncate(int(4 * 1024**3 * scale))
+        f.write(os.urandom(1024**2))
+
+    def run() -> None:
+        hash_file(path)
+
+    yield Timed(run)
+
+
+@benchmark("GenericVersion.sort", iterations=5)
+def bench_generic_version_sort(directory: Path, scale: float) -> Iterator[Timed]:
+    rng = random.Random(0)
+    versions = [
+        f"{rng.randint(0, 300)}.{rng.randint(0, 50)}.{rng.randint(0, 20)}"
+        f"{rng.choice(['', '~rc1', '-1.fc40', '+git20240101', '^post1', 'a', '.b3'])}"
+        for _ in range(int(20_000 * scale))
+    ]
+
+    def run() -> None:
+        sorted(versions, key=GenericVersion)
+
+    yield Timed(run)
+
+
+@benchmark("Config.to_json/from_json", iterations=5)
+def bench_config_json(directory: Path, scale: float) -> Iterator[Timed]:
+    with chdir(directory):
+        _, [config] = parse_config(["--distribution", "fedora", "--package", "foo,bar,baz", "build"])
+
+    def run() -> None:
+        for _ in range(int(100 * scale)):
+            Config.from_json(config.to_json())
+
+    yield Timed(run)
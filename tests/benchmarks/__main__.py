@@ -0,0 +1,126 @@
+# SPDX-License-Identifier: LGPL-2.1-or-later
+
+import argparse
+import datetime
+import json
+import logging
+import platform
+import statistics
+import sys
+import tempfile
+import time
+from pathlib import Path
+from typing import Any
+
+from mkosi.log import log_setup
+from mkosi.run import find_binary
+from mkosi.sandbox import __version__
+
+from . import BENCHMARKS, Benchmark
+
+
+def run_benchmark(benchmark: Benchmark, *, scale: float, iterations: int, workspace: Path) -> dict[str, Any]:
+    timings = []
+
+    with (
+        tempfile.TemporaryDirectory(dir=workspace, prefix="mkosi-benchmark-") as d,
+        benchmark.function(Path(d), scale) as timed,
+    ):
+        for _ in range(iterations):
+            if timed.setup:
+                timed.setup()
+
+            start = time.perf_counter()
+            timed.run()
+            timings.append(time.perf_counter() - start)
+
+    return {
+        "iterations": iterations,
+        "min": min(timings),
+        "max": max(timings),
+        "mean": statistics.mean(timings),
+        "median": statistics.median(timings),
+        "timings": timings,
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        prog="python3 -m tests.benchmarks",
+        description="Run offline benchmarks of mkosi's hot paths",
+    )
+    parser.add_argument(
+        "-o", "--output",
+        metavar="PATH",
+        help="Write the results as JSON to the given path",
+        type=Path,
+    )
+    parser.add_argument(
+        "-s", "--scale",
+        metavar="FACTOR",
+        help="Scale the size of the generated fixtures by the given factor",
+        type=float,
+        default=1.0,
+    )
+    parser.add_argument(
+        "-n", "--iterations",
+        metavar="N",
+        help="Override the number of timed iterations of every benchmark",
+        type=int,
+    )
+    parser.add_argument(
+        "-k", "--only",
+        metavar="NAME",
+        help="Only run the benchmarks with the given names",
+        action="append",
+        default=[],
+    )
+    parser.add_argument(
+        "-w", "--workspace",
+        metavar="PATH",
+        help="Directory to generate the fixtures in",
+        type=Path,
+        default=Path(tempfile.gettempdir()),
+    )
+    args = parser.parse_args()
+
+    log_setup()
+
+    results: dict[str, Any] = {}
+
+    for benchmark in BENCHMARKS:
+        if args.only and benchmark.name not in args.only:
+            continue
+
+        if benchmark.requires and not find_binary(benchmark.requires):
+            logging.warning(f"Skipping {benchmark.name} as {benchmark.requires} is not installed")
+            continue
+
+        logging.info(f"Running {benchmark.name}")
+        r = run_benchmark(
+            benchmark,
+            scale=args.scale,
+            iterations=args.iterations or benchmark.iterations,
+            workspace=args.workspace,
+        )
+        logging.info(f"{benchmark.name}: min {r['min']:.3f}s, median {r['median']:.3f}s, max {r['max']:.3f}s")
+        results[benchmark.name] = r
+
+    report = {
+        "mkosi": __version__,
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "timestamp": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        "scale": args.scale,
+        "benchmarks": results,
+    }
+
+    if args.output:
+        args.output.write_text(json.dumps(report, indent=4) + "\n")
+    else:
+        json.dump(report, sys.stdout, indent=4)
+        sys.stdout.write("\n")
+
+
+if __name__ == "__main__":
+    main()
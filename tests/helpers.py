@@ -0,0 +1,27 @@
+# SPDX-License-Identifier: LGPL-2.1-or-later
+
+import struct
+
+
+def make_elf_module(fields: list[tuple[str, str]], *, is64: bool = True, endian: str = "<") -> bytes:
+    """Create a minimal relocatable ELF object with a .modinfo section like the ones found in kernel modules."""
+    modinfo = b"".join(f"{k}={v}".encode() + b"\0" for k, v in fields) + b"\0" * 3
+    shstrtab = b"\0.modinfo\0.shstrtab\0"
+
+    ehsize, shentsize = (64, 64) if is64 else (52, 40)
+    shoff = ehsize + len(modinfo) + len(shstrtab)
+    shdr = f"{endian}IIQQQQIIQQ" if is64 else f"{endian}IIIIIIIIII"
+
+    header = b"\x7fELF" + bytes([2 if is64 else 1, 1 if endian == "<" else 2, 1]) + bytes(9)
+    header += struct.pack(f"{endian}HHI", 1, 62, 1)
+    header += struct.pack(f"{endian}QQQ" if is64 else f"{endian}III", 0, 0, shoff)
+    header += struct.pack(f"{endian}IHHHHHH", 0, ehsize, 0, 0, shentsize, 3, 2)
+    assert len(header) == ehsize
+
+    sections = [
+        struct.pack(shdr, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0),
+        struct.pack(shdr, 1, 1, 2, 0, ehsize, len(modinfo), 0, 0, 1, 0),
+        struct.pack(shdr, 10, 3, 0, 0, ehsize + len(modinfo), len(shstrtab), 0, 0, 1, 0),
+    ]
+
+    return header + modinfo + shstrtab + b"".join(sections)
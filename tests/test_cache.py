@@ -0,0 +1,445 @@
+# SPDX-License-Identifier: LGPL-2.1-or-later
+
+import dataclasses
+import json
+import os
+import shutil
+from collections.abc import Iterator
+from pathlib import Path
+from typing import Any
+from unittest import mock
+
+import pytest
+
+import mkosi
+from mkosi import (
+    DEFAULT_INITRD_CACHE_ENTRIES,
+    KERNEL_MODULES_INITRD_CACHE_ENTRIES,
+    MICROCODE_INITRD_CACHE_ENTRIES,
+    CacheStage,
+    build_default_initrd,
+    build_kernel_modules_initrd,
+    build_microcode_initrd,
+    cache_manifest_delta,
+    cache_tree_paths,
+    finalize_cache_stages,
+    have_cache_overlay,
+    install_distribution_packages,
+    install_sandbox_trees,
+    mount_cache_overlay,
+    run_cache_stages,
+    unmount_cache_overlay,
+    want_cache_overlay,
+)
+from mkosi.archive import make_cpio
+from mkosi.config import Config, ConfigFeature, JsonEncoder, OutputFormat, parse_config
+from mkosi.context import Context
+from mkosi.run import fork_and_wait
+from mkosi.sandbox import CLONE_NEWNS, MS_REC, MS_SLAVE, mount, unshare
+from mkosi.tree import TRASH_DIRECTORY, rmtree
+from mkosi.util import chdir, flock
+
+KVER = "6.0.0"
+
+
+@pytest.fixture
+def context(tmp_path: Path) -> Iterator[Context]:
+    with chdir(tmp_path):
+        args, images = parse_config(["--distribution", "fedora", "--cache-dir", os.fspath(tmp_path / "cache")])
+
+    workspace = tmp_path / "workspace"
+    workspace.mkdir()
+
+    yield Context(
+        args,
+        images[-1],
+        workspace=workspace,
+        resources=Path(mkosi.__file__).parent / "resources",
+        metadata_dir=tmp_path / "metadata",
+    )
+
+
+def fresh(context: Context) -> None:
+    """
+    Forget the outputs of the previous build so that the next build has to consult the cache. Also make all cache
+    entries a second older so that their order doesn't depend on the timestamp granularity of the file system.
+    """
+    for p in context.workspace.iterdir():
+        if p.is_file():
+            p.unlink()
+
+    assert context.config.cache_dir
+    for p in context.config.cache_dir.glob("*.initrd"):
+        st = p.stat()
+        os.utime(p, ns=(st.st_atime_ns, st.st_mtime_ns - 1_000_000_000))
+
+
+def test_kernel_modules_initrd_cache(context: Context) -> None:
+    files = [Path("usr/lib/modules") / KVER / "kernel/foo.ko", Path("usr/lib/firmware/fw.bin")]
+    for f in files:
+        (context.root / f).parent.mkdir(parents=True, exist_ok=True)
+        (context.root / f).write_text(f.name)
+
+    builds = []
+
+    def make_cpio(src: Path, dst: Path, *args: Any, **kwargs: Any) -> None:
+        builds.append(dst)
+        dst.write_text(f"initrd {len(builds)}")
+
+    with (
+        mock.patch("mkosi.gen_required_kernel_modules", return_value=iter(files)) as gen,
+        mock.patch("mkosi.make_cpio", make_cpio),
+    ):
+        kmods = build_kernel_modules_initrd(context, KVER)
+        assert kmods.read_text() == "initrd 1"
+        assert context.config.cache_dir
+        entries = list(context.config.cache_dir.glob("kernel-modules-*.initrd"))
+        assert len(entries) == 1
+
+        # The same modules are served from the cache.
+        fresh(context)
+        gen.return_value = iter(files)
+        assert build_kernel_modules_initrd(context, KVER).read_text() == "initrd 1"
+        assert len(builds) == 1
+
+        # Modifying one of the files changes the key but doesn't evict the entry of the unmodified files, which might
+        # still be used by another image sharing the cache directory.
+        st = (context.root / files[0]).stat()
+        os.utime(context.root / files[0], ns=(0, 0))
+        fresh(context)
+        gen.return_value = iter(files)
+        assert build_kernel_modules_initrd(context, KVER).read_text() == "initrd 2"
+        assert entries[0].exists()
+        assert len(list(context.config.cache_dir.glob("kernel-modules-*.initrd"))) == 2
+
+        os.utime(context.root / files[0], ns=(st.st_atime_ns, st.st_mtime_ns))
+        fresh(context)
+        gen.return_value = iter(files)
+        assert build_kernel_modules_initrd(context, KVER).read_text() == "initrd 1"
+        assert len(builds) == 2
+
+        # Every kernel version gets its own entry but only the most recently used entries are kept.
+        for i in range(KERNEL_MODULES_INITRD_CACHE_ENTRIES):
+            fresh(context)
+            gen.return_value = iter(files)
+            build_kernel_modules_initrd(context, f"6.{i + 1}.0")
+
+        entries = list(context.config.cache_dir.glob("kernel-modules-*.initrd"))
+        assert len(entries) == KERNEL_MODULES_INITRD_CACHE_ENTRIES
+        assert not list(context.config.cache_dir.glob(f"kernel-modules-{KVER}-*.initrd"))
+
+
+def update_metadata(context: Context, contents: str) -> None:
+    subdir = context.config.distribution.package_manager(context.config).subdir(context.config)
+    (context.metadata_dir / "lib" / subdir).mkdir(parents=True, exist_ok=True)
+    (context.metadata_dir / "lib" / subdir / "repomd.xml").write_text(contents)
+    mkosi.directory_digest.cache_clear()
+
+
+def test_default_initrd_cache(context: Context) -> None:
+    builds = []
+
+    def build_default_initrd_image(context: Context, config: Config) -> None:
+        assert config.output_dir
+        builds.append(config)
+        (config.output_dir / config.output).write_text(f"initrd {len(builds)}")
+
+    assert context.config.cache_dir
+
+    with mock.patch("mkosi.build_default_initrd_image", build_default_initrd_image):
+        assert build_default_initrd(context).read_text() == "initrd 1"
+        entries = list(context.config.cache_dir.glob("default-initrd-*.initrd"))
+        assert len(entries) == 1
+        assert entries[0].with_suffix(".lock").exists()
+
+        # Another build with the same configuration and repository metadata reuses the cached initrd.
+        fresh(context)
+        assert build_default_initrd(context).read_text() == "initrd 1"
+        assert len(builds) == 1
+
+        # The repository metadata determines the packages the initrd is built from so it's part of the key.
+        update_metadata(context, "metadata")
+        fresh(context)
+        assert build_default_initrd(context).read_text() == "initrd 2"
+        assert len(list(context.config.cache_dir.glob("default-initrd-*.initrd"))) == 2
+
+        # Entries that are locked by a concurrent build are never evicted.
+        for i in range(DEFAULT_INITRD_CACHE_ENTRIES):
+            update_metadata(context, f"metadata {i}")
+            fresh(context)
+
+            with flock(entries[0].with_suffix(".lock")):
+                build_default_initrd(context)
+
+        assert entries[0].exists()
+        assert len(list(context.config.cache_dir.glob("default-initrd-*.initrd"))) == DEFAULT_INITRD_CACHE_ENTRIES + 1
+
+        update_metadata(context, "metadata final")
+        fresh(context)
+        build_default_initrd(context)
+        assert not entries[0].exists()
+        assert len(list(context.config.cache_dir.glob("default-initrd-*.initrd"))) == DEFAULT_INITRD_CACHE_ENTRIES
+
+        # Lock files are never evicted as another build might be about to lock them.
+        lock = entries[0].with_suffix(".lock")
+        assert lock.exists()
+        ino = lock.stat().st_ino
+        shutil.rmtree(context.metadata_dir)
+        mkosi.directory_digest.cache_clear()
+        fresh(context)
+        build_default_initrd(context)
+        assert entries[0].exists()
+        assert lock.stat().st_ino == ino
+
+        # A missing lock file is created when locking it.
+        lock.unlink()
+        entries[0].unlink()
+        fresh(context)
+        build_default_initrd(context)
+        assert entries[0].exists() and lock.exists()
+
+
+def test_microcode_initrd_cache(context: Context) -> None:
+    amd = context.root / "usr/lib/firmware/amd-ucode"
+    amd.mkdir(parents=True)
+    (amd / "microcode_amd.bin").write_bytes(b"amd")
+    (amd / "microcode_amd_fam17h.bin").write_bytes(b"fam17h")
+    st = (amd / "microcode_amd_fam17h.bin").stat()
+
+    assert context.config.cache_dir
+
+    with mock.patch("mkosi.make_cpio", wraps=make_cpio) as cpio:
+        [microcode] = build_microcode_initrd(context)
+        contents = microcode.read_bytes()
+        assert b"kernel/x86/microcode/AuthenticAMD.bin" in contents
+        assert b"amdfam17h" in contents
+        entries = list(context.config.cache_dir.glob("microcode-all-*.initrd"))
+        assert len(entries) == 1
+
+        fresh(context)
+        assert build_microcode_initrd(context) == [microcode]
+        assert microcode.read_bytes() == contents
+        assert cpio.call_count == 1
+
+        # Updated firmware changes the key but doesn't evict the entry of the old firmware, which might still be used
+        # by another image sharing the cache directory.
+        (amd / "microcode_amd_fam17h.bin").write_bytes(b"fam17h v2")
+        fresh(context)
+        assert b"amdfam17h v2" in build_microcode_initrd(context)[0].read_bytes()
+        assert cpio.call_count == 2
+        assert entries[0].exists()
+        assert len(list(context.config.cache_dir.glob("microcode-all-*.initrd"))) == 2
+
+        (amd / "microcode_amd_fam17h.bin").write_bytes(b"fam17h")
+        os.utime(amd / "microcode_amd_fam17h.bin", ns=(st.st_atime_ns, st.st_mtime_ns))
+        fresh(context)
+        assert build_microcode_initrd(context)[0].read_bytes() == contents
+        assert cpio.call_count == 2
+
+        # Only the most recently used entries are kept.
+        for i in range(MICROCODE_INITRD_CACHE_ENTRIES):
+            (amd / "microcode_amd_fam17h.bin").write_bytes(f"fam17h v{i + 3}".encode())
+            fresh(context)
+            build_microcode_initrd(context)
+
+        assert len(list(context.config.cache_dir.glob("microcode-all-*.initrd"))) == MICROCODE_INITRD_CACHE_ENTRIES
+        assert not entries[0].exists()
+
+
+def test_cache_manifest_delta(context: Context) -> None:
+    def manifest(**overrides: Any) -> dict[str, Any]:
+        m: dict[str, Any] = json.loads(json.dumps(context.config.cache_manifest(), cls=JsonEncoder))
+        return m | {"packages": ["bash", "systemd=255"], "build_packages": ["gcc"]} | overrides
+
+    prev = manifest()
+    assert cache_manifest_delta(prev, manifest()) == ([], [])
+
+    # Packages that were only added are installed on top of the cached images.
+    assert cache_manifest_delta(prev, manifest(packages=["bash", "systemd=255", "vim"])) == (["vim"], [])
+    assert cache_manifest_delta(prev, manifest(build_packages=["gcc", "make", "cmake"])) == ([], ["cmake", "make"])
+    # A manifest without build packages is treated as not having any.
+    assert cache_manifest_delta({k: v for k, v in prev.items() if k != "build_packages"}, manifest()) == ([], ["gcc"])
+
+    # Removing packages forces a rebuild.
+    assert cache_manifest_delta(prev, manifest(packages=["bash"])) is None
+    assert cache_manifest_delta(prev, manifest(packages=["bash", "systemd=255", "vim"], build_packages=[])) is None
+
+    # So do version changes, either of a package or of anything else in the manifest.
+    assert cache_manifest_delta(prev, manifest(packages=["bash", "systemd=256"])) is None
+    assert cache_manifest_delta(prev, manifest(release="99")) is None
+    assert cache_manifest_delta(prev, manifest(package_directories=[["foo.rpm", 2]])) is None
+
+
+def test_cache_stage_digests(tmp_path: Path) -> None:
+    for script in ("a.prepare", "b.prepare"):
+        (tmp_path / script).write_text("#!/bin/sh\n")
+        (tmp_path / script).chmod(0o755)
+
+    def digests() -> dict[str, str]:
+        with chdir(tmp_path):
+            _, images = parse_config([
+                "--distribution", "fedora",
+                "--prepare-script", "a.prepare",
+                "--prepare-script", "b.prepare",
+                "--build-script", "a.prepare",
+            ])
+
+        return {stage.name: stage.digest for stage in finalize_cache_stages(images[-1])}
+
+    prev = digests()
+    assert list(prev) == [
+        "base",
+        "packages",
+        "prepare-0",
+        "prepare-1",
+        "build-packages",
+        "prepare-build-0",
+        "prepare-build-1",
+    ]
+    assert digests() == prev
+
+    # Changing the inputs of a stage invalidates that stage and the stages after it, but not the ones before it.
+    (tmp_path / "b.prepare").write_text("#!/bin/sh\ntrue\n")
+    new = digests()
+    assert [name for name in prev if prev[name] == new[name]] == ["base", "packages", "prepare-0"]
+
+
+def test_cache_stages(context: Context) -> None:
+    context.config = dataclasses.replace(context.config, incremental=True, cache_stages=True)
+    # Snapshots are copied in the package manager sandbox, which has to be set up like in a real build.
+    install_sandbox_trees(context)
+    steps = []
+
+    def stage(name: str, build: bool = False) -> CacheStage:
+        def step(context: Context) -> None:
+            steps.append(name)
+            d = context.workspace / "build-overlay" if build else context.root
+            d.mkdir(exist_ok=True)
+            (d / name).write_text(name)
+
+        return CacheStage(name=name, digest=name, build=build, step=step)
+
+    stages = [stage("base"), stage("packages"), stage("build-packages", build=True)]
+
+    def build(stages: list[CacheStage]) -> None:
+        for d in (context.root, context.workspace / "build-overlay"):
+            if d.exists():
+                rmtree(d)
+
+        context.root.mkdir()
+        steps.clear()
+
+        with mock.patch("mkosi.finalize_cache_stages", return_value=stages):
+            run_cache_stages(context)
+
+    build(stages)
+    assert steps == ["base", "packages", "build-packages"]
+    snapshots = cache_tree_paths(context.config)[3]
+    assert sorted(p.name for p in snapshots.iterdir()) == [
+        "base.base",
+        "build-packages.build-packages",
+        "packages.packages",
+    ]
+    # Stages that run in the build overlay only store the build overlay.
+    assert sorted(p.name for p in (snapshots / "build-packages.build-packages").iterdir()) == ["build-overlay"]
+
+    # Everything is restored from the snapshot of the last stage.
+    build(stages)
+    assert steps == []
+    assert sorted(p.name for p in context.root.iterdir()) == ["base", "packages"]
+    assert sorted(p.name for p in (context.workspace / "build-overlay").iterdir()) == ["build-packages"]
+
+    # Only the stages after the last stage whose inputs didn't change are executed again, on top of the restored
+    # snapshot, and their snapshots are replaced.
+    stages[1:] = [dataclasses.replace(s, digest=f"{s.digest}-new") for s in stages[1:]]
+    build(stages)
+    assert steps == ["packages", "build-packages"]
+    assert sorted(p.name for p in context.root.iterdir()) == ["base", "packages"]
+    # Replaced snapshots are moved to the trash.
+    assert sorted(p.name for p in snapshots.iterdir() if p.name != TRASH_DIRECTORY) == [
+        "base.base",
+        "build-packages.build-packages-new",
+        "packages.packages-new",
+    ]
+
+
+@pytest.mark.parametrize(
+    "base_trees,output_format,removed",
+    [
+        ([], OutputFormat.disk, True),
+        ([Path("base")], OutputFormat.disk, False),
+        ([], OutputFormat.sysext, False),
+    ],
+)
+def test_install_distribution_packages_cleanup(
+    context: Context,
+    base_trees: list[Path],
+    output_format: OutputFormat,
+    removed: bool,
+) -> None:
+    context.config = dataclasses.replace(context.config, base_trees=base_trees, output_format=output_format)
+    seed = context.root / "var/lib/systemd/random-seed"
+    seed.parent.mkdir(parents=True)
+    seed.touch()
+
+    # Without packages to install, files that were supplied on purpose by base trees are left alone.
+    install_distribution_packages(context)
+    assert seed.exists() != removed
+
+
+@pytest.mark.skipif(os.getuid() != 0, reason="Mounting the cache overlay requires root privileges")
+def test_cache_overlay(context: Context, tmp_path: Path) -> None:
+    install_sandbox_trees(context)
+    lowerdir = tmp_path / "image.cache"
+    (lowerdir / "usr").mkdir(parents=True)
+    (lowerdir / "usr/file").write_text("cached")
+
+    def mount_and_modify() -> None:
+        unshare(CLONE_NEWNS)
+        mount("", "/", "", MS_SLAVE|MS_REC, "")
+
+        mount_cache_overlay(context, lowerdir)
+        assert have_cache_overlay(context)
+        assert (context.root / "usr/file").read_text() == "cached"
+
+        (context.root / "usr/file").write_text("modified")
+        (context.root / "new").touch()
+
+        # Only the modified files end up in the workspace, the cached tree itself is never modified.
+        assert sorted(p.name for p in (context.workspace / "cache-overlay").iterdir()) == ["new", "usr"]
+        assert (context.workspace / "cache-overlay/usr/file").read_text() == "modified"
+
+        unmount_cache_overlay(context)
+        assert not have_cache_overlay(context)
+        assert not (context.workspace / "cache-overlay-workdir").exists()
+        assert not any(context.root.iterdir())
+
+        # Unmounting is idempotent so it can be done unconditionally when the build finishes.
+        unmount_cache_overlay(context)
+
+    fork_and_wait(mount_and_modify)
+
+    assert (lowerdir / "usr/file").read_text() == "cached"
+    assert not (lowerdir / "new").exists()
+
+
+def test_want_cache_overlay(context: Context) -> None:
+    assert context.config.cache_dir
+    final = cache_tree_paths(context.config)[0]
+    final.mkdir(parents=True)
+
+    def want(feature: ConfigFeature, *, reflink: bool = False, delta: tuple[list[str], list[str]] = ([], [])) -> bool:
+        context.config = dataclasses.replace(context.config, cache_overlay=feature)
+        with (
+            mock.patch("mkosi.can_reflink", return_value=reflink),
+            mock.patch("mkosi.cache_package_delta", return_value=delta),
+        ):
+            return want_cache_overlay(context)
+
+    assert want(ConfigFeature.enabled)
+    assert not want(ConfigFeature.disabled)
+    # By default, the overlay is only used when the cached tree can't be reflinked cheaply instead.
+    assert want(ConfigFeature.auto)
+    assert not want(ConfigFeature.auto, reflink=True)
+    # Packages added since the cache was built are installed into the root directory, which can't be an overlay.
+    assert not want(ConfigFeature.enabled, delta=(["vim"], []))
@@ -18,6 +18,7 @@ from mkosi.config import (
     Config,
     ConfigFeature,
     ConfigTree,
+    CopyTool,
     DocFormat,
     KeySource,
     ManifestFormat,
@@ -55,6 +56,8 @@ def test_args(path: Optional[Path]) -> None:
             "GenkeyValidDays": "100",
             "Json": false,
             "Pager": true,
+            "Stats": false,
+            "Trace": null,
             "Verb": "build",
             "WipeBuildDir": true
         }}
@@ -74,6 +77,8 @@ def test_args(path: Optional[Path]) -> None:
         genkey_valid_days="100",
         json=False,
         pager=True,
+        stats=False,
+        trace=None,
         verb=Verb.build,
         wipe_build_dir=True,
     )
@@ -95,6 +100,7 @@ def test_config() -> None:
             "Bootable": "disabled",
             "Bootloader": "grub",
             "BuildDirectory": null,
+            "BuildJobs": 2,
             "BuildPackages": [
                 "pkg1",
                 "pkg2"
@@ -111,6 +117,8 @@ def test_config() -> None:
             "BuildSourcesEphemeral": true,
             "CacheDirectory": "/is/this/the/cachedir",
             "CacheOnly": "always",
+            "CacheOverlay": "auto",
+            "CacheStages": true,
             "Checksum": false,
             "CleanPackageMetadata": "auto",
             "CleanScripts": [
@@ -121,6 +129,7 @@ def test_config() -> None:
             "ConfigureScripts": [
                 "/configure"
             ],
+            "CopyTool": "cp",
             "Credentials": {
                 "credkey": "credval"
             },
@@ -315,6 +324,7 @@ def test_config() -> None:
             "Ssh": false,
             "SshCertificate": "/path/to/cert",
             "SshKey": null,
+            "StageInOutputDirectory": "enabled",
             "SyncScripts": [
                 "/sync"
             ],
@@ -370,11 +380,14 @@ def test_config() -> None:
         bootable=ConfigFeature.disabled,
         bootloader=Bootloader.grub,
         build_dir=None,
+        build_jobs=2,
         build_packages=["pkg1", "pkg2"],
         build_scripts=[Path("/path/to/buildscript")],
         build_sources=[ConfigTree(Path("/qux"), Path("/frob"))],
         build_sources_ephemeral=True,
         cache_dir=Path("/is/this/the/cachedir"),
+        cache_overlay=ConfigFeature.auto,
+        cache_stages=True,
         cacheonly=Cacheonly.always,
         checksum= False,
         clean_package_metadata=ConfigFeature.auto,
@@ -382,6 +395,7 @@ def test_config() -> None:
         compress_level=3,
         compress_output=Compression.bz2,
         configure_scripts=[Path("/configure")],
+        copy_tool=CopyTool.cp,
         credentials= {"credkey": "credval"},
         dependencies=["dep1"],
         distribution=Distribution.fedora,
@@ -492,6 +506,7 @@ def test_config() -> None:
         ssh=False,
         ssh_certificate=Path("/path/to/cert"),
         ssh_key=None,
+        stage_in_output_dir=ConfigFeature.enabled,
         sync_scripts=[Path("/sync")],
         timezone=None,
         tools_tree=None,
@@ -0,0 +1,220 @@
+# SPDX-License-Identifier: LGPL-2.1-or-later
+
+import lzma
+import os
+from pathlib import Path
+from typing import Any
+from unittest import mock
+
+from mkosi.kmod import (
+    MODINFO_CACHE_ENTRIES,
+    FirmwareIndex,
+    KernelModuleInventory,
+    ModuleInfo,
+    parse_modinfo,
+    read_modinfo_cache,
+    read_module_info,
+    resolve_module_dependencies,
+    write_modinfo_cache,
+)
+from mkosi.types import CompletedProcess
+from mkosi.util import chdir
+
+from .helpers import make_elf_module
+
+KVER = "6.0.0"
+MODULESD = Path("usr/lib/modules") / KVER
+
+
+def modinfo(modules: dict[str, tuple[list[str], list[str]]]) -> str:
+    info = []
+    for name, (depends, firmware) in modules.items():
+        info += [
+            f"filename:       /{MODULESD}/kernel/{name}.ko.xz",
+            *(f"firmware:       {fw}" for fw in firmware),
+            "softdep:        pre: crc32c",
+            f"depends:        {','.join(depends)}",
+            f"name:           {name.replace('-', '_')}",
+        ]
+
+    return "\0".join(info)
+
+
+def make_modules(root: Path, modules: dict[str, tuple[list[str], list[str]]]) -> None:
+    (root / MODULESD / "kernel").mkdir(parents=True)
+    (root / "usr/lib/firmware/vendor").mkdir(parents=True)
+
+    for name in modules:
+        (root / MODULESD / "kernel" / f"{name}.ko.xz").write_text(name)
+
+    (root / "usr/lib/firmware/vendor/fw.bin.xz").touch()
+
+
+def test_parse_modinfo() -> None:
+    info = parse_modinfo(modinfo({"foo-bar": (["baz"], ["vendor/fw.bin"]), "baz": ([], [])}))
+
+    assert info == {
+        MODULESD / "kernel/foo-bar.ko.xz": ModuleInfo(
+            name="foo-bar",
+            depends=("crc32c", "baz"),
+            firmware=("vendor/fw.bin",),
+        ),
+        MODULESD / "kernel/baz.ko.xz": ModuleInfo(name="baz", depends=("crc32c",), firmware=()),
+    }
+
+
+def test_resolve_module_dependencies_cache(tmp_path: Path) -> None:
+    root = tmp_path / "root"
+    modules = {"foo": (["bar"], ["vendor/fw.bin"]), "bar": ([], []), "unused": ([], []), "crc32c": ([], [])}
+    make_modules(root, modules)
+
+    calls = []
+
+    def run(cmdline: list[str], *args: Any, **kwargs: Any) -> CompletedProcess:
+        requested = [Path(p).name.partition(".")[0] for p in cmdline if p.startswith("/")]
+        calls.append(sorted(requested))
+        return CompletedProcess(cmdline, 0, modinfo({m: modules[m] for m in requested}), "")
+
+    with mock.patch("mkosi.kmod.run", run):
+        result = resolve_module_dependencies(root, KVER, ["foo"], cache=tmp_path / "cache")
+        assert result == (
+            {MODULESD / f"kernel/{m}.ko.xz" for m in ("foo", "bar", "crc32c")},
+            {Path("usr/lib/firmware/vendor/fw.bin.xz")},
+        )
+        assert calls == [["bar", "crc32c", "foo", "unused"]]
+
+        # Nothing changed, so modinfo shouldn't be invoked again.
+        assert resolve_module_dependencies(root, KVER, ["foo"], cache=tmp_path / "cache") == result
+        assert len(calls) == 1
+
+        # Only the changed module should be passed to modinfo.
+        (root / MODULESD / "kernel/unused.ko.xz").write_text("changed")
+        os.utime(root / MODULESD / "kernel/unused.ko.xz", ns=(0, 0))
+        assert resolve_module_dependencies(root, KVER, ["foo"], cache=tmp_path / "cache") == result
+        assert calls[1:] == [["unused"]]
+
+
+def test_modinfo_cache_eviction(tmp_path: Path) -> None:
+    for i in range(MODINFO_CACHE_ENTRIES):
+        write_modinfo_cache(tmp_path / f"modinfo-{i}.json", {"kver": i})
+        os.utime(tmp_path / f"modinfo-{i}.json", ns=(i, i))
+
+    # Reading a cache marks it as used so the oldest unused cache is evicted instead.
+    assert read_modinfo_cache(tmp_path / "modinfo-0.json") == {"kver": 0}
+    write_modinfo_cache(tmp_path / "modinfo-new.json", {})
+
+    assert sorted(p.name for p in tmp_path.iterdir()) == [
+        "modinfo-0.json",
+        "modinfo-2.json",
+        "modinfo-3.json",
+        "modinfo-new.json",
+    ]
+
+
+def test_read_module_info(tmp_path: Path) -> None:
+    fields = [
+        ("license", "GPL"),
+        ("firmware", "vendor/fw.bin"),
+        ("softdep", "pre: crc32c post: foo_bar"),
+        ("depends", "baz,qux_quux"),
+        ("name", "my_module"),
+    ]
+    expected = ModuleInfo(
+        name="my-module",
+        depends=("crc32c", "foo-bar", "baz", "qux-quux"),
+        firmware=("vendor/fw.bin",),
+    )
+
+    (tmp_path / "my-module.ko").write_bytes(make_elf_module(fields))
+    assert read_module_info(tmp_path / "my-module.ko") == expected
+
+    (tmp_path / "my-module32.ko").write_bytes(make_elf_module(fields, is64=False, endian=">"))
+    assert read_module_info(tmp_path / "my-module32.ko") == expected
+
+    (tmp_path / "my-module.ko.xz").write_bytes(lzma.compress(make_elf_module(fields)))
+    assert read_module_info(tmp_path / "my-module.ko.xz") == expected
+
+    (tmp_path / "garbage.ko").write_bytes(b"garbage")
+    assert read_module_info(tmp_path / "garbage.ko") is None
+
+
+def test_resolve_module_dependencies_depmod(tmp_path: Path) -> None:
+    root = tmp_path / "root"
+    modules = {"foo": (["bar"], ["vendor/fw.bin"]), "bar": ([], []), "unused": ([], []), "crc32c": ([], [])}
+    make_modules(root, modules)
+
+    (root / MODULESD / "modules.dep").write_text(
+        "kernel/foo.ko.xz: kernel/bar.ko.xz\n"
+        "kernel/bar.ko.xz:\n"
+        "kernel/unused.ko.xz:\n"
+        "kernel/crc32c.ko.xz:\n"
+    )
+    (root / MODULESD / "modules.softdep").write_text("# Soft dependencies\nsoftdep bar pre: crc32c\n")
+
+    calls = []
+
+    def run(cmdline: list[str], *args: Any, **kwargs: Any) -> CompletedProcess:
+        requested = [Path(p).name.partition(".")[0] for p in cmdline if p.startswith("/")]
+        calls.append(sorted(requested))
+        return CompletedProcess(cmdline, 0, modinfo({m: modules[m] for m in requested}), "")
+
+    expected = (
+        {MODULESD / f"kernel/{m}.ko.xz" for m in ("foo", "bar", "crc32c")},
+        {Path("usr/lib/firmware/vendor/fw.bin.xz")},
+    )
+
+    with mock.patch("mkosi.kmod.run", run):
+        # Only the modules that end up being included should be inspected to find their firmware.
+        assert resolve_module_dependencies(root, KVER, ["foo"]) == expected
+        assert calls == [["bar", "crc32c", "foo"]]
+
+        # If modules.dep is older than any of the modules, it can't be trusted.
+        os.utime(root / MODULESD / "modules.dep", ns=(0, 0))
+        assert resolve_module_dependencies(root, KVER, ["foo"]) == expected
+        assert calls[1:] == [["bar", "crc32c", "foo", "unused"]]
+
+
+def test_firmware_index(tmp_path: Path) -> None:
+    firmwared = tmp_path / "usr/lib/firmware"
+    (firmwared / "vendor/sub").mkdir(parents=True)
+    for p in ("fw.bin", "fw.bin.xz", "fw.bin2.zst", "fw.bim", "sub/fw.bin", "sub/other.bin"):
+        (firmwared / "vendor" / p).touch()
+    (firmwared / "top.bin").touch()
+    (firmwared / "alias").symlink_to("vendor")
+
+    index = FirmwareIndex(tmp_path)
+    assert sorted(index.walk()) == sorted(p.relative_to(tmp_path) for p in firmwared.rglob("*"))
+
+    for reference in ("vendor/fw.bin", "alias/fw.bin", "vendor/sub/", "top", "missing/fw.bin", "vendor/sub/fw"):
+        with chdir(tmp_path):
+            expected = sorted(Path("usr/lib/firmware").glob(f"{reference}*"))
+
+        assert sorted(index.glob(reference)) == expected
+
+
+def test_kernel_module_inventory(tmp_path: Path) -> None:
+    make_modules(tmp_path, {"foo": ([], []), "bar_baz": ([], [])})
+    (tmp_path / MODULESD / "kernel/sub").mkdir()
+    (tmp_path / MODULESD / "kernel/sub/qux.ko").touch()
+    (tmp_path / MODULESD / "modules.dep").touch()
+
+    inventory = KernelModuleInventory.get(tmp_path, KVER)
+    assert inventory.paths() == sorted(p.relative_to(tmp_path) for p in (tmp_path / MODULESD).rglob("*.ko*"))
+    assert inventory.by_name["bar-baz"] == MODULESD / "kernel/bar_baz.ko.xz"
+    assert inventory.filter(include=["sub/"], exclude=[".*"]) == [MODULESD / "kernel/sub/qux.ko"]
+    assert KernelModuleInventory.get(tmp_path, KVER) is inventory
+
+    # Modifying, adding or removing modules anywhere in the tree invalidates the inventory.
+    (tmp_path / MODULESD / "kernel/foo.ko.xz").write_text("changed")
+    inventory = KernelModuleInventory.get(tmp_path, KVER)
+    assert inventory.modules[MODULESD / "kernel/foo.ko.xz"].size == len("changed")
+
+    os.utime(tmp_path / MODULESD / "kernel/sub", ns=(0, 0))
+    assert KernelModuleInventory.get(tmp_path, KVER) is not inventory
+    inventory = KernelModuleInventory.get(tmp_path, KVER)
+
+    (tmp_path / MODULESD / "kernel/sub/qux.ko").unlink()
+    assert KernelModuleInventory.get(tmp_path, KVER).paths() == [
+        MODULESD / "kernel/bar_baz.ko.xz",
+        MODULESD / "kernel/foo.ko.xz",
+    ]
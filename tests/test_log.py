@@ -0,0 +1,55 @@
+# SPDX-License-Identifier: LGPL-2.1-or-later
+
+import json
+from pathlib import Path
+
+from mkosi import save_trace
+from mkosi.log import complete_step, profile_summary, start_profiling, stop_profiling
+from mkosi.run import run
+
+
+def test_trace(tmp_path: Path) -> None:
+    with complete_step("Untraced"):
+        pass
+
+    start_profiling()
+    try:
+        with complete_step("Outer"):
+            with complete_step("Inner"):
+                run(["sh", "-c", "i=0; while [ $i -lt 20000 ]; do i=$((i + 1)); done"])
+                (tmp_path / "file").write_bytes(b"0" * 1024)
+    finally:
+        events = stop_profiling()
+
+    # Steps are recorded when they finish, and steps that ran before profiling was started aren't recorded at all.
+    # The peak memory usage is only recorded once when profiling is stopped as it is cumulative.
+    assert [e["name"] for e in events] == ["Inner", "Outer", "Peak RSS"]
+    inner, outer, rss = events
+    assert (inner["args"]["level"], outer["args"]["level"]) == (1, 0)
+    assert all(e["ph"] == "X" and e["cat"] == "step" for e in (inner, outer))
+    assert outer["ts"] <= inner["ts"]
+    assert inner["ts"] + inner["dur"] <= outer["ts"] + outer["dur"]
+    # The CPU time of the shell is accounted to both steps.
+    assert inner["args"]["children_user_time"] + inner["args"]["children_system_time"] > 0
+    assert outer["args"]["children_user_time"] >= inner["args"]["children_user_time"]
+    assert "max_rss_bytes" not in inner["args"]
+    assert rss["ph"] == "C"
+    assert rss["args"]["peak_rss_bytes"] > 0
+
+    # Nothing is recorded once profiling was stopped.
+    with complete_step("Untraced"):
+        pass
+    assert stop_profiling() == []
+
+    summary = profile_summary(events).splitlines()
+    assert summary[0].split() == ["Wall", "CPU", "Read", "Written", "Step"]
+    assert summary[-1] == f"Peak RSS: {rss['args']['peak_rss_bytes'] // 1024**2}M"
+    # Steps are sorted by duration and indented by their level.
+    assert sorted(line.rsplit("M  ", maxsplit=1)[1] for line in summary[1:-1]) == [" Inner", "Outer"]
+    durations = [float(line.split()[0].rstrip("s")) for line in summary[1:-1]]
+    assert durations == sorted(durations, reverse=True)
+
+    # Events of multiple images are merged into the same trace.
+    save_trace(tmp_path / "trace.json", events[:1])
+    save_trace(tmp_path / "trace.json", events[1:])
+    assert json.loads((tmp_path / "trace.json").read_text()) == {"traceEvents": events}
@@ -0,0 +1,52 @@
+# SPDX-License-Identifier: LGPL-2.1-or-later
+
+import struct
+from pathlib import Path
+
+import pytest
+
+from mkosi.pe import copy_pe_section
+
+
+def make_pe(sections: dict[str, bytes], *, alignment: int = 0x200) -> bytes:
+    """Create a minimal PE32+ binary with the given sections, each padded to the file alignment."""
+    pe = 0x80
+    optsize = 240
+    headers = pe + 24 + optsize + 40 * len(sections)
+    offset = (headers + alignment - 1) // alignment * alignment
+
+    data = bytearray(offset)
+    data[:2] = b"MZ"
+    struct.pack_into("<I", data, 0x3C, pe)
+    data[pe:pe + 4] = b"PE\0\0"
+    struct.pack_into("<HHIIIHH", data, pe + 4, 0x8664, len(sections), 0, 0, 0, optsize, 0x22)
+    struct.pack_into("<HBB", data, pe + 24, 0x20B, 0, 0)
+    struct.pack_into("<II", data, pe + 24 + 32, 0x1000, alignment)
+
+    for i, (name, contents) in enumerate(sections.items()):
+        rawsize = (len(contents) + alignment - 1) // alignment * alignment
+        struct.pack_into(
+            "<8sIIIIIIHHI",
+            data,
+            pe + 24 + optsize + i * 40,
+            name.encode(), len(contents), 0x1000 * (i + 1), rawsize, len(data), 0, 0, 0, 0, 0x40000040,
+        )
+        data += contents + bytes(rawsize - len(contents))
+
+    return bytes(data)
+
+
+def test_copy_pe_section(tmp_path: Path) -> None:
+    sections = {".osrel": b"ID=test\n", ".linux": b"kernel" * 1000, ".initrd": b"initrd" * 333}
+    (tmp_path / "uki.efi").write_bytes(make_pe(sections))
+
+    for name, contents in sections.items():
+        copy_pe_section(tmp_path / "uki.efi", name, tmp_path / "section")
+        assert (tmp_path / "section").read_bytes() == contents
+
+    with pytest.raises(KeyError):
+        copy_pe_section(tmp_path / "uki.efi", ".sdmagic", tmp_path / "section")
+
+    (tmp_path / "garbage.efi").write_bytes(b"garbage")
+    with pytest.raises(ValueError):
+        copy_pe_section(tmp_path / "garbage.efi", ".linux", tmp_path / "section")
@@ -0,0 +1,101 @@
+# SPDX-License-Identifier: LGPL-2.1-or-later
+
+import os
+import subprocess
+import sys
+import time
+from pathlib import Path
+
+import pytest
+
+from mkosi.run import PROCESS_STATS, fork_and_wait_graph, run
+
+
+def run_graph(log: Path, graph: dict[int, list[int]], *, jobs: int, fail: int = -1) -> list[tuple[str, int]]:
+    def target(node: int) -> None:
+        with log.open("a") as f:
+            f.write(f"start {node}\n")
+            f.flush()
+            time.sleep(0.1)
+
+            if node == fail:
+                raise RuntimeError(f"node {node} failed")
+
+            f.write(f"end {node}\n")
+
+    try:
+        fork_and_wait_graph(target, graph, jobs=jobs)
+    finally:
+        events = [(event, int(node)) for event, node in (line.split() for line in log.read_text().splitlines())]
+
+    return events
+
+
+def concurrency(events: list[tuple[str, int]]) -> int:
+    running = peak = 0
+    for event, _ in events:
+        running += 1 if event == "start" else -1
+        peak = max(peak, running)
+
+    return peak
+
+
+@pytest.mark.parametrize("jobs", [1, 2, 4])
+def test_fork_and_wait_graph_order(tmp_path: Path, jobs: int) -> None:
+    graph = {0: [], 1: [0], 2: [0], 3: [], 4: [1, 2], 5: [4, 3]}
+    events = run_graph(tmp_path / "log", graph, jobs=jobs)
+
+    assert sorted(node for event, node in events if event == "end") == list(graph)
+    for node, dependencies in graph.items():
+        for d in dependencies:
+            assert events.index(("end", d)) < events.index(("start", node))
+
+
+@pytest.mark.parametrize("jobs", [1, 2, 3])
+def test_fork_and_wait_graph_jobs(tmp_path: Path, jobs: int) -> None:
+    events = run_graph(tmp_path / "log", {i: [] for i in range(6)}, jobs=jobs)
+    assert concurrency(events) == jobs
+
+
+def test_fork_and_wait_graph_failure(tmp_path: Path) -> None:
+    # A child forked by somebody else must not confuse the scheduler.
+    pid = os.fork()
+    if pid == 0:
+        os._exit(0)
+
+    try:
+        with pytest.raises(subprocess.CalledProcessError):
+            run_graph(tmp_path / "log", {0: [], 1: [0], 2: [1], 3: []}, jobs=2, fail=1)
+    finally:
+        os.waitpid(pid, 0)
+
+    events = (tmp_path / "log").read_text().splitlines()
+    assert "end 0" in events
+    assert "end 1" not in events
+    # Nodes that depend on the failing node are never started.
+    assert "start 2" not in events
+
+
+def test_fork_and_wait_graph_output(capfd: pytest.CaptureFixture[str]) -> None:
+    def target(node: int) -> None:
+        print(f"stdout {node}", file=sys.stdout, flush=True)
+        print(f"stderr {node}", file=sys.stderr, flush=True)
+
+    fork_and_wait_graph(target, {0: [], 1: [0], 2: []}, jobs=2)
+
+    # The captured output of every child is replayed to the stream it was written to.
+    out, err = capfd.readouterr()
+    assert sorted(out.splitlines()) == ["stdout 0", "stdout 1", "stdout 2"]
+    assert sorted(err.splitlines()) == ["stderr 0", "stderr 1", "stderr 2"]
+
+
+def test_process_stats() -> None:
+    PROCESS_STATS.clear()
+
+    run(["sh", "-c", "i=0; while [ $i -lt 20000 ]; do i=$((i + 1)); done"])
+    assert run(["sh", "-c", "exit 3"], check=False).returncode == 3
+
+    stats = PROCESS_STATS["sh"]
+    assert stats.count == 2
+    assert stats.user_time + stats.system_time > 0
+    assert stats.max_rss > 0
@@ -0,0 +1,258 @@
+# SPDX-License-Identifier: LGPL-2.1-or-later
+
+import os
+import stat
+import time
+from pathlib import Path
+from typing import Any
+from unittest import mock
+
+import pytest
+
+from mkosi.config import CopyTool
+from mkosi.tree import (
+    TRASH_DIRECTORY,
+    TreeIndex,
+    clamp_mtime,
+    copy_tree,
+    empty_trash,
+    exchange_tree,
+    remove_tree,
+    rmtree,
+)
+from mkosi.util import chdir
+
+
+def make_tree(root: Path) -> None:
+    (root / "dir/subdir").mkdir(parents=True)
+    (root / "file").write_text("hello")
+    (root / "dir/subdir/other").write_text("world")
+    (root / "dir/subdir/other").chmod(0o4755)
+    os.link(root / "file", root / "dir/link")
+    os.link(root / "dir/subdir/other", root / "dir/other")
+    (root / "symlink").symlink_to("file")
+    (root / "dirlink").symlink_to("dir")
+
+    with (root / "sparse").open("wb") as f:
+        f.seek(1024**2)
+        f.write(b"tail")
+
+    try:
+        os.setxattr(root / "file", "user.mkosi", b"value")
+    except OSError:
+        pass
+
+    (root / "readonly").mkdir()
+    (root / "readonly/file").touch()
+    (root / "readonly").chmod(0o555)
+
+    for p in sorted(root.rglob("*"), reverse=True):
+        os.utime(p, ns=(1_000_000_000, 2_000_000_000), follow_symlinks=False)
+
+
+def describe(root: Path) -> dict[str, Any]:
+    tree = {}
+    inodes: dict[int, str] = {}
+
+    for p in sorted(root.rglob("*")):
+        st = p.lstat()
+        rel = os.fspath(p.relative_to(root))
+
+        tree[rel] = (
+            stat.S_IFMT(st.st_mode),
+            stat.S_IMODE(st.st_mode) if not p.is_symlink() else None,
+            st.st_size,
+            st.st_mtime_ns if not p.is_symlink() else None,
+            os.readlink(p) if p.is_symlink() else None,
+            p.read_bytes() if p.is_file() and not p.is_symlink() else None,
+            inodes.setdefault(st.st_ino, rel),
+            sorted(os.listxattr(p, follow_symlinks=False)),
+        )
+
+    return tree
+
+
+@pytest.mark.parametrize("preserve", [True, False])
+def test_copy_tree_native(tmp_path: Path, preserve: bool) -> None:
+    make_tree(tmp_path / "src")
+
+    try:
+        for tool in (CopyTool.cp, CopyTool.native):
+            (tmp_path / str(tool)).mkdir()
+            (tmp_path / str(tool) / "existing").mkdir()
+            (tmp_path / str(tool) / "dir").mkdir()
+            for d in ("existing", "dir"):
+                os.utime(tmp_path / str(tool) / d, ns=(3_000_000_000, 4_000_000_000))
+
+            copy_tree(tmp_path / "src", tmp_path / str(tool), preserve=preserve, copy_tool=tool)
+
+            # Files and directories are merged into existing directories.
+            copy_tree(tmp_path / "src/file", tmp_path / str(tool) / "existing", preserve=preserve, copy_tool=tool)
+            copy_tree(tmp_path / "src/dir", tmp_path / str(tool) / "dir", preserve=preserve, copy_tool=tool)
+
+        native = describe(tmp_path / "native")
+        cp = describe(tmp_path / "cp")
+
+        if preserve:
+            # Copying the file modifies the existing directory, which isn't part of the source tree.
+            assert native.pop("existing")[3] > 4_000_000_000
+            assert cp.pop("existing")[3] > 4_000_000_000
+        else:
+            # Only the timestamps of existing directories are restored when not preserving metadata.
+            for d in ("existing", "dir"):
+                assert native.pop(d)[3] == cp.pop(d)[3] == 4_000_000_000
+
+            native = {k: (*v[:3], None, *v[4:]) for k, v in native.items()}
+            cp = {k: (*v[:3], None, *v[4:]) for k, v in cp.items()}
+
+        assert native == cp
+        assert native["sparse"][5] == bytes(1024**2) + b"tail"
+        assert native["dir/subdir/other"][6] == native["dir/other"][6]
+    finally:
+        for d in ("src", "cp", "native"):
+            if (tmp_path / d / "readonly").exists():
+                (tmp_path / d / "readonly").chmod(0o755)
+
+
+def test_rmtree_background(tmp_path: Path) -> None:
+    for i in range(100):
+        (tmp_path / f"tree/{i % 10}/{i}").mkdir(parents=True)
+        (tmp_path / f"tree/{i % 10}/{i}/file").touch()
+        (tmp_path / f"tree/{i % 10}/{i}/symlink").symlink_to("file")
+    (tmp_path / "file").touch()
+
+    rmtree(tmp_path / "tree", tmp_path / "file", background=True)
+    assert not (tmp_path / "tree").exists()
+    assert not (tmp_path / "file").exists()
+
+    # The tree is removed by a detached process so wait for it to finish.
+    for _ in range(100):
+        if not any((tmp_path / TRASH_DIRECTORY).iterdir()):
+            break
+        time.sleep(0.1)
+
+    assert not any((tmp_path / TRASH_DIRECTORY).iterdir())
+
+
+def test_remove_tree(tmp_path: Path) -> None:
+    (tmp_path / "outside").mkdir()
+    (tmp_path / "outside/file").touch()
+
+    for i in range(200):
+        (tmp_path / f"tree/{i % 3}/{i % 7}/{i}").mkdir(parents=True, exist_ok=True)
+        (tmp_path / f"tree/{i % 3}/{i % 7}/{i}/file").touch()
+    (tmp_path / "tree/1/link").symlink_to(tmp_path / "outside", target_is_directory=True)
+    os.mkfifo(tmp_path / "tree/2/fifo")
+
+    remove_tree(tmp_path / "tree")
+    assert not (tmp_path / "tree").exists()
+    # Symlinks to directories are removed, never followed.
+    assert (tmp_path / "outside/file").exists()
+
+    # A tree that was replaced by a symlink is removed instead of being followed.
+    (tmp_path / "tree").symlink_to(tmp_path / "outside", target_is_directory=True)
+    remove_tree(tmp_path / "tree")
+    assert not (tmp_path / "tree").is_symlink()
+    assert (tmp_path / "outside/file").exists()
+
+
+def test_empty_trash_foreign(tmp_path: Path) -> None:
+    (tmp_path / "outside/dir").mkdir(parents=True)
+    (tmp_path / "symlink").mkdir()
+    (tmp_path / "symlink" / TRASH_DIRECTORY).symlink_to(tmp_path / "outside", target_is_directory=True)
+    (tmp_path / "foreign" / TRASH_DIRECTORY / "dir").mkdir(parents=True)
+    if os.getuid() == 0:
+        os.chown(tmp_path / "foreign" / TRASH_DIRECTORY, 65534, 65534)
+
+    # Trash directories that are symlinks or that are owned by another user are skipped before forking.
+    with mock.patch("mkosi.tree.fork_detached") as fork:
+        empty_trash(tmp_path / "symlink", *([tmp_path / "foreign"] if os.getuid() == 0 else []))
+
+    fork.assert_not_called()
+    assert (tmp_path / "outside/dir").exists()
+
+
+def test_clamp_mtime(tmp_path: Path) -> None:
+    for i in range(20):
+        (tmp_path / f"root/{i % 4}/{i}").mkdir(parents=True)
+        (tmp_path / f"root/{i % 4}/{i}/file").touch()
+        (tmp_path / f"root/{i % 4}/{i}/symlink").symlink_to("file")
+    (tmp_path / "root/old").touch()
+    os.utime(tmp_path / "root/old", ns=(0, 0))
+
+    entries = [tmp_path / "root", *(tmp_path / "root").rglob("*")]
+    index = TreeIndex.scan(tmp_path / "root")
+    assert clamp_mtime(index, 1_000_000_000) == len(entries) - 1
+    assert clamp_mtime(index, 1_000_000_000) == 0
+
+    for p in entries:
+        st = p.lstat()
+        assert st.st_mtime_ns == st.st_atime_ns == (0 if p.name == "old" else 1_000_000_000)
+        assert index[p.relative_to(tmp_path / "root")].st_mtime_ns == st.st_mtime_ns
+
+
+def test_clamp_mtime_after_remove(tmp_path: Path) -> None:
+    (tmp_path / "root/dir").mkdir(parents=True)
+    (tmp_path / "root/dir/file").touch()
+    (tmp_path / "root/dir/other").touch()
+    for p in (tmp_path / "root/dir/file", tmp_path / "root/dir/other", tmp_path / "root/dir"):
+        os.utime(p, ns=(500, 500))
+
+    index = TreeIndex.scan(tmp_path / "root")
+    (tmp_path / "root/dir/file").unlink()
+    index.remove(Path("dir/file"))
+    assert index[Path("dir")].st_mtime_ns > 500
+
+    clamp_mtime(index, 1000 * 1_000_000_000)
+    assert (tmp_path / "root/dir").stat().st_mtime_ns == 1000 * 1_000_000_000
+    assert index[Path("dir")].st_mtime_ns == 1000 * 1_000_000_000
+    assert (tmp_path / "root/dir/other").stat().st_mtime_ns == 500
+
+
+def test_tree_index(tmp_path: Path) -> None:
+    make_tree(tmp_path / "root")
+    (tmp_path / "root/usr/lib/modules").mkdir(parents=True)
+    (tmp_path / "root/usr/lib/modules/.hidden").touch()
+    (tmp_path / "root/lib").symlink_to("usr/lib")
+    (tmp_path / "root/abs").symlink_to("/usr/lib")
+
+    try:
+        index = TreeIndex.scan(tmp_path / "root")
+        with chdir(tmp_path / "root"):
+            assert index.paths() == sorted(Path(".").rglob("*"))
+            assert index.directories() == [Path("."), *sorted(Path(".").glob("**/"))[1:]]
+            assert index.glob("**/other") == list(Path(".").glob("**/other"))
+
+        assert index.resolve(Path("lib/modules")) == Path("usr/lib/modules")
+        assert index.resolve(Path("abs/modules/.hidden")) == Path("usr/lib/modules/.hidden")
+        assert index.glob("lib/*/.hidden") == [Path("usr/lib/modules/.hidden")]
+        assert index.glob("dirlink/sub*") == [Path("dir/subdir")]
+        assert index.glob("missing/*") == []
+
+        (tmp_path / "root/usr/lib/modules/new").touch()
+        index.update(Path("usr/lib/modules"))
+        assert index.glob("usr/lib/modules/*") == [Path("usr/lib/modules/.hidden"), Path("usr/lib/modules/new")]
+
+        index.remove(Path("usr"))
+        assert index.glob("usr/**") == []
+        assert Path("usr/lib/modules/new") not in index
+        assert Path("usr") not in index.glob("*")
+    finally:
+        (tmp_path / "root/readonly").chmod(0o755)
+
+
+def test_exchange_tree(tmp_path: Path) -> None:
+    (tmp_path / "staging/image").mkdir(parents=True)
+    (tmp_path / "staging/image/new").touch()
+    (tmp_path / "staging/image.raw").write_text("new")
+    (tmp_path / "output/image").mkdir(parents=True)
+    (tmp_path / "output/image/old").touch()
+
+    assert exchange_tree(tmp_path / "staging/image", tmp_path / "output/image")
+    assert exchange_tree(tmp_path / "staging/image.raw", tmp_path / "output/image.raw")
+
+    assert (tmp_path / "output/image/new").exists()
+    assert (tmp_path / "output/image.raw").read_text() == "new"
+    # The previous outputs end up in the staging directory.
+    assert (tmp_path / "staging/image/old").exists()
+    assert not (tmp_path / "staging/image.raw").exists()